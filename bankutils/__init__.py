@@ -0,0 +1,8 @@
+'''
+Helpers shared by the scripts in this repository.
+
+Scripts import this package by adding the repository root to sys.path, eg.
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+    from bankutils import metrics
+'''
@@ -0,0 +1,86 @@
+'''
+In-memory index of the API's allocations, keyed by (project, resource).
+
+Looking up an allocation with `allocations/?project=..&resources=..` costs a
+round trip per project (two or three per project in the sync scripts).
+AllocationIndex.load() reads every allocation in one paginated sweep of
+`allocations/` instead, and load_attributes() fetches the attributes of the
+indexed allocations (eg. Service Units) a few requests at a time, since the
+API only serves them per allocation.
+
+The scripts pass in their own request helpers, so requests keep going through
+their auth header and metrics:
+
+    ALLOCATIONS = allocations.AllocationIndex.load(paginate_requests, BASE_URL)
+    ALLOCATIONS.load_attributes(single_request, BASE_URL)
+    allocation = ALLOCATIONS.get('fc_proj', 'Savio Compute')
+'''
+SERVICE_UNITS = 'Service Units'
+
+
+def compute_resource(resources_table, project):
+    '''project name -> compute resource of its allocation, eg. fc_foo -> Savio Compute'''
+    header = project.split('_')[0]
+    return resources_table.get(header, '{} Compute'.format(header.upper()))
+
+
+class AllocationIndex(object):
+    def __init__(self, allocations):
+        self.allocations = {}  # (project, resource) -> allocation
+        self.attributes = {}   # (allocation id, attribute type) -> [attribute]
+        for allocation in allocations:
+            for resource in allocation.get('resources') or []:
+                # the API lists allocations in order, the first one wins like it did per project
+                self.allocations.setdefault((allocation['project'], resource), allocation)
+
+    @classmethod
+    def load(cls, paginate, base_url):
+        '''paginate(url, params) -> all results of a paginated endpoint'''
+        return cls(paginate(base_url + 'allocations/', {}))
+
+    def __len__(self):
+        return len(self.allocations)
+
+    def get(self, project, resource):
+        return self.allocations.get((project, resource))
+
+    def start_date(self, project, resource):
+        '''start date of the allocation without fractional seconds, None if unknown'''
+        allocation = self.get(project, resource)
+        creation = allocation.get('start_date') if allocation else None
+        if not creation:
+            return None
+
+        return creation.split('.')[0] if '.' in creation else creation
+
+    def load_attributes(self, request, base_url, attribute_type=SERVICE_UNITS, keys=None, workers=8):
+        '''fetch attribute_type of the allocations under keys (default: all of them),
+        request(url, params) -> results of a single request, None on failure'''
+        keys = self.allocations.keys() if keys is None else keys
+        ids = sorted(set(self.allocations[key]['id'] for key in keys if key in self.allocations))
+        ids = [allocation_id for allocation_id in ids if (allocation_id, attribute_type) not in self.attributes]
+
+        def fetch(allocation_id):
+            url = base_url + 'allocations/{}/attributes/'.format(allocation_id)
+            return allocation_id, request(url, {'type': attribute_type})
+
+        from multiprocessing.pool import ThreadPool  # here, check_usage only needs it for its report
+        pool = ThreadPool(max(1, min(workers, len(ids))))
+        try:
+            for allocation_id, attributes in pool.imap_unordered(fetch, ids):
+                if attributes is not None:
+                    self.attributes[(allocation_id, attribute_type)] = attributes
+        finally:
+            pool.close()
+
+        return len(ids)
+
+    def attribute(self, project, resource, attribute_type=SERVICE_UNITS):
+        '''first attribute_type attribute of the allocation, None if unknown
+        (load_attributes() must have been called for it)'''
+        allocation = self.get(project, resource)
+        if allocation is None:
+            return None
+
+        attributes = self.attributes.get((allocation['id'], attribute_type))
+        return attributes[0] if attributes else None
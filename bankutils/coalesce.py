@@ -0,0 +1,86 @@
+'''
+TTL cache that fetches each missing key once, however many threads ask for it.
+
+When a class runs check_usage at the same time, the login node daemon gets
+the same few queries hundreds of times within a second. CoalescingCache
+serves repeats from the cache for `ttl` seconds, and while a key is being
+fetched other threads asking for it wait for that fetch instead of starting
+their own:
+
+    cache = coalesce.CoalescingCache(ttl=60)
+    response = cache.get(url, lambda: fetch(url))
+
+Errors are handed to the waiting threads too, but are not cached.
+'''
+import time
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CoalescingCache(object):
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}   # key -> (expires, value)
+        self.inflight = {}  # key -> _Call
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, fetch, cacheable=None):
+        '''the cached value of key, or fetch() it. cacheable(value) -> False keeps a value out of the cache'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self.inflight[key] = _Call()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fetch()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+                if call.error is None and (cacheable is None or cacheable(call.value)):
+                    self._store(key, call.value)
+            call.done.set()
+
+        return call.value
+
+    def _store(self, key, value):
+        now = time.time()
+        if len(self.entries) >= self.max_entries:
+            for old in [k for k, (expires, _) in self.entries.items() if expires <= now]:
+                del self.entries[old]
+        if len(self.entries) >= self.max_entries:  # all fresh, drop the ones closest to expiring
+            for old, _ in sorted(self.entries.items(), key=lambda item: item[1][0])[:len(self.entries) // 10 + 1]:
+                del self.entries[old]
+        self.entries[key] = (now + self.ttl, value)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'inflight': len(self.inflight),
+                    'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
@@ -0,0 +1,133 @@
+'''
+Conditional GETs of the API endpoints that rarely change.
+
+projects/, allocations/ (with their attributes) and allocation_users/ are
+mostly the same from one run to the next. ValidatorCache keeps the last
+response to each of their urls with its validators (ETag, Last-Modified), so
+the next request for the url can be conditional, and a 304 Not Modified is
+answered with the kept body instead of the API sending it again:
+
+    cache = httpcache.ValidatorCache('.http_cache')  # or ValidatorCache() to keep them in memory
+    headers.update(cache.request_headers(url, AUTH_TOKEN))  # If-None-Match / If-Modified-Since
+    status, body = send(url, headers)
+    status, body = cache.response(url, status, response.getheader, body, AUTH_TOKEN)  # a 304 becomes (200, kept body)
+
+The API still checks every response, nothing is served without asking it.
+Responses are kept per credentials (the request's Authorization header) and
+url, so runs with different tokens (or modes) can share a directory: a
+response kept for one token is never the answer to a request made with
+another. Only a hash of the credentials is kept. A directory is made
+readable by its owner only, the responses are the API's data.
+'''
+import os
+import re
+import json
+import hashlib
+import threading
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+
+CACHEABLE = re.compile(r'/(projects|allocations|allocation_users)/')
+
+
+class ValidatorCache(object):
+    def __init__(self, directory=None, max_entries=10000, cacheable=CACHEABLE):
+        '''responses are kept in directory (one file per token and url), or in memory without one'''
+        self.directory = directory
+        self.max_entries = max_entries
+        self.cacheable = cacheable
+        self.entries = {}  # (scope, url) -> (etag, last modified, body), without a directory
+        self.lock = threading.Lock()
+        self.not_modified = 0
+        self.modified = 0
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+    @staticmethod
+    def _scope(credentials):
+        '''what responses are kept under for these credentials, a hash of them'''
+        return hashlib.sha256((credentials or '').encode('utf-8')).hexdigest()
+
+    def _path(self, scope, url):
+        return os.path.join(self.directory, hashlib.sha1((scope + '\n' + url).encode('utf-8')).hexdigest())
+
+    def _load(self, scope, url, with_body=True):
+        '''(etag, last modified, body) kept for url, None if there is nothing (or nothing readable)'''
+        if self.directory is None:
+            with self.lock:
+                return self.entries.get((scope, url))
+
+        try:
+            with open(self._path(scope, url), 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+                if meta.get('url') != url or meta.get('scope') != scope:
+                    return None
+                return meta.get('etag'), meta.get('last_modified'), f.read() if with_body else None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save(self, scope, url, etag, last_modified, body):
+        if self.directory is None:
+            with self.lock:
+                if (scope, url) not in self.entries and len(self.entries) >= self.max_entries:
+                    self.entries.pop(next(iter(self.entries)))
+                self.entries[(scope, url)] = (etag, last_modified, body)
+            return
+
+        # written + renamed, so a concurrent run never reads half a body
+        path = self._path(scope, url)
+        temp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        meta = json.dumps({'url': url, 'scope': scope, 'etag': etag, 'last_modified': last_modified})
+        try:
+            fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(meta.encode('utf-8') + b'\n')
+                f.write(body)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            pass  # the cache is only an optimization
+
+    def request_headers(self, url, credentials=None):
+        '''the conditional headers of a GET of url, sent with these credentials (Authorization header)'''
+        if not self.cacheable.search(urlparse(url).path):
+            return {}
+
+        entry = self._load(self._scope(credentials), url, with_body=False)
+        if entry is None:
+            return {}
+
+        etag, last_modified, _ = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def response(self, url, status, header, body, credentials=None):
+        '''(status, body) of a GET of url: a 304 becomes the kept response, the validators of a 200 are kept.
+        header(name) is the response's header, credentials those the request was sent with'''
+        scope = self._scope(credentials)
+        if status == 304:
+            entry = self._load(scope, url)
+            if entry is None:
+                return status, body  # dropped since the request, the caller sees the 304
+            with self.lock:
+                self.not_modified += 1
+            return 200, entry[2]
+
+        if status == 200 and self.cacheable.search(urlparse(url).path):
+            etag, last_modified = header('ETag'), header('Last-Modified')
+            if etag or last_modified:
+                self._save(scope, url, etag, last_modified, body)
+                with self.lock:
+                    self.modified += 1
+        return status, body
+
+    def stats(self):
+        with self.lock:
+            return {'not_modified': self.not_modified, 'modified': self.modified}
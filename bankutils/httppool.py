@@ -0,0 +1,138 @@
+'''
+Keep-alive connections to the API, shared between threads.
+
+urllib2 opens a new connection (and TLS handshake) for every request.
+ConnectionPool keeps up to `size` connections to the API host open and hands
+them to whichever thread makes the next request, so a process that makes many
+requests (the check_usage daemon, batch queries) pays for the handshake once
+per connection instead of once per request.
+
+    pool = httppool.ConnectionPool('https://mybrc.brc.berkeley.edu/api/')
+    status, body = pool.request('GET', pool.base_url + 'jobs/?account=fc_foo',
+                                {'Authorization': AUTH_TOKEN})
+
+Requests go through a transport.Transport, which traces them (with a
+tracing.Tracer, new connections are then opened step by step, so their spans
+split the time into dns, connect and tls), waits for the rate limit, makes
+GETs conditional with an httpcache.ValidatorCache and decompresses
+responses.
+'''
+import socket
+import threading
+
+from bankutils import transport
+
+try:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlparse
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlparse
+
+
+class ConnectionPool(object):
+    def __init__(self, base_url, size=8, timeout=30, tracer=None, limiter=None, cache=None):
+        parsed = urlparse(base_url)
+        self.base_url = base_url
+        self.scheme = parsed.scheme
+        self.host = parsed.netloc
+        self.timeout = timeout
+        self.transport = transport.Transport(tracer, limiter, cache)
+        self.tracer = self.transport.tracer
+        self.cache = cache
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(size)
+        self.connects = 0
+        self.requests = 0
+
+    def _connect(self):
+        with self.lock:
+            self.connects += 1
+        kind = HTTPSConnection if self.scheme == 'https' else HTTPConnection
+        return kind(self.host, timeout=self.timeout)
+
+    def _open(self, connection, span):
+        '''connect, as connection.connect() would, with a lap for each step'''
+        address = socket.getaddrinfo(connection.host, connection.port, 0, socket.SOCK_STREAM)[0][4]
+        span.lap('dns')
+        sock = socket.create_connection(address[:2], self.timeout)
+        span.lap('connect')
+        if self.scheme == 'https':
+            import ssl
+            context = getattr(connection, '_context', None) or ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=connection.host)
+            span.lap('tls')
+        connection.sock = sock
+
+    def _path(self, url):
+        parsed = urlparse(url)
+        if parsed.netloc and parsed.netloc != self.host:
+            raise ValueError('{} is not on {}'.format(url, self.host))
+        return parsed.path + ('?' + parsed.query if parsed.query else '')
+
+    def request(self, method, url, headers=None, body=None):
+        '''(status, body) of a request to url, on a pooled connection'''
+        path = self._path(url)
+        with self.slots:
+            return self.transport.request(method, url, headers or {}, body,
+                                          lambda headers, span: self._send(method, path, headers, body, span))
+
+    def _send(self, method, path, headers, body, span):
+        '''send the request on an idle connection (or a new one), the response once its status line is in'''
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+            self.requests += 1
+
+        reused = connection is not None
+        span.args['reused'] = reused
+        while True:
+            if connection is None:
+                connection = self._connect()
+            try:
+                if self.tracer.enabled and connection.sock is None:
+                    self._open(connection, span)
+                connection.request(method, path, body, headers)
+                span.lap('send')
+                return PooledResponse(self, connection, connection.getresponse())
+            except (HTTPException, socket.error):
+                connection.close()
+                connection = None
+                if not reused:
+                    raise
+                reused = False  # the server may have closed an idle connection, try a fresh one once
+                span.args.update(reused=False, reconnected=True)
+
+    def _release(self, connection, response):
+        if response.will_close or not response.isclosed():  # the server closes it, or the body wasn't read
+            connection.close()
+        else:
+            with self.lock:
+                self.idle.append(connection)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+class PooledResponse(object):
+    '''a response on a pooled connection, the connection goes back to the pool once the response is closed'''
+
+    def __init__(self, pool, connection, response):
+        self.pool = pool
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+
+    def getheader(self, name):
+        return self.response.getheader(name)
+
+    def read(self, size=None):
+        return self.response.read() if size is None else self.response.read(size)
+
+    def close(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            self.pool._release(connection, self.response)
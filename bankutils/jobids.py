@@ -0,0 +1,85 @@
+'''
+Compact sets of slurm job ids, for finding the jobs one side is missing.
+
+The job ids of an allocation year are a few million ints. A python set of
+them costs ~70 bytes per id, JobIdSet keeps them as a sorted array('l') (8
+bytes per id) and only the rare ids that are not numeric (array and het jobs,
+1234_5, 1234+0) in a set. difference() walks both sorted arrays once, or uses
+numpy.setdiff1d if NumPy is installed.
+
+    slurm = jobids.JobIdSet(sacct_ids)
+    api = jobids.JobIdSet(api_ids)
+    missing = slurm - api
+'''
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _difference(left, right):
+    '''sorted array('l') minus sorted array('l')'''
+    if numpy is not None:
+        dtype = 'i{}'.format(left.itemsize)
+        result = numpy.setdiff1d(numpy.frombuffer(left, dtype=dtype) if len(left) else numpy.zeros(0, dtype),
+                                 numpy.frombuffer(right, dtype=dtype) if len(right) else numpy.zeros(0, dtype),
+                                 assume_unique=True)
+        return array.array('l', result.tolist())
+
+    out = array.array('l')
+    index, count = 0, len(right)
+    for value in left:
+        while index < count and right[index] < value:
+            index += 1
+        if index == count or right[index] != value:
+            out.append(value)
+    return out
+
+
+class JobIdSet(object):
+    def __init__(self, jobids=()):
+        self.numeric = array.array('l')
+        self.other = set()
+        self.sorted = True
+        self.update(jobids)
+
+    def add(self, jobid):
+        jobid = str(jobid)
+        if jobid.isdigit():
+            if self.sorted and self.numeric and self.numeric[-1] >= int(jobid):
+                self.sorted = False
+            self.numeric.append(int(jobid))
+        else:
+            self.other.add(jobid)
+
+    def update(self, jobids):
+        for jobid in jobids:
+            self.add(jobid)
+
+    def _sort(self):
+        '''sort and drop duplicates, once, before the ids are compared'''
+        if not self.sorted:
+            self.numeric = array.array('l', sorted(set(self.numeric)))
+            self.sorted = True
+        return self.numeric
+
+    def difference(self, other):
+        '''JobIdSet of the ids in self but not in other'''
+        result = JobIdSet()
+        result.numeric = _difference(self._sort(), other._sort())
+        result.other = self.other - other.other
+        return result
+
+    __sub__ = difference
+
+    def __len__(self):
+        return len(self._sort()) + len(self.other)
+
+    def __iter__(self):
+        '''the ids as strings, numeric ones in order'''
+        for jobid in self._sort():
+            yield str(jobid)
+        for jobid in sorted(self.other):
+            yield jobid
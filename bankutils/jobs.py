@@ -0,0 +1,258 @@
+'''
+Compact column store for the jobs of a sync run.
+
+A full sync holds every job of the allocation period between parsing and
+pushing. A dict per job (16 keys plus a list of {'name': node} dicts) costs
+well over a kilobyte, so JobTable keeps one column per field instead: job
+ids, times, counts and amounts in typed arrays, and the repetitive strings
+(user, account, state, partition, qos, nodelist) as codes into per-table
+lists. The API payload of a job is only built when it is needed, by
+JobTable.payload().
+
+JobTable.extend_sacct() parses a whole block of sacct output at once: the
+lines are split and transposed into columns, each column is converted in one
+pass, and run time and amount are computed over whole columns (with NumPy if
+it is installed). Rows that can't be parsed (eg. End=Unknown) are returned
+with the reason instead of going through a try/except per row.
+'''
+import array
+
+from bankutils import timeconv
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    range = xrange  # noqa: F821, don't build a list of every row on python2
+except NameError:
+    pass
+
+
+# the columns extend_sacct() expects, pass as sacct --format=SACCT_FORMAT
+SACCT_FIELDS = ('JobId', 'Submit', 'Start', 'End', 'UID', 'Account', 'State', 'Partition', 'QOS', 'NodeList',
+                'AllocCPUS', 'ReqNodes', 'AllocNodes', 'CPUTimeRAW', 'CPUTime')
+SACCT_FORMAT = ','.join(SACCT_FIELDS)
+
+
+def expand_node_list(nodelist):
+    '''slurm hostlist -> node names, eg. n0[100-102,110].savio3 -> n0100.savio3, n0101.savio3, ...'''
+    names = []
+    depth, begin = 0, 0
+    items = []
+    for index, char in enumerate(nodelist):
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(nodelist[begin:index])
+            begin = index + 1
+    items.append(nodelist[begin:])
+
+    for item in items:
+        if '[' not in item:
+            if item:
+                names.append(item)
+            continue
+
+        prefix, rest = item.split('[', 1)
+        ranges, suffix = rest.split(']', 1)
+        for part in ranges.split(','):
+            low, _, high = part.partition('-')
+            width = len(low)
+            for number in range(int(low), int(high or low) + 1):
+                names.append('{}{:0{}d}{}'.format(prefix, number, width, suffix))
+
+    return names
+
+
+class Codes(object):
+    '''interns strings as small ints'''
+
+    def __init__(self):
+        self.values = []
+        self.index = {}
+
+    def code(self, value):
+        try:
+            return self.index[value]
+        except KeyError:
+            self.index[value] = len(self.values)
+            self.values.append(value)
+            return self.index[value]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class JobTable(object):
+    # columns coded through Codes, in append() order after the times
+    CODED = ('uid', 'account', 'state', 'partition', 'qos', 'nodelist')
+
+    def __init__(self):
+        self.jobids = array.array('l')  # numeric job ids, -1 if the id is not numeric
+        self.other_jobids = {}          # row -> job id, for array/het job ids (1234_5, 1234+0)
+        self.submit = array.array('l')
+        self.start = array.array('l')
+        self.end = array.array('l')
+        self.codes = dict((name, Codes()) for name in self.CODED)
+        self.coded = dict((name, array.array('i')) for name in self.CODED)
+        self.cpus = array.array('i')
+        self.req_nodes = array.array('i')
+        self.alloc_nodes = array.array('i')
+        self.amount = array.array('d')
+
+    def __len__(self):
+        return len(self.jobids)
+
+    def append(self, jobid, submit, start, end, uid, account, state, partition, qos, nodelist,
+               cpus, req_nodes, alloc_nodes, amount):
+        '''add a job, times in epoch seconds; returns its row'''
+        row = len(self.jobids)
+        if jobid.isdigit():
+            self.jobids.append(int(jobid))
+        else:
+            self.jobids.append(-1)
+            self.other_jobids[row] = jobid
+
+        self.submit.append(submit)
+        self.start.append(start)
+        self.end.append(end)
+        for name, value in zip(self.CODED, (uid, account, state, partition, qos, nodelist)):
+            self.coded[name].append(self.codes[name].code(value))
+        self.cpus.append(int(cpus))
+        self.req_nodes.append(int(req_nodes))
+        self.alloc_nodes.append(int(alloc_nodes))
+        self.amount.append(amount)
+        return row
+
+    def extend(self, jobids, submit, start, end, uid, account, state, partition, qos, nodelist,
+               cpus, req_nodes, alloc_nodes, amount):
+        '''append() for whole columns'''
+        row = len(self.jobids)
+        for offset, jobid in enumerate(jobids):
+            if not jobid.isdigit():
+                self.other_jobids[row + offset] = jobid
+        self.jobids.extend([int(jobid) if jobid.isdigit() else -1 for jobid in jobids])
+
+        self.submit.extend(submit)
+        self.start.extend(start)
+        self.end.extend(end)
+        for name, values in zip(self.CODED, (uid, account, state, partition, qos, nodelist)):
+            code = self.codes[name].code
+            self.coded[name].extend([code(value) for value in values])
+        self.cpus.extend(cpus)
+        self.req_nodes.extend(req_nodes)
+        self.alloc_nodes.extend(alloc_nodes)
+        self.amount.extend(amount)
+
+    def extend_sacct(self, out, price_per_hour, select=None):
+        '''parse `sacct -P --format=SACCT_FORMAT` output and append its jobs.
+
+        price_per_hour(partition) is called once per partition. select(jobid, state),
+        if given, picks the rows to keep. Returns [(jobid, reason)] for the rows
+        that could not be parsed.'''
+        if not isinstance(out, str):
+            out = out.decode('utf-8')
+
+        errors = []
+        rows = []
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) == len(SACCT_FIELDS):
+                rows.append(fields)
+            elif line:
+                errors.append((fields[0], 'expected {} fields, got {}'.format(len(SACCT_FIELDS), len(fields))))
+
+        if select is not None:
+            rows = [fields for fields in rows if select(fields[0], fields[6])]
+        if not rows:
+            return errors
+
+        columns = list(zip(*rows))
+        jobids = columns[0]
+        failed = [None] * len(rows)  # the error column, reason per row
+
+        def convert(index, function, name):
+            values = columns[index]
+            try:
+                return list(map(function, values))
+            except ValueError:
+                converted = []
+                for row, value in enumerate(values):
+                    try:
+                        converted.append(function(value))
+                    except ValueError:
+                        converted.append(0)
+                        failed[row] = failed[row] or 'invalid {}: {!r}'.format(name, value)
+                return converted
+
+        submit = convert(1, timeconv.sacct_timestamp, 'Submit')
+        start = convert(2, timeconv.sacct_timestamp, 'Start')
+        end = convert(3, timeconv.sacct_timestamp, 'End')
+        cpus = convert(10, int, 'AllocCPUS')
+        req_nodes = convert(11, int, 'ReqNodes')
+        alloc_nodes = convert(12, int, 'AllocNodes')
+
+        partitions = columns[7]
+        prices = dict((partition, price_per_hour(partition)) for partition in set(partitions))
+        if numpy is not None:
+            hours = (numpy.array(end, dtype=numpy.int64) - numpy.array(start, dtype=numpy.int64)) / 3600.0
+            price = numpy.array([prices[partition] for partition in partitions], dtype=numpy.float64)
+            amount = price * numpy.array(cpus, dtype=numpy.int64) * hours
+            # python's round(), numpy.round() rounds halves to even
+            amount = [round(value, 2) for value in amount.tolist()]
+        else:
+            amount = [round(prices[partition] * count * ((stop - begin) / 3600.0), 2)
+                      for partition, count, begin, stop in zip(partitions, cpus, start, end)]
+
+        keep = [row for row in range(len(rows)) if failed[row] is None]
+        errors.extend((jobids[row], failed[row]) for row in range(len(rows)) if failed[row] is not None)
+
+        def pick(values):
+            return [values[row] for row in keep] if len(keep) < len(rows) else list(values)
+
+        self.extend(pick(jobids), pick(submit), pick(start), pick(end), pick(columns[4]), pick(columns[5]),
+                    pick(columns[6]), pick(partitions), pick(columns[8]), pick(columns[9]),
+                    pick(cpus), pick(req_nodes), pick(alloc_nodes), pick(amount))
+        return errors
+
+    def jobid(self, row):
+        jobid = self.jobids[row]
+        return str(jobid) if jobid >= 0 else self.other_jobids[row]
+
+    def value(self, name, row):
+        '''decoded value of a coded column'''
+        return self.codes[name].values[self.coded[name][row]]
+
+    def raw_time(self, row):
+        '''run time in hours'''
+        return (self.end[row] - self.start[row]) / 3600.0
+
+    def payload(self, row):
+        '''the jobs/<id>/ payload of a row'''
+        raw_time = self.raw_time(row)
+        return {
+            'jobslurmid': self.jobid(row),
+            'submitdate': timeconv.format_timestamp(self.submit[row]),
+            'startdate': timeconv.format_timestamp(self.start[row]),
+            'enddate': timeconv.format_timestamp(self.end[row]),
+            'userid': self.value('uid', row),
+            'accountid': self.value('account', row),
+            'amount': str(self.amount[row]),
+            'jobstatus': self.value('state', row),
+            'partition': self.value('partition', row),
+            'qos': self.value('qos', row),
+            'nodes': [{'name': name} for name in expand_node_list(self.value('nodelist', row))],
+            'num_cpus': self.cpus[row],
+            'num_req_nodes': self.req_nodes[row],
+            'num_alloc_nodes': self.alloc_nodes[row],
+            'raw_time': raw_time,
+            'cpu_time': raw_time * self.cpus[row]}
+
+    def payloads(self):
+        '''(job id, payload) for every row'''
+        for row in range(len(self.jobids)):
+            yield self.jobid(row), self.payload(row)
@@ -0,0 +1,238 @@
+'''
+Compressed, incrementally decoded pages of the API's list endpoints.
+
+json.loads(urlopen(request).read()) holds the raw bytes, the decoded text and
+the parsed page in memory at once, and a large jobs/ page is all of that
+several times over. A Page reads the response as it arrives, gunzips it on
+the fly when the API compressed it, and decodes the `results` array one
+result at a time:
+
+    request.add_header('Accept-Encoding', jsonstream.ACCEPT_ENCODING)
+    response = urlopen(request)
+    page = jsonstream.Page(jsonstream.chunks(response), response.info().get('Content-Encoding'))
+    for job in page.iter_results():  # each job is yielded as soon as it is parsed
+        ...
+    page['next']                     # the rest of the page, read once the results are
+
+A Page is read only once. Indexing it like the decoded dict works too, also
+after part of the results have been iterated: page['results'] then decodes
+the results that haven't been iterated into a list, page['next'] skips them.
+pagination.paginate() iterates the results of pages it gets. A body that ends
+before the page does raises IncompletePage, an IOError like the connection
+errors that usually cause it, so it is retried like them.
+
+gunzip() decompresses whole bodies, for responses that aren't pages.
+'''
+import json
+import zlib
+import codecs
+
+ACCEPT_ENCODING = 'gzip'
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+DELIMITERS = ',]}' + WHITESPACE
+NUMBER_START = '-0123456789'
+
+
+class IncompletePage(IOError):
+    '''the body ended before the page did'''
+
+
+def chunks(response, size=CHUNK_SIZE):
+    '''the body of a file-like response, in chunks'''
+    while True:
+        chunk = response.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def decompressed(chunks, encoding=None):
+    '''the chunks of a body, gunzipped as they come if encoding is gzip'''
+    if (encoding or '').lower() not in ('gzip', 'x-gzip'):
+        for chunk in chunks:
+            yield chunk
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip header and trailer
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def gunzip(body, encoding=None):
+    '''a whole body, decompressed if encoding is gzip'''
+    return b''.join(decompressed([body], encoding))
+
+
+class Page(object):
+    def __init__(self, chunks, encoding=None, on_close=None):
+        '''chunks of the (possibly gzipped) body of a page. on_close(error) is called once it has been read,
+        with the exception that stopped it, if one did'''
+        self.chunks = decompressed(chunks, encoding)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.on_close = on_close
+        self.text = u''
+        self.position = 0
+        self.eof = False
+        self.fields = {}      # the members of the page other than results, as they are read
+        self.state = 'start'  # start, results, fields, done
+        self.first = True     # the next result is the first of the array, no ',' before it
+
+    # reading
+
+    def _more(self):
+        '''read the next chunk into the text, False at the end of the body'''
+        if self.eof:
+            return False
+        if self.position:
+            self.text = self.text[self.position:]
+            self.position = 0
+
+        for chunk in self.chunks:
+            text = self.decoder.decode(chunk)
+            if text:
+                self.text += text
+                return True
+
+        self.text += self.decoder.decode(b'', True)
+        self.eof = True
+        return False
+
+    def _char(self):
+        '''the next character that isn't whitespace, without consuming it. '' at the end of the body'''
+        while True:
+            while self.position < len(self.text) and self.text[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self._more():
+                return ''
+
+    def _expect(self, characters):
+        char = self._char()
+        if not char:
+            raise IncompletePage('the page ended where {!r} was expected'.format(characters))
+        if char not in characters:
+            raise ValueError('expected {!r} in the page, got {!r}'.format(characters, char))
+        self.position += 1
+        return char
+
+    def _value(self):
+        '''decode the next value. A number may go on past what has been read (12 of 12.5, 1 of 1e3), so it
+        is only taken once a delimiter follows it, or there is nothing more to read'''
+        number = self._char() in NUMBER_START
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.text, self.position)
+                if self.eof or (end < len(self.text) and (not number or self.text[end] in DELIMITERS)):
+                    self.position = end
+                    return value
+            except ValueError as e:
+                if self.eof:
+                    raise IncompletePage('the page ended in the middle of a value: {}'.format(e))
+            self._more()
+
+    def _close(self, error=None):
+        self.state = 'done'
+        self.text = u''
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close(error)
+
+    def _read_fields(self):
+        '''read members up to the results array (left open) or the end of the page'''
+        if self.state == 'start':
+            self._expect('{')
+            if self._char() == '}':
+                self.position += 1
+                return self._close()
+            self.state = 'fields'
+        elif self._expect(',}') == '}':
+            return self._close()
+
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'results' and self._char() == '[':
+                self.position += 1
+                self.state = 'results'
+                self.first = True
+                return
+            self.fields[key] = self._value()
+            if self._expect(',}') == '}':
+                return self._close()
+
+    def _next_result(self):
+        '''the next result of the open results array, or raise StopIteration at its end'''
+        char = self._char()
+        if char == ']':
+            self.position += 1
+            self.state = 'fields'
+            raise StopIteration
+        if not self.first:
+            self._expect(',')
+        result = self._value()
+        self.first = False
+        return result
+
+    # the page
+
+    def iter_results(self):
+        '''yield the results as they are decoded, then read the rest of the page'''
+        try:
+            if self.state == 'start':
+                self._read_fields()
+            if self.state == 'results':  # from the start of the array, or where an earlier iteration stopped
+                while True:
+                    try:
+                        result = self._next_result()
+                    except StopIteration:
+                        break
+                    yield result
+                self.fields.setdefault('results', None)
+            self.finish()
+        except Exception as e:
+            if self.state != 'done':
+                self._close(e)
+            raise
+
+    def finish(self):
+        '''read the rest of the page, skipping results that weren't iterated'''
+        try:
+            while self.state != 'done':
+                if self.state == 'results':
+                    for _ in self.iter_results():
+                        pass
+                else:
+                    self._read_fields()
+        except Exception as e:
+            if self.state != 'done':
+                self._close(e)
+            raise
+
+    def close(self):
+        '''drop the rest of the page, without reading it'''
+        if self.state != 'done':
+            self.chunks.close()
+            self._close()
+
+    def __getitem__(self, key):
+        if key == 'results' and self.state == 'start':
+            self._read_fields()
+        if key == 'results' and self.state == 'results':
+            self.fields['results'] = list(self.iter_results())
+        self.finish()
+        return self.fields[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
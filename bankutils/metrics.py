@@ -0,0 +1,309 @@
+'''
+Per-phase run metrics for the sync scripts.
+
+A run is split into phases that are started one after another (starting a
+phase ends the previous one). Each phase collects wall time, item counts,
+bytes transferred and error counts.
+
+The scripts send their API requests through RunMetrics.urlopen() (or
+urlopen_page(), which returns the large pages of jobs/ as a streamed
+jsonstream.Page). These go through a transport.Transport, which traces them,
+waits for the rate limit, makes GETs of the endpoints that rarely change
+conditional and decompresses responses. Each request is recorded in a
+latency histogram per endpoint, with its status (a 304 answered from the
+cache is recorded as such) and the bytes transferred. Requests retried by
+pagination.Retry(on_retry=RunMetrics.add_retry) are counted per endpoint,
+and the time spent waiting for the rate limit is in the run summary
+(`throttled_seconds`).
+
+At exit the run is written as a Prometheus textfile-collector file
+(<name>.prom) and a json run summary (<name>_summary.json).
+'''
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+try:
+    from urllib2 import urlopen as _urlopen
+    from urlparse import urlparse
+except ImportError:
+    from urllib.request import urlopen as _urlopen
+    from urllib.parse import urlparse
+
+from bankutils import transport
+
+
+METRIC_PREFIX = 'slurm_banking_sync'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def endpoint_name(url):
+    '''api url -> endpoint label, eg. https://host/api/allocations/12/attributes/?type=x -> allocations/attributes'''
+    parts = [part for part in urlparse(url).path.split('/') if part]
+    if 'api' in parts:
+        parts = parts[parts.index('api') + 1:]
+    return '/'.join(part for part in parts if not part.isdigit()) or '/'
+
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.finished = None
+        self.items = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def wall(self):
+        return (self.finished or time.time()) - self.started
+
+    def summary(self):
+        return {'wall_seconds': round(self.wall(), 6), 'items': self.items,
+                'bytes': self.bytes, 'errors': self.errors}
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def summary(self):
+        return {'count': self.count, 'sum': round(self.total, 6),
+                'buckets': dict(('{:g}'.format(bound), count) for bound, count in zip(self.buckets, self.counts))}
+
+
+class RunMetrics(object):
+    def __init__(self, script, labels=None, tracer=None, limiter=None, cache=None):
+        self.script = script
+        self.transport = transport.Transport(tracer, limiter, cache, observe=self.observe_url)
+        self.tracer = self.transport.tracer
+        self.limiter = self.transport.limiter
+        self.labels = dict(labels or {})
+        self.started = time.time()
+        self.phases = []
+        self.current = None
+        self.latency = {}      # (method, endpoint) -> Histogram
+        self.http_status = {}  # (method, endpoint, status) -> count
+        self.http_bytes = {}   # (method, endpoint) -> bytes sent + received
+        self.http_retries = {}  # endpoint -> [retries, requests that needed a retry]
+        self.failed = False
+        self.lock = threading.Lock()  # requests may be made from worker threads
+
+    # phases
+
+    def start_phase(self, name):
+        self.end_phase()
+        self.current = Phase(name)
+        self.phases.append(self.current)
+        return self.current
+
+    def end_phase(self):
+        if self.current is not None:
+            self.current.finished = time.time()
+        self.current = None
+
+    def add_items(self, count=1):
+        if self.current is not None:
+            self.current.items += count
+
+    def add_bytes(self, count):
+        if self.current is not None:
+            self.current.bytes += count
+
+    def add_error(self, count=1):
+        if self.current is not None:
+            self.current.errors += count
+
+    def fail(self):
+        '''mark the run failed, for runs that stop with exit(1): SystemExit doesn't reach sys.excepthook'''
+        self.failed = True
+
+    # http
+
+    def observe_request(self, method, endpoint, seconds, sent, received, status):
+        key = (method, endpoint)
+        status_key = (method, endpoint, str(status))
+        with self.lock:
+            self.latency.setdefault(key, Histogram()).observe(seconds)
+            self.http_bytes[key] = self.http_bytes.get(key, 0) + sent + received
+            self.http_status[status_key] = self.http_status.get(status_key, 0) + 1
+
+            self.add_bytes(sent + received)
+            if not isinstance(status, int) or status >= 400:
+                self.add_error()
+
+    def observe_url(self, method, url, seconds, sent, received, status):
+        self.observe_request(method, endpoint_name(url), seconds, sent, received, status)
+
+    def add_retry(self, url, attempt, error=None):
+        '''a request to url failed and is retried, attempt is 1 for its first retry'''
+        endpoint = endpoint_name(url)
+        with self.lock:
+            counts = self.http_retries.setdefault(endpoint, [0, 0])
+            counts[0] += 1
+            if attempt == 1:
+                counts[1] += 1
+        self.tracer.add_retry(url, attempt, error)
+
+    @staticmethod
+    def _sender(request, timeout):
+        '''send(headers, span) of a transport.Transport, with urllib2: raises HTTPError for anything but a 2xx'''
+        def send(headers, span):
+            for name, value in headers.items():
+                request.add_header(name, value)
+            return _urlopen(request, timeout=timeout) if timeout else _urlopen(request)
+
+        return send
+
+    def urlopen(self, request, timeout=None):
+        '''urlopen(request).read(), recorded'''
+        _, body = self.transport.request(request.get_method(), request.get_full_url(), dict(request.header_items()),
+                                         request.data, self._sender(request, timeout))
+        return body
+
+    def urlopen_page(self, request, timeout=None):
+        '''jsonstream.Page of the response to request, recorded once it has been read'''
+        _, page = self.transport.stream(request.get_method(), request.get_full_url(), dict(request.header_items()),
+                                        request.data, self._sender(request, timeout))
+        return page
+
+    # output
+
+    def summary(self):
+        self.end_phase()
+        phases = {}
+        for phase in self.phases:
+            if phase.name in phases:  # repeated phase, accumulate
+                merged = phases[phase.name]
+                for key, value in phase.summary().items():
+                    merged[key] += value
+            else:
+                phases[phase.name] = phase.summary()
+
+        order = []
+        for phase in self.phases:
+            if phase.name not in order:
+                order.append(phase.name)
+
+        http = {}
+        for (method, endpoint), histogram in self.latency.items():
+            entry = histogram.summary()
+            entry['bytes'] = self.http_bytes.get((method, endpoint), 0)
+            entry['status'] = dict((status, count) for (m, e, status), count in self.http_status.items()
+                                   if (m, e) == (method, endpoint))
+            http['{} {}'.format(method, endpoint)] = entry
+
+        retries = dict((endpoint, {'retries': counts[0], 'retried_requests': counts[1]})
+                       for endpoint, counts in self.http_retries.items())
+
+        return {'script': self.script, 'labels': self.labels,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall_seconds': round(time.time() - self.started, 6), 'failed': self.failed,
+                'phases': phases, 'phase_order': order, 'http': http, 'retries': retries,
+                'throttled_seconds': round(self.limiter.throttled, 6)}
+
+    def prometheus(self):
+        summary = self.summary()
+        base = dict(self.labels, script=self.script)
+
+        def fmt(name, value, **labels):
+            merged = dict(base, **labels)
+            rendered = ','.join('{}="{}"'.format(key, str(merged[key]).replace('"', '\\"')) for key in sorted(merged))
+            return '{}_{}{{{}}} {}'.format(METRIC_PREFIX, name, rendered, value)
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(METRIC_PREFIX, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(METRIC_PREFIX, name, kind))
+            lines.extend(samples)
+
+        metric('run_duration_seconds', 'gauge', 'wall time of the last run',
+               [fmt('run_duration_seconds', summary['wall_seconds'])])
+        metric('run_timestamp_seconds', 'gauge', 'start time of the last run',
+               [fmt('run_timestamp_seconds', int(self.started))])
+        metric('run_failed', 'gauge', '1 if the last run failed (died with an exception, or stopped by fail())',
+               [fmt('run_failed', int(self.failed))])
+
+        phases = summary['phases']
+        for key, name, help_text in [('wall_seconds', 'phase_duration_seconds', 'wall time per phase'),
+                                     ('items', 'phase_items', 'items processed per phase'),
+                                     ('bytes', 'phase_bytes', 'bytes transferred per phase'),
+                                     ('errors', 'phase_errors', 'errors per phase')]:
+            metric(name, 'gauge', help_text,
+                   [fmt(name, phases[phase][key], phase=phase) for phase in sorted(phases)])
+
+        samples = []
+        for (method, endpoint) in sorted(self.latency):
+            histogram = self.latency[(method, endpoint)]
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                samples.append(fmt('http_request_duration_seconds_bucket', count,
+                                   method=method, endpoint=endpoint, le='{:g}'.format(bound)))
+            samples.append(fmt('http_request_duration_seconds_bucket', histogram.count,
+                               method=method, endpoint=endpoint, le='+Inf'))
+            samples.append(fmt('http_request_duration_seconds_sum', round(histogram.total, 6),
+                               method=method, endpoint=endpoint))
+            samples.append(fmt('http_request_duration_seconds_count', histogram.count,
+                               method=method, endpoint=endpoint))
+        metric('http_request_duration_seconds', 'histogram', 'API request latency', samples)
+
+        metric('http_bytes', 'gauge', 'bytes sent and received per endpoint',
+               [fmt('http_bytes', count, method=method, endpoint=endpoint)
+                for (method, endpoint), count in sorted(self.http_bytes.items())])
+        metric('http_responses', 'gauge', 'responses per endpoint and status',
+               [fmt('http_responses', count, method=method, endpoint=endpoint, status=status)
+                for (method, endpoint, status), count in sorted(self.http_status.items())])
+        metric('http_retries', 'gauge', 'retried requests per endpoint',
+               [fmt('http_retries', counts[0], endpoint=endpoint)
+                for endpoint, counts in sorted(self.http_retries.items())])
+        metric('http_retried_requests', 'gauge', 'requests (eg. pages) that needed at least one retry, per endpoint',
+               [fmt('http_retried_requests', counts[1], endpoint=endpoint)
+                for endpoint, counts in sorted(self.http_retries.items())])
+        metric('http_throttled_seconds', 'gauge', 'time requests waited for the API rate limit',
+               [fmt('http_throttled_seconds', summary['throttled_seconds'])])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory, name):
+        '''write <directory>/<name>.prom and <directory>/<name>_summary.json'''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # the textfile collector may read at any time, so write + rename
+        outputs = [(os.path.join(directory, name + '.prom'), self.prometheus()),
+                   (os.path.join(directory, name + '_summary.json'),
+                    json.dumps(self.summary(), indent=2, sort_keys=True) + '\n')]
+        for path, contents in outputs:
+            temp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temp, 'w') as f:
+                f.write(contents)
+            os.rename(temp, path)
+
+    def install(self, directory, name):
+        '''write the metrics at exit, and mark the run failed on an uncaught exception (see fail())'''
+        previous_hook = sys.excepthook
+
+        def excepthook(kind, value, traceback):
+            self.failed = True
+            previous_hook(kind, value, traceback)
+
+        def write():
+            try:
+                self.write(directory, name)
+            except (IOError, OSError) as e:
+                sys.stderr.write('could not write metrics to {}: {}\n'.format(directory, e))
+
+        sys.excepthook = excepthook
+        atexit.register(write)
@@ -0,0 +1,242 @@
+'''
+Lazy pagination of the API's list endpoints.
+
+The list endpoints (projects/, allocations/, jobs/, ...) are paginated DRF
+style: {'count': .., 'next': .., 'previous': .., 'results': [..]}. paginate()
+yields the results one page at a time instead of collecting every page into a
+list first, so a caller that streams through them holds one page in memory,
+however long the listing is, and a caller that only needs the first result
+only requests the first page.
+
+The scripts pass in their own fetch function, so requests keep going through
+their auth header and metrics:
+
+    def fetch(request_url):
+        request = urllib2.Request(request_url)
+        request.add_header('Authorization', AUTH_TOKEN)
+        return json.loads(METRICS.urlopen(request))
+
+    for project in pagination.paginate(fetch, BASE_URL + 'projects/'):
+        ...
+
+Deep job listings can be walked with a keyset cursor instead of page numbers,
+see paginate_keyset().
+
+Page fetches that fail with a transient error (connection errors, timeouts,
+429 and 5xx responses) are retried with jittered exponential backoff when a
+Retry is passed in. A page that still fails raises PageError, after the
+results of the pages before it have been yielded, instead of ending the
+listing early as if it were complete. PageError.params continue the listing
+at the page that failed:
+
+    try:
+        for job in pagination.paginate(fetch, url, params, RETRY):
+            ...
+    except pagination.PageError as e:
+        resume = e.params  # pagination.paginate(fetch, e.url, e.params, RETRY) picks up from here
+
+fetch may also return a streamed page (jsonstream.Page, eg. from
+RunMetrics.urlopen_page), its results are then yielded as they are decoded.
+A streamed page that fails part way through is fetched again like a page
+that failed outright, and the results already yielded are skipped. If it
+still fails, PageError comes after the results it did yield, and its params
+read the page again from the start.
+'''
+import time
+import random
+import threading
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+
+
+def page_url(url, params):
+    return url + '?' + urlencode(params) if params else url
+
+
+class PageError(Exception):
+    '''a page could not be fetched. url and params (with its page or cursor) continue the listing'''
+
+    def __init__(self, url, params, cause):
+        Exception.__init__(self, '{} failed: {}'.format(page_url(url, params), cause))
+        self.url = url
+        self.params = params
+        self.cause = cause
+
+
+def is_transient(error):
+    '''whether a failed request is worth retrying'''
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):  # HTTPError
+        return code in TRANSIENT_STATUS
+    # URLError, socket errors and timeouts are EnvironmentErrors, truncated responses HTTPExceptions
+    if isinstance(error, EnvironmentError):
+        return True
+
+    try:  # only imported on errors, check_usage through the login node daemon doesn't need httplib otherwise
+        from httplib import HTTPException
+    except ImportError:
+        from http.client import HTTPException
+    return isinstance(error, HTTPException)
+
+
+class Retry(object):
+    '''retries failed requests with jittered exponential backoff, and counts them.
+
+    attempts is the number of tries per request, the n-th retry sleeps a random
+    0..min(max_backoff, backoff * 2 ** n) seconds (full jitter), so clients
+    that failed together don't retry together. on_retry(request url, attempt,
+    error) is called before every retry, eg. RunMetrics.add_retry.'''
+
+    def __init__(self, attempts=4, backoff=0.5, max_backoff=30.0, on_retry=None):
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_retry = on_retry
+        self.retries = 0
+        self.retried_pages = 0
+        self.lock = threading.Lock()  # pages may be fetched from worker threads
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def call(self, fetch, request_url):
+        '''fetch(request_url), retrying transient errors. The last error is raised'''
+        attempt = 0
+        while True:
+            try:
+                return fetch(request_url)
+            except Exception as e:
+                attempt += 1
+                if attempt >= self.attempts or not is_transient(e):
+                    raise
+                self.wait(request_url, attempt, e)
+
+    def wait(self, request_url, attempt, error):
+        '''count the retry of a failed request, and sleep before it'''
+        with self.lock:
+            self.retries += 1
+            if attempt == 1:
+                self.retried_pages += 1
+        if self.on_retry is not None:
+            self.on_retry(request_url, attempt, error)
+        time.sleep(self.delay(attempt))
+
+
+def _fetch_page(fetch, url, params, retry):
+    try:
+        if retry is not None:
+            return retry.call(fetch, page_url(url, params))
+        return fetch(page_url(url, params))
+    except Exception as e:
+        raise PageError(url, dict(params), e)
+
+
+class _PageResults(object):
+    '''the results of a page, iterated once. response is the page, count and last the results yielded'''
+
+    def __init__(self, fetch, url, params, retry):
+        self.fetch = fetch
+        self.url = url
+        self.params = dict(params)
+        self.retry = retry
+        self.response = _fetch_page(fetch, url, params, retry)
+        self.count = 0
+        self.last = None
+
+    def __iter__(self):
+        if not hasattr(self.response, 'iter_results'):
+            for result in self.response['results'] or []:
+                self.count += 1
+                self.last = result
+                yield result
+            return
+
+        attempt = 0
+        while True:
+            results = self.response.iter_results()
+            skip = self.count  # yielded before the page was fetched again
+            try:
+                while True:
+                    try:
+                        result = next(results)
+                    except StopIteration:
+                        return
+                    except Exception as e:
+                        attempt += 1
+                        if self.retry is None or attempt >= self.retry.attempts or not is_transient(e):
+                            raise PageError(self.url, dict(self.params), e)
+                        self.retry.wait(page_url(self.url, self.params), attempt, e)
+                        break
+
+                    if skip:
+                        skip -= 1
+                        continue
+                    self.count += 1
+                    self.last = result
+                    yield result
+            finally:
+                self.response.close()  # the rest of a page that isn't read (or failed) is dropped
+            self.response = _fetch_page(self.fetch, self.url, self.params, self.retry)
+
+
+def paginate(fetch, url, params=None, retry=None):
+    '''yield every result of a paginated endpoint, fetch(request url) -> decoded response.
+
+    A page that can't be fetched (after retrying, with a Retry) raises
+    PageError, after the results of the pages before have been yielded.'''
+    params = dict(params or {})
+    page = int(params.get('page', 1))
+    while True:
+        results = _PageResults(fetch, url, params, retry)
+        for result in results:
+            yield result
+
+        if results.response.get('next') is None:
+            return
+
+        page += 1
+        params['page'] = page
+
+
+# keyset pagination of jobs/: ?ordering=startdate,jobslurmid&after=<startdate>,<jobslurmid>
+# returns the jobs ordered by these fields that come after the given key
+KEYSET_ORDERING = ('startdate', 'jobslurmid')
+
+
+def keyset_cursor(result):
+    '''the after= value that continues a keyset listing after this result'''
+    return ','.join(str(result.get(field) or '') for field in KEYSET_ORDERING)
+
+
+def paginate_keyset(fetch, url, params=None, retry=None):
+    '''yield every result of a keyset paginated endpoint (jobs/), fetch(request url) -> decoded response.
+
+    Every page asks for the results after the key of the last result seen, so
+    the server seeks to it instead of skipping page * page_size rows, and rows
+    added or changed while paging don't shift the later pages. A server that
+    ignores the cursor would return the same page forever, this raises
+    ValueError instead. Failed pages raise PageError, like paginate().'''
+    params = dict(params or {})
+    params['ordering'] = ','.join(KEYSET_ORDERING)
+    params.pop('page', None)
+    if params.get('fields'):  # the cursor needs the key fields of the last result
+        fields = params['fields'].split(',')
+        params['fields'] = ','.join(fields + [field for field in KEYSET_ORDERING if field not in fields])
+
+    while True:
+        results = _PageResults(fetch, url, params, retry)
+        for result in results:
+            yield result
+
+        if results.response.get('next') is None or not results.count:
+            return
+
+        cursor = keyset_cursor(results.last)
+        if cursor == params.get('after'):
+            raise ValueError('{} ignored the keyset cursor after={}'.format(url, cursor))
+        params['after'] = cursor
@@ -0,0 +1,301 @@
+'''
+Token bucket rate limit on API requests, shared by the processes of a host.
+
+The sync scripts, the jobcomp cron, the check_usage daemon and check_usage
+runs without it all send their requests to the same API. RateLimiter keeps a
+token bucket in a small state file, locked with flock(), so every process on
+the host that uses the same file draws from the same bucket:
+
+    LIMITER = ratelimit.RateLimiter.for_api(BASE_URL)
+    with LIMITER.acquire() as ticket:  # waits for a token
+        status, body = send(request)
+        ticket.status = status          # left at None: the request failed
+
+The bucket refills at `rate` requests per second, adjusted from what the
+requests see (AIMD): every fast success adds a little to the rate, a 429, a
+5xx, a failed request or one slower than `slow` seconds halves it, at most
+once per second. What a request saw is applied when the next token is taken,
+so a request locks the file once. Interactive limiters (check_usage) mark the
+bucket when they take tokens. For a while after that, batch limiters (the
+sync scripts) leave the last `reserve` tokens to them.
+
+The state file is $SLURM_BANKING_RATELIMIT, or
+/var/run/slurm_banking/ratelimit_<api host>. SLURM_BANKING_RATELIMIT=off
+turns the limit off. Whoever can write the file can slow down everyone using
+it, so it is only used in a directory that is owned by root (or the process'
+user) and not writable by others, eg. root:slurm_banking with mode 2770 so
+the check_usage daemon's group can use it. Root creates the default directory
+(mode 2770, group root) if it is missing, the file is created with mode 660.
+Processes that can't open the file for writing, eg. the users outside the
+group, use a bucket of their own.
+
+The lock is tried LOCK_TRIES times without blocking, so a process holding it
+can't hang the others. A process that can't take it (or can't read or write
+the file) uses a bucket of its own for the next FALLBACK seconds.
+'''
+import os
+import json
+import stat
+import time
+import errno
+import fcntl
+import threading
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+
+ENVIRONMENT = 'SLURM_BANKING_RATELIMIT'
+STATE_DIR = '/var/run/slurm_banking'
+STATE_DIR_MODE = 0o2770  # group members share the bucket, files they create keep the group
+STATE_MODE = 0o660
+
+RATE = 20.0       # requests per second to start from
+MIN_RATE = 1.0
+MAX_RATE = 100.0
+BURST = 20.0      # tokens the bucket holds
+RESERVE = 10.0    # tokens batch limiters leave to interactive traffic
+SLOW = 5.0        # seconds, a slower response counts as a sign of overload
+INCREASE = 1.0    # requests per second added per `rate` fast successes
+HOLD = 1.0        # seconds between two decreases, so one burst of errors halves the rate once
+INTERACTIVE_WINDOW = 10.0  # seconds batch limiters keep the reserve after interactive traffic
+LOCK_TRIES = 5    # tries to lock the state file without blocking, LOCK_INTERVAL seconds apart
+LOCK_INTERVAL = 0.005
+FALLBACK = 10.0   # seconds a process that couldn't use the state file keeps to its own bucket
+
+
+class Ticket(object):
+    '''permission to send one request. Set status to the response's, the limiter learns from it'''
+
+    def __init__(self, limiter, waited):
+        self.limiter = limiter
+        self.waited = waited
+        self.status = None
+        self.started = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.limiter.observe(self.status, time.time() - self.started)
+
+
+class RateLimiter(object):
+    def __init__(self, path=None, interactive=False, rate=RATE, min_rate=MIN_RATE, max_rate=MAX_RATE,
+                 burst=BURST, reserve=RESERVE, slow=SLOW):
+        '''path of the shared state file. Without one, requests are not limited'''
+        self.path = path
+        self.enabled = path is not None
+        self.interactive = interactive
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.reserve = min(reserve, burst - 1)
+        self.slow = slow
+        self.initial = {'rate': min(max(rate, min_rate), max_rate), 'tokens': burst, 'updated': time.time(),
+                        'interactive': 0, 'hold': 0}
+        self.memory = None   # the process' own bucket
+        self.fd = None       # opened on first use
+        self.opened = False
+        self.own_until = 0   # the state file isn't tried again before then
+        self.observed = []   # whether each request since the last update saw overload
+        self.lock = threading.Lock()  # flock() doesn't keep threads sharing the descriptor apart
+        self.throttled = 0.0
+
+    @classmethod
+    def for_api(cls, base_url, interactive=False):
+        '''limiter of the requests to the API at base_url, see the module docstring for the state file'''
+        path = os.environ.get(ENVIRONMENT)
+        if path == 'off':
+            return cls(None)
+        if not path:
+            host = urlparse(base_url).netloc.replace(':', '_') or 'api'
+            path = os.path.join(STATE_DIR, 'ratelimit_{}'.format(host))
+        return cls(path, interactive=interactive)
+
+    # shared state
+
+    def _directory(self):
+        '''whether the state file's directory can be trusted: a directory (not a symlink) owned by root or this
+        process' user, that others can't write to. Root creates the default one'''
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if os.geteuid() == 0 and directory == STATE_DIR:
+            try:
+                os.mkdir(directory, 0o700)
+                os.chmod(directory, STATE_DIR_MODE)  # whatever the umask
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    return False
+        try:
+            info = os.lstat(directory)
+        except OSError:
+            return False
+        return stat.S_ISDIR(info.st_mode) and info.st_uid in (0, os.geteuid()) and not info.st_mode & stat.S_IWOTH
+
+    def _open(self):
+        '''the state file's descriptor, None if it can't be used. Only a regular file that others can't write
+        to is used, in a trusted directory, not through a symlink or a hard link (opening a fifo would block)'''
+        if not self._directory():
+            return None
+
+        flags = os.O_RDWR | os.O_NOFOLLOW | os.O_NONBLOCK
+        try:
+            fd = os.open(self.path, flags | os.O_CREAT, STATE_MODE)
+        except OSError:
+            return None
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode) or info.st_mode & stat.S_IWOTH or info.st_nlink != 1:
+            os.close(fd)
+            return None
+        if info.st_size == 0 and info.st_uid == os.geteuid():
+            os.fchmod(fd, STATE_MODE)  # created now: whatever the umask
+        return fd
+
+    def _lock(self):
+        '''lock the state file, without waiting for long on whoever holds it. Whether it is locked'''
+        for attempt in range(LOCK_TRIES):
+            if attempt:
+                time.sleep(LOCK_INTERVAL)
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    return False
+        return False
+
+    def _update(self, change):
+        '''change(state, now) under the lock, written back for the other processes. Returns what change returns.
+        Made to the process' own bucket when the file can't be used'''
+        with self.lock:
+            if not self.opened:
+                self.opened = True
+                self.fd = self._open()
+
+            now = time.time()
+            if self.fd is not None and now >= self.own_until:
+                if self._lock():
+                    try:
+                        state = self._read(now)
+                        result = change(state, now)
+                        data = json.dumps(state).encode('utf-8')
+                        os.lseek(self.fd, 0, os.SEEK_SET)
+                        os.write(self.fd, data)
+                        os.ftruncate(self.fd, len(data))
+                        self.memory = state  # to go on from, if the file can't be used next time
+                        return result
+                    except (IOError, OSError):
+                        pass
+                    finally:
+                        fcntl.flock(self.fd, fcntl.LOCK_UN)
+                self.own_until = now + FALLBACK
+
+            if self.memory is None:
+                self.memory = dict(self.initial, updated=now)
+            return change(self.memory, now)
+
+    def _read(self, now):
+        '''the state in the file, within bounds: any user can write it'''
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        try:
+            state = json.loads(os.read(self.fd, 4096).decode('utf-8'))
+            state = dict((key, float(state[key])) for key in self.initial)
+            if any(value != value for value in state.values()):  # NaN
+                raise ValueError(state)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            state = dict(self.initial, updated=now)
+
+        state['rate'] = min(max(state['rate'], self.min_rate), self.max_rate)
+        state['tokens'] = min(max(state['tokens'], 0.0), self.burst)
+        state['updated'] = min(state['updated'], now)
+        state['interactive'] = min(state['interactive'], now)
+        state['hold'] = min(state['hold'], now + HOLD)
+        return state
+
+    # requests
+
+    def _adjust(self, state, now):
+        '''AIMD, for the requests observed since the last update (called with self.lock held)'''
+        observed, self.observed = self.observed, []
+        for overloaded in observed:
+            if overloaded:
+                if now >= state['hold']:
+                    state['rate'] = max(self.min_rate, state['rate'] / 2)
+                    state['hold'] = now + HOLD
+            else:
+                state['rate'] = min(self.max_rate, state['rate'] + INCREASE / state['rate'])
+
+    def _take(self, state, now):
+        '''take a token, or return the seconds until there will be one for this limiter'''
+        self._adjust(state, now)
+        state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * state['rate'])
+        state['updated'] = now
+        if self.interactive:
+            state['interactive'] = now
+
+        floor = 1.0
+        if not self.interactive and now - state['interactive'] < INTERACTIVE_WINDOW:
+            floor += self.reserve  # yield to check_usage
+
+        if state['tokens'] >= floor:
+            state['tokens'] -= 1
+            return 0
+        return (floor - state['tokens']) / state['rate']
+
+    def acquire(self):
+        '''wait for a token, the Ticket is a context manager around the request'''
+        if not self.enabled:
+            return Ticket(self, 0)
+
+        waited = 0.0
+        while True:
+            wait = self._update(self._take)
+            if not wait:
+                break
+            wait = min(wait, 1.0)  # the rate may change in the meantime
+            time.sleep(wait)
+            waited += wait
+
+        if waited:
+            with self.lock:
+                self.throttled += waited
+        return Ticket(self, waited)
+
+    def observe(self, status, latency):
+        '''AIMD: a fast success adds to the rate, an error (status None, 429, 5xx) or slow response halves it.
+        Applied with the next token taken'''
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.observed.append(status is None or status == 429 or status >= 500 or latency > self.slow)
+
+    def urlopen(self, request, timeout=None):
+        '''urlopen(request).read(), once there is a token. For scripts that use urllib2 without RunMetrics'''
+        try:
+            from urllib2 import urlopen
+        except ImportError:
+            from urllib.request import urlopen
+
+        with self.acquire() as ticket:
+            try:
+                response = urlopen(request, timeout=timeout) if timeout else urlopen(request)
+                body = response.read()
+            except Exception as e:
+                ticket.status = getattr(e, 'code', None)
+                raise
+            ticket.status = response.getcode()
+            return body
+
+    def rate(self):
+        '''the current rate, in requests per second'''
+        if not self.enabled:
+            return None
+
+        def rate(state, now):
+            self._adjust(state, now)
+            return state['rate']
+
+        return self._update(rate)
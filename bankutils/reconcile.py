@@ -0,0 +1,209 @@
+'''
+Per-account, per-day job totals, for finding where slurmdb and the API disagree.
+
+Telling which jobs the API has wrong by comparing every job means fetching and
+re-pushing all of them. Instead the totals of the jobs (count, cpu hours,
+amount) are compared the way a Merkle tree compares hashes: per account over
+the whole window first, then per month for the accounts that differ, then per
+day for the months that differ. The jobs/ endpoint returns the same totals
+(count, total_cpu_time, total_amount) for any account and time range, so every
+comparison is a single cheap request, and only the jobs of the days that still
+differ have to be looked at one by one.
+
+Jobs are bucketed by the utc day they started, which is what the start_time /
+end_time filters of jobs/ select on. Days with jobs that are still running
+can't match (the API only learns their totals when they end), they are
+reported as unsettled instead of mismatched.
+'''
+import calendar
+import time
+
+from bankutils import jobs
+
+
+DAY = 24 * 3600
+
+# job states with End=Unknown in sacct
+ACTIVE_STATES = ('RUNNING', 'SUSPENDED', 'COMPLETING')
+# jobs in these states are left out of the totals, pending jobs haven't started
+SKIPPED_STATES = ACTIVE_STATES + ('PENDING',)
+_ACTIVE_MARKERS = ['|{}|'.format(state) for state in ACTIVE_STATES]
+_ACCOUNT = jobs.SACCT_FIELDS.index('Account')
+_START = jobs.SACCT_FIELDS.index('Start')
+
+# cpu hours are floats on both sides, amounts are rounded to cents per job
+CPU_TIME_TOLERANCE = 0.01
+AMOUNT_TOLERANCE = 0.005
+
+
+class Totals(object):
+    __slots__ = ('count', 'cpu_time', 'amount')
+
+    def __init__(self, count=0, cpu_time=0.0, amount=0.0):
+        self.count = count
+        self.cpu_time = cpu_time
+        self.amount = amount
+
+    @classmethod
+    def from_response(cls, response):
+        '''totals of a jobs/ response'''
+        return cls(int(response.get('count') or 0), float(response.get('total_cpu_time') or 0),
+                   float(response.get('total_amount') or 0))
+
+    def add(self, other):
+        self.count += other.count
+        self.cpu_time += other.cpu_time
+        self.amount += other.amount
+
+    def matches(self, other):
+        slack = max(1, self.count)
+        return self.count == other.count and \
+            abs(self.cpu_time - other.cpu_time) <= CPU_TIME_TOLERANCE * slack and \
+            abs(self.amount - other.amount) <= AMOUNT_TOLERANCE * slack
+
+    def __repr__(self):
+        return '{} jobs, {:.2f} CPUHrs, {:.2f} SUs'.format(self.count, self.cpu_time, self.amount)
+
+
+def day_start(epoch):
+    return int(epoch) // DAY * DAY
+
+
+def split_months(begin, end):
+    '''[begin, end] -> [(begin, end)] at utc month boundaries, ends inclusive'''
+    ranges = []
+    while begin <= end:
+        year, month = time.gmtime(begin)[:2]
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        following = calendar.timegm((year, month, 1, 0, 0, 0))
+        ranges.append((begin, min(end, following - 1)))
+        begin = following
+    return ranges
+
+
+def split_days(begin, end):
+    '''[begin, end] -> [(begin, end)] at utc day boundaries, ends inclusive'''
+    ranges = []
+    while begin <= end:
+        following = day_start(begin) + DAY
+        ranges.append((begin, min(end, following - 1)))
+        begin = following
+    return ranges
+
+
+# levels of the comparison below the whole window, and how a range is split into them
+LEVELS = (('month', split_months), ('day', split_days))
+
+
+class DayTotals(object):
+    '''Totals of the jobs of each account per utc day, for jobs that started in [start, end]'''
+
+    def __init__(self, start, end):
+        self.start = int(start)
+        self.end = int(end)
+        self.days = {}        # account -> {day: Totals}
+        self.active = set()   # (account, day) with jobs that are still running
+
+    def add_table(self, table):
+        '''add the jobs of a bankutils.jobs.JobTable'''
+        accounts = table.codes['account'].values
+        for row in range(len(table)):
+            start = table.start[row]
+            if start < self.start or start > self.end:
+                continue
+
+            account = accounts[table.coded['account'][row]]
+            days = self.days.get(account)
+            if days is None:
+                days = self.days[account] = {}
+            day = start // DAY * DAY
+            totals = days.get(day)
+            if totals is None:
+                totals = days[day] = Totals()
+            totals.count += 1
+            totals.cpu_time += table.raw_time(row) * table.cpus[row]
+            totals.amount += table.amount[row]
+
+    def add_sacct(self, out, price_per_hour):
+        '''parse a block of `sacct -P --format=bankutils.jobs.SACCT_FORMAT` output (times as
+        epoch seconds, see timeconv.sacct_env()), returns [(jobid, reason)] for bad rows'''
+        if not isinstance(out, str):
+            out = out.decode('utf-8')
+
+        for line in out.splitlines():
+            for marker in _ACTIVE_MARKERS:
+                if marker in line:
+                    fields = line.split('|')
+                    if len(fields) == len(jobs.SACCT_FIELDS) and fields[_START].isdigit():
+                        start = int(fields[_START])
+                        if self.start <= start <= self.end:
+                            self.active.add((fields[_ACCOUNT], day_start(start)))
+                    break
+
+        table = jobs.JobTable()
+        errors = table.extend_sacct(out, price_per_hour, select=lambda jobid, state: state not in SKIPPED_STATES)
+        self.add_table(table)
+        return errors
+
+    def accounts(self):
+        return set(self.days)
+
+    def total(self, account, begin, end):
+        '''Totals of the jobs of account that started in [begin, end]'''
+        totals = Totals()
+        first = day_start(begin)  # begin is not on a day boundary at the start of the window
+        for day, day_totals in self.days.get(account, {}).items():
+            if first <= day <= end:
+                totals.add(day_totals)
+        return totals
+
+    def is_active(self, account, begin, end):
+        return any((account, day) in self.active for day in range(day_start(begin), end + 1, DAY))
+
+
+def compare(day_totals, accounts, fetch, map_function=map):
+    '''compare day_totals with the API top-down, fetch(account, begin, end) -> Totals from
+    the API (None if the request failed), map_function to run the fetches (eg. a thread
+    pool's map).
+
+    Returns (mismatched, unsettled, stats): the (account, day) buckets that differ, the
+    ones that differ but have running jobs, and {level: number of requests}.'''
+    stats = {'account': 0, 'failed': 0}
+    mismatched, unsettled = [], []
+
+    def fetch_all(nodes, level):
+        stats[level] = stats.get(level, 0) + len(nodes)
+        return map_function(lambda node: fetch(*node), nodes)
+
+    # (account, begin, end) nodes to request at the next level, or known to differ already
+    nodes = [(account, day_totals.start, day_totals.end) for account in sorted(accounts)]
+    differ = []
+    for node, remote in zip(nodes, fetch_all(nodes, 'account')):
+        if remote is None:
+            stats['failed'] += 1
+        elif not day_totals.total(*node).matches(remote):
+            differ.append(node)
+
+    for level, split in LEVELS:
+        nodes, known = [], []
+        for account, begin, end in differ:
+            ranges = split(begin, end)
+            if ranges == [(begin, end)]:
+                known.append((account, begin, end))  # same range as its parent, which differs
+            else:
+                nodes.extend((account, child_begin, child_end) for child_begin, child_end in ranges)
+
+        differ = known
+        for node, remote in zip(nodes, fetch_all(nodes, level)):
+            if remote is None:
+                stats['failed'] += 1
+            elif not day_totals.total(*node).matches(remote):
+                differ.append(node)
+
+    for account, begin, end in sorted(differ):
+        if day_totals.is_active(account, begin, end):
+            unsettled.append((account, day_start(begin)))
+        else:
+            mismatched.append((account, day_start(begin)))
+
+    return mismatched, unsettled, stats
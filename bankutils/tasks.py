@@ -0,0 +1,84 @@
+'''
+Small thread pool for the concurrent requests of usage queries.
+
+multiprocessing.pool.ThreadPool imports most of multiprocessing (subprocess,
+pickle, ...) and joins its handler threads at exit, which poll every 0.1s. For
+a check_usage query answered by the login node daemon in a few milliseconds,
+that is most of the run time. TaskPool starts up to `size` threads as tasks
+come in, and close() stops them as soon as they are done:
+
+    pool = tasks.TaskPool(16)
+    result = pool.submit(fetch, url)
+    ...
+    response = result.get()  # waits for fetch(url), or raises what it raised
+    pool.close()
+'''
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class Result(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def get(self):
+        while not self.done.wait(1):  # with a timeout, so ^C isn't held up on python 2
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class TaskPool(object):
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.tasks = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+
+            result, fn, args, kwargs = task
+            try:
+                result.value = fn(*args, **kwargs)
+            except Exception as e:
+                result.error = e
+            result.done.set()
+
+    def submit(self, fn, *args, **kwargs):
+        '''run fn(*args, **kwargs) on the pool, the Result's get() returns what it returns'''
+        with self.lock:
+            if len(self.threads) < self.size:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+        result = Result()
+        self.tasks.put((result, fn, args, kwargs))
+        return result
+
+    def imap(self, fn, items):
+        '''fn(item) of every item, in order. All of them are submitted before this returns'''
+        results = [self.submit(fn, item) for item in items]
+        return (result.get() for result in results)
+
+    def close(self):
+        '''wait for the tasks already submitted, and stop the threads. python 2 daemon threads that are still
+        waiting for tasks when the interpreter shuts down can crash it'''
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.tasks.put(None)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,145 @@
+'''
+Time conversions shared by the scripts.
+
+Times on the command line, in the API and in sacct output are
+'YYYY-MM-DD[THH:MM:SS]' strings, and a full sync converts a few million of
+them. Instead of strptime() (which tries each format through exceptions and
+builds a datetime per call), parse_timestamp() slices the fields out by
+position and caches the epoch of each date, and format_timestamp() caches the
+string of each hour, so a conversion is a handful of int() calls.
+
+sacct can print epoch seconds instead of formatted times (SLURM_TIME_FORMAT),
+run sacct with sacct_env() and read its times with sacct_timestamp() to skip
+parsing altogether. Either way the result is the utc epoch: sacct formats
+times in the local zone, so a formatted time is read as local wall time.
+
+Local time goes through the C library (time.mktime/time.localtime), ie. the
+system tz database, so conversions are right on both sides of a DST change.
+UTC offsets are cached per 15 minutes, the granularity of every tz rule.
+'''
+import os
+import time
+import calendar
+
+
+TIMESTAMP_FORMAT_COMPLETE = '%Y-%m-%dT%H:%M:%S'
+TIMESTAMP_FORMAT_MINIMAL = '%Y-%m-%d'
+
+# sacct prints Submit/Start/End as epoch seconds with this in its environment
+SACCT_TIME_FORMAT = '%s'
+
+_OFFSET_GRANULARITY = 900
+
+_day_epochs = {}      # 'YYYY-MM-DD' -> utc epoch of midnight
+_hour_strings = {}    # hours since epoch -> 'YYYY-MM-DDTHH'
+_MINUTE_SECONDS = [':%02d:%02d' % divmod(second, 60) for second in range(3600)]
+_utc_offsets = {}     # utc epoch // granularity -> local utc offset
+_naive_offsets = {}   # naive local epoch // granularity -> local utc offset
+
+
+def _day_epoch(date):
+    try:
+        return _day_epochs[date]
+    except KeyError:
+        epoch = calendar.timegm(time.strptime(date, TIMESTAMP_FORMAT_MINIMAL))
+        _day_epochs[date] = epoch
+        return epoch
+
+
+def _hour_string(hour):
+    prefix = time.strftime('%Y-%m-%dT%H', time.gmtime(hour * 3600))
+    _hour_strings[hour] = prefix
+    return prefix
+
+
+def _naive_offset(naive):
+    '''utc offset of the local zone at the local wall time naive (as if it were utc)'''
+    key = naive // _OFFSET_GRANULARITY
+    try:
+        return _naive_offsets[key]
+    except KeyError:
+        bucket = key * _OFFSET_GRANULARITY
+        fields = time.gmtime(bucket)[:8] + (-1,)  # let mktime work out DST
+        offset = bucket - int(time.mktime(fields))
+        _naive_offsets[key] = offset
+        return offset
+
+
+def utc_offset(epoch):
+    '''seconds east of utc of the local zone at the given utc epoch'''
+    key = int(epoch) // _OFFSET_GRANULARITY
+    try:
+        return _utc_offsets[key]
+    except KeyError:
+        bucket = key * _OFFSET_GRANULARITY
+        offset = calendar.timegm(time.localtime(bucket)) - bucket
+        _utc_offsets[key] = offset
+        return offset
+
+
+def parse_timestamp(value, local=False):
+    '''YYYY-MM-DD[THH:MM:SS[.ffffff]][Z] -> epoch seconds
+
+    The time is utc, or local wall time with local=True (a trailing Z always
+    means utc). Raises ValueError for anything else.'''
+    if len(value) < 10 or value[4] != '-' or value[7] != '-':
+        raise ValueError('invalid timestamp: {!r}'.format(value))
+
+    epoch = _day_epoch(value[:10])
+    rest = value[10:]
+    if rest.endswith('Z'):
+        rest, local = rest[:-1], False
+
+    if rest:
+        if len(rest) < 9 or rest[0] not in 'T ' or rest[3] != ':' or rest[6] != ':' or \
+                (len(rest) > 9 and (rest[9] != '.' or not rest[10:].isdigit())):
+            raise ValueError('invalid timestamp: {!r}'.format(value))
+
+        hour, minute, second = rest[1:3], rest[4:6], rest[7:9]
+        if not (hour.isdigit() and minute.isdigit() and second.isdigit()):
+            raise ValueError('invalid timestamp: {!r}'.format(value))
+
+        hour, minute, second = int(hour), int(minute), int(second)
+        if hour > 23 or minute > 59 or second > 61:
+            raise ValueError('invalid timestamp: {!r}'.format(value))
+
+        epoch += hour * 3600 + minute * 60 + second
+
+    if local:
+        epoch -= _naive_offset(epoch)
+    return epoch
+
+
+def format_timestamp(epoch):
+    '''epoch seconds -> YYYY-MM-DDTHH:MM:SS in utc'''
+    hour, seconds = divmod(int(epoch), 3600)
+    try:
+        return _hour_strings[hour] + _MINUTE_SECONDS[seconds]
+    except KeyError:
+        return _hour_string(hour) + _MINUTE_SECONDS[seconds]
+
+
+def utc2local(epoch):
+    '''utc epoch -> epoch of the local wall time, ie. format_timestamp(utc2local(t))
+    is the local time at t'''
+    return int(epoch) + utc_offset(epoch)
+
+
+def local2utc(epoch):
+    '''inverse of utc2local()'''
+    return int(epoch) - _naive_offset(int(epoch))
+
+
+def sacct_env(environ=None):
+    '''environment for running sacct with epoch timestamps in its output'''
+    env = dict(os.environ if environ is None else environ)
+    env['SLURM_TIME_FORMAT'] = SACCT_TIME_FORMAT
+    return env
+
+
+def sacct_timestamp(value):
+    '''a Submit/Start/End field from sacct -> utc epoch seconds, whether sacct ran
+    with sacct_env() or printed local wall time. Raises ValueError for Unknown/None.'''
+    if value.isdigit():
+        return int(value)
+    return parse_timestamp(value, local=True)
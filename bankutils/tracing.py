@@ -0,0 +1,203 @@
+'''
+Opt-in tracing of API requests, written as Chrome trace-event json.
+
+Every HTTP request becomes a span with its endpoint, params, status, bytes,
+retry number and timings. The functions that make requests
+(paginate_requests, single_request, get_cpu_usage) get spans of their own, so
+the requests show up nested under them. Each traced request carries an
+X-Request-ID header, which is in its span too, to find it in the API server's
+logs. Open the file in chrome://tracing or https://ui.perfetto.dev.
+
+    TRACER = tracing.Tracer(parsed.trace)  # disabled when the path is None
+    TRACER.install()                       # written at exit
+
+    with TRACER.span('single_request', url=request_url):
+        with TRACER.request('GET', request_url) as span:
+            request.add_header(tracing.REQUEST_ID_HEADER, span.request_id)
+            response = urlopen(request)
+            span.lap('ttfb')
+            body = response.read()
+            span.lap('read')
+            span.args.update(status=response.getcode(), bytes=len(body))
+
+Laps are the time since the previous lap (or the start of the span), so for
+connections made by httppool they add up to the total: dns, connect, tls,
+send, ttfb, read. Through urllib2 only ttfb (from the start, connecting
+included) and read are visible.
+'''
+import os
+import sys
+import json
+import time
+import atexit
+import binascii
+import threading
+
+try:
+    from urlparse import urlparse, parse_qsl
+except ImportError:
+    from urllib.parse import urlparse, parse_qsl
+
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+
+def new_request_id():
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+
+def url_args(url):
+    '''span args of a request url: its path, and its query string as a dict'''
+    parsed = urlparse(url)
+    return {'endpoint': parsed.path, 'params': dict(parse_qsl(parsed.query))}
+
+
+class Span(object):
+    '''a span in progress, args can be added to it until it ends'''
+
+    def __init__(self, tracer, name, category, args, request_id=None):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.request_id = request_id
+        self.started = self.last_lap = None
+
+    def __enter__(self):
+        self.started = self.last_lap = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        finished = time.time()
+        if kind is not None and kind is not GeneratorExit:  # GeneratorExit: a generator that wasn't read to the end
+            self.args.setdefault('error', '{}: {}'.format(kind.__name__, value))
+        self.args['total_ms'] = round((finished - self.started) * 1000, 3)
+        self.tracer.add(self.name, self.category, self.started, finished, self.args)
+
+    def lap(self, name):
+        '''args[<name>_ms] = the time since the previous lap'''
+        now = time.time()
+        self.args[name + '_ms'] = round((now - self.last_lap) * 1000, 3)
+        self.last_lap = now
+
+
+class NoSpan(object):
+    '''what a disabled tracer hands out, costs next to nothing'''
+    request_id = None
+
+    def __init__(self):
+        self.args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        pass
+
+    def lap(self, name):
+        pass
+
+
+class Tracer(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = path is not None
+        self.started = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = {}  # thread ident -> tid
+        self.retries = {}  # url -> attempt of the retry about to be made
+        self.lock = threading.Lock()
+
+    def span(self, name, category='function', **args):
+        '''span around a call, eg. with TRACER.span('single_request', url=url):'''
+        if not self.enabled:
+            return NoSpan()
+        return Span(self, name, category, args)
+
+    def request(self, method, url):
+        '''span of an HTTP request, with a new request id to send as the X-Request-ID header'''
+        if not self.enabled:
+            return NoSpan()
+
+        args = url_args(url)
+        request_id = new_request_id()
+        with self.lock:
+            args.update(method=method, request_id=request_id, retry=self.retries.pop(url, 0))
+        return Span(self, '{} {}'.format(method, args['endpoint']), 'http', args, request_id)
+
+    def add_retry(self, url, attempt, error=None):
+        '''pagination.Retry on_retry hook: marks the retry, and numbers the next request to url'''
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.retries[url] = attempt
+        self.add('retry', 'http', time.time(), None, dict(url_args(url), attempt=attempt, error=str(error)))
+
+    def add(self, name, category, started, finished, args):
+        '''a complete span, or an instant event if finished is None'''
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': category, 'pid': self.pid, 'ts': round((started - self.started) * 1e6, 1),
+                 'args': args}
+        if finished is None:
+            event.update(ph='i', s='t')
+        else:
+            event.update(ph='X', dur=round((finished - started) * 1e6, 1))
+
+        with self.lock:
+            tid = self.threads.get(thread.ident)
+            if tid is None:
+                tid = self.threads[thread.ident] = len(self.threads) + 1
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                    'args': {'name': thread.name}})
+            event['tid'] = tid
+            self.events.append(event)
+
+    def trace(self):
+        with self.lock:
+            events = list(self.events)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))}}
+
+    def write(self, path=None):
+        path = path or self.path
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(self.trace(), f)
+        os.rename(temp, path)
+
+    def install(self):
+        '''write the trace at exit, if tracing is enabled'''
+        if not self.enabled:
+            return
+
+        def write():
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                sys.stderr.write('could not write trace to {}: {}\n'.format(self.path, e))
+
+        atexit.register(write)
+
+    def urlopen(self, request, timeout=None):
+        '''urlopen(request).read(), traced. For scripts that use urllib2 without RunMetrics'''
+        try:
+            from urllib2 import urlopen
+        except ImportError:
+            from urllib.request import urlopen
+
+        with self.request(request.get_method(), request.get_full_url()) as span:
+            if span.request_id:
+                request.add_header(REQUEST_ID_HEADER, span.request_id)
+            try:
+                response = urlopen(request, timeout=timeout) if timeout else urlopen(request)
+                span.lap('ttfb')
+                body = response.read()
+                span.lap('read')
+            except Exception as e:
+                span.args['status'] = getattr(e, 'code', type(e).__name__)
+                raise
+
+            span.args.update(status=response.getcode(), bytes=len(body))
+            return body
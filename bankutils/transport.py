@@ -0,0 +1,145 @@
+'''
+What happens around every API request, whichever way it is sent.
+
+RunMetrics sends the sync scripts' requests with urllib2, ConnectionPool
+sends check_usage's over keep-alive connections. Transport does the rest for
+both: the request is traced (tracing.Tracer) and waits for a token of the
+rate limit (ratelimit.RateLimiter). GETs of the endpoints that rarely change
+are made conditional (httpcache.ValidatorCache), and a 304 is answered with
+the kept 200 response. Responses are asked for gzipped and decompressed,
+a body shorter than its Content-Length raises jsonstream.IncompletePage, and
+every response (or failure) is passed to observe(method, url, seconds, bytes
+sent, bytes received, status):
+
+    transport = Transport(tracer, limiter, cache)
+    status, body = transport.request('GET', url, {'Authorization': AUTH_TOKEN}, None, send)
+
+send(headers, span) sends the request with these headers and returns the
+response once its status line is in: an httplib response, urlopen()'s, or
+anything with `status` (or getcode()), getheader(name) (or info()), read()
+and close(). It may also raise the error of a response, like urllib2's
+HTTPError, which is recorded and raised again (a 304 is answered from the
+cache first).
+'''
+import time
+
+from bankutils import jsonstream, ratelimit, tracing
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+
+def status_of(response):
+    status = getattr(response, 'status', None)
+    return status if status is not None else response.getcode()
+
+
+def header_of(response):
+    '''header(name) of a response, None for a missing header'''
+    return response.info().get if hasattr(response, 'info') else response.getheader
+
+
+class Transport(object):
+    def __init__(self, tracer=None, limiter=None, cache=None, observe=None):
+        self.tracer = tracer or tracing.Tracer()
+        self.limiter = limiter or ratelimit.RateLimiter()
+        self.cache = cache
+        self.observe = observe
+
+    def _start(self, method, url, headers, span, ticket):
+        '''the headers to send: Accept-Encoding, the request id and the conditional ones'''
+        if ticket.waited:
+            span.lap('throttled')
+        headers = dict(headers, **{'Accept-Encoding': jsonstream.ACCEPT_ENCODING})
+        if span.request_id:
+            headers[tracing.REQUEST_ID_HEADER] = span.request_id
+        if self.cache is not None and method == 'GET':
+            headers.update(self.cache.request_headers(url, headers.get('Authorization')))
+        return headers
+
+    def _record(self, method, url, span, ticket, started, sent, received, status):
+        '''status: the response's, or the name of the error the request failed with'''
+        ticket.status = status if isinstance(status, int) else None
+        span.args.update(status=status, bytes=received, bytes_sent=sent)
+        if self.observe is not None:
+            self.observe(method, url, time.time() - started, sent, received, status)
+
+    def request(self, method, url, headers, body, send):
+        '''(status, body) of a request, read whole'''
+        conditional = self.cache is not None and method == 'GET'
+        credentials = headers.get('Authorization')
+        sent = len(body or b'')
+        with self.tracer.request(method, url) as span, self.limiter.acquire() as ticket:
+            headers = self._start(method, url, headers, span, ticket)
+            started = time.time()
+            try:
+                response = send(headers, span)
+                span.lap('ttfb')
+                try:
+                    data = response.read()
+                    span.lap('read')
+                    length = header_of(response)('Content-Length')
+                    if length and length.isdigit() and len(data) < int(length):  # python 2 doesn't raise IncompleteRead
+                        raise jsonstream.IncompletePage('the body ended after {} of {} bytes'.format(len(data), length))
+                finally:
+                    response.close()
+            except Exception as e:
+                code = getattr(e, 'code', None)
+                if conditional and code == 304:  # urllib2 raises for anything but a 2xx
+                    status, data = self.cache.response(url, 304, header_of(e), b'', credentials)
+                    if status == 200:
+                        self._record(method, url, span, ticket, started, sent, 0, 304)
+                        return status, data
+                self._record(method, url, span, ticket, started, sent, 0, code or type(e).__name__)
+                raise
+
+            status = status_of(response)
+            self._record(method, url, span, ticket, started, sent, len(data), status)
+
+        header = header_of(response)
+        data = jsonstream.gunzip(data, header('Content-Encoding'))
+        if conditional:
+            return self.cache.response(url, status, header, data, credentials)
+        return status, data
+
+    def stream(self, method, url, headers, body, send):
+        '''(status, jsonstream.Page) of a request, decoded as it is read. The request is recorded once the page
+        has been read (or closed). GETs the cache applies to are read whole, to keep them'''
+        if self.cache is not None and method == 'GET' and self.cache.cacheable.search(urlparse(url).path):
+            status, data = self.request(method, url, headers, body, send)
+            return status, jsonstream.Page([data])
+
+        sent = len(body or b'')
+        span = self.tracer.request(method, url)
+        span.__enter__()
+        ticket = self.limiter.acquire()
+        headers = self._start(method, url, headers, span, ticket)
+        started = time.time()
+        try:
+            response = send(headers, span)
+            span.lap('ttfb')
+        except Exception as e:
+            self._record(method, url, span, ticket, started, sent, 0, getattr(e, 'code', None) or type(e).__name__)
+            ticket.__exit__(None, None, None)
+            span.__exit__(type(e), e, None)
+            raise
+
+        received = [0]
+
+        def chunks():
+            for chunk in jsonstream.chunks(response):
+                received[0] += len(chunk)
+                yield chunk
+
+        def close(error):
+            response.close()
+            span.lap('read')
+            status = status_of(response) if error is None else type(error).__name__
+            self._record(method, url, span, ticket, started, sent, received[0], status)
+            ticket.__exit__(None, None, None)
+            span.__exit__(None if error is None else type(error), error, None)
+
+        page = jsonstream.Page(chunks(), header_of(response)('Content-Encoding'), on_close=close)
+        return status_of(response), page
@@ -0,0 +1,588 @@
+'''
+Usage of accounts and users, as check_usage_coldfront.py reports it.
+
+UsageClient makes the API requests of usage queries and returns the usage as
+records (dicts), so portals and job submit helpers can ask for it without
+running check_usage and reading its output. A client keeps its connections,
+threads and responses between calls, keep one around instead of making one
+per query:
+
+    client = usage.UsageClient('https://mybrc.brc.berkeley.edu/api/', AUTH_TOKEN, usage.MODE_MYBRC)
+    record = client.account_usage('fc_foo', expand=True)
+    for record in client.users_usage(['alice', 'bob']):
+        ...
+
+Times are utc time stamps. Without a start, accounts are queried from the
+start of their allocation and users from the start of the allocation year,
+without an end until now. Records look like
+
+    {'type': 'account', 'account': 'fc_foo', 'start': '2021-06-01T07:00:00Z', 'end': ...,
+     'jobs': 12, 'cpu_hours': 3.5, 'service_units': '4.20', 'allocation': 300000,
+     'users': [{'user': 'alice', 'jobs': 2, 'cpu_hours': 1.0, 'service_units': '1.20', 'percent': 28.6}]}
+    {'type': 'user', 'user': 'alice', 'start': ..., 'end': ..., 'jobs': 2, 'cpu_hours': 1.0, 'service_units': '1.20',
+     'accounts': [{'account': 'fc_foo', 'jobs': 2, 'cpu_hours': 1.0, 'service_units': '1.20', 'removed': False}]}
+
+`allocation` is only there for queries from the start of the allocation,
+`users` and `accounts` only with expand=True. Queries that can't be answered
+(eg. an account that doesn't exist) get a record with an `error` message
+instead. account_usage() and user_usage() raise QueryError, and URLError when
+the API can't be reached, the batch variants turn these into error records.
+
+check_usage runs this on every invocation, often from NFS, so what only some
+queries need is imported when they first need it: httplib and urllib2 for
+requests that don't go through the login node daemon (and for errors),
+pagination for -E and the report, multiprocessing for the report. Queries
+run their requests on a tasks.TaskPool instead of a ThreadPool.
+
+With a tracing.Tracer, the requests and the functions that make them
+(single_request, get_cpu_usage, paginate_requests) are traced. Requests
+answered by the login node daemon are traced as the daemon requests they are,
+their request id is passed on for the daemon to send to the API. With a
+ratelimit.RateLimiter, the requests the client sends itself wait for its
+tokens (the daemon has a limiter of its own), and with an
+httpcache.ValidatorCache they are conditional where the endpoint allows it.
+'''
+import os
+import json
+import time
+import socket
+import datetime
+import threading
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from bankutils import allocations, coalesce, tasks, timeconv, tracing
+
+
+MODE_MYBRC = 'mybrc'
+MODE_MYLRC = 'mylrc'
+
+SUPPORT = {
+    MODE_MYBRC: ('BRC', 'brc-hpc-help@berkeley.edu'),
+    MODE_MYLRC: ('LRC', 'hpcshelp@lbl.gov'),
+}
+
+# month the allocation year starts in
+BREAK_MONTH = {
+    MODE_MYBRC: 6,
+    MODE_MYLRC: 10,
+}
+
+COMPUTE_RESOURCES_TABLE = {
+    MODE_MYBRC: {
+        'ac': 'Savio Compute',
+        'co': 'Savio Compute',
+        'fc': 'Savio Compute',
+        'ic': 'Savio Compute',
+        'pc': 'Savio Compute',
+        'vector': 'Vector Compute',
+        'abc': 'ABC Compute',
+    },
+
+    MODE_MYLRC: {
+        'ac': 'LAWRENCIUM Compute',
+        'lr': 'LAWRENCIUM Compute',
+        'pc': 'LAWRENCIUM Compute',
+    }
+}
+
+DAEMON_TIMEOUT = 120
+
+# jobs per page of the report's sweep, and the job fields it needs
+REPORT_PAGE_SIZE = 1000
+REPORT_FIELDS = 'accountid,userid,startdate,amount,cpu_time'
+
+
+class QueryError(Exception):
+    '''a query that can't be answered, the message is shown as is'''
+
+
+def url_errors():
+    '''(URLError, HTTPError). Both are IOErrors, so `except IOError` catches them without importing urllib2'''
+    try:
+        from urllib2 import URLError, HTTPError
+    except ImportError:
+        from urllib.error import URLError, HTTPError
+    return URLError, HTTPError
+
+
+# local date time string -> utc time stamp
+def to_timestamp(date_time):
+    return timeconv.parse_timestamp(date_time, local=True)
+
+
+# utc time stamp -> utc date time string
+def to_timestring(timestamp):
+    return timeconv.format_timestamp(timestamp) + 'Z'
+
+
+def now_rounded_up():
+    '''now, rounded up to the minute. the default end time is the same for every query in that minute, so the
+    login node daemon can share their responses (and there are no jobs that start in the future anyway)'''
+    return (int(time.time()) // 60 + 1) * 60
+
+
+def default_start(mode):
+    '''local date time string of the start of the current allocation year'''
+    now = datetime.datetime.now()
+    year = now.year if now.month >= BREAK_MONTH[mode] else now.year - 1
+    return '{}-{:02d}-01T00:00:00'.format(year, BREAK_MONTH[mode])
+
+
+class UsageClient(object):
+    def __init__(self, base_url, token=None, mode=MODE_MYBRC, socket_path=None, workers=8, ttl=60, debug=False,
+                 tracer=None, limiter=None, cache=None):
+        '''token can be left out if the login node daemon listens on socket_path. workers is the number of
+        users/accounts the batch variants query at the same time, and ttl how long responses are reused'''
+        self.base_url = base_url
+        self.token = token
+        self.mode = mode
+        self.socket_path = socket_path
+        self.workers = max(1, workers)
+        self.debug = debug
+        self.tracer = tracer or tracing.Tracer()
+        self.limiter = limiter
+        self.cache = cache
+        self.support_team, self.support_email = SUPPORT[mode]
+        self.compute_resources = COMPUTE_RESOURCES_TABLE[mode]
+
+        self.allocation_endpoint = base_url + 'allocations/'
+        self.allocation_users_endpoint = base_url + 'allocation_users/'
+        self.job_endpoint = base_url + 'jobs/'
+
+        # requests in flight at the same time, enough for the users of most accounts to be asked for at once
+        self.in_flight = max(self.workers, 16)
+
+        # responses to single requests. a request made by two queries (eg. the allocation of an account, for its
+        # start date and for its users' start date) is sent once, even when both are in flight
+        self.responses = coalesce.CoalescingCache(ttl=ttl)
+
+        # made on first use, see connection_pool(), submit() and batch()
+        self.lock = threading.Lock()
+        self.pool = None
+        self.retry = None
+        self.requests = None
+        self.queries = None
+
+    def close(self):
+        for pool in (self.queries, self.requests, self.pool):
+            if pool is not None:
+                pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def backend_error(self):
+        URLError, _ = url_errors()
+        return URLError('ERR: Backend Error, contact {} Support ({}).'.format(self.support_team, self.support_email))
+
+    def connection_pool(self):
+        '''one keep-alive connection per request in flight, when the login node daemon isn't there to make them'''
+        with self.lock:
+            if self.pool is None:
+                from bankutils import httppool
+                self.pool = httppool.ConnectionPool(self.base_url, size=self.in_flight, tracer=self.tracer,
+                                                    limiter=self.limiter, cache=self.cache)
+            return self.pool
+
+    def submit(self, fn, *args, **kwargs):
+        '''start fn(*args, **kwargs) on the request pool. .get() of the result waits for it, or raises its error'''
+        with self.lock:
+            if self.requests is None:
+                self.requests = tasks.TaskPool(self.in_flight)
+        return self.requests.submit(fn, *args, **kwargs)
+
+    def daemon_get(self, url):
+        '''the decoded response to a GET of url, from the login node daemon. None if it isn't running'''
+        if self.socket_path is None or not url.startswith(self.base_url) or not os.path.exists(self.socket_path):
+            return None
+
+        with self.tracer.request('GET', url) as span:
+            span.args['transport'] = 'daemon'
+            message = {'path': url[len(self.base_url):]}
+            if span.request_id:
+                message['request_id'] = span.request_id
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.settimeout(DAEMON_TIMEOUT)
+            try:
+                client.connect(self.socket_path)
+                span.lap('connect')
+                client.sendall((json.dumps(message) + '\n').encode('utf-8'))
+                line = client.makefile('rb').readline()
+                span.lap('reply')
+            except socket.error as e:
+                span.args['status'] = type(e).__name__
+                if self.debug:
+                    print('[daemon_get({})] ERR: {}'.format(url, e))
+                return None
+            finally:
+                client.close()
+
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                span.args['status'] = 'incomplete reply'
+                return None  # daemon went away mid-reply, ask the API ourselves
+            span.args.update(status=reply['status'], bytes=len(line))
+
+        if reply['status'] != 200:
+            _, HTTPError = url_errors()
+            raise HTTPError(url, reply['status'], reply.get('error'), None, None)
+        return reply['body']
+
+    def api_get(self, url):
+        '''decoded json response to a GET of url, through the login node daemon if it is running'''
+        response = self.daemon_get(url)
+        if response is not None:
+            return response
+
+        URLError, HTTPError = url_errors()
+        if self.token is None:
+            raise URLError('no API token, and the login node daemon is not running')
+
+        try:
+            from httplib import HTTPException
+        except ImportError:
+            from http.client import HTTPException
+
+        try:
+            status, body = self.connection_pool().request('GET', url, {'Authorization': self.token})
+        except (socket.error, HTTPException) as e:
+            raise URLError(e)
+
+        if status != 200:
+            raise HTTPError(url, status, body[:200], None, None)
+        return json.loads(body)
+
+    def cached_get(self, url):
+        return self.responses.get(url, lambda: self.api_get(url))
+
+    def paginate_requests(self, url, params):
+        '''yield the results of a paginated endpoint, one page at a time'''
+        from bankutils import pagination
+        with self.lock:
+            if self.retry is None:
+                self.retry = pagination.Retry(attempts=3, on_retry=self.tracer.add_retry)
+
+        try:
+            with self.tracer.span('paginate_requests', url=url, params=params) as span:
+                span.args['results'] = 0
+                for result in pagination.paginate(self.api_get, url, params, self.retry):
+                    span.args['results'] += 1
+                    yield result
+        except pagination.PageError as e:
+            if self.debug:
+                print('[paginate_requests({}, {})] ERR: {}'.format(url, params, e))
+
+            # don't report the usage of the pages that were read as if it were all of it
+            raise self.backend_error()
+
+    def single_request(self, url, params=None):
+        request_url = url
+        if params:
+            request_url += '?' + urlencode(params)
+
+        try:
+            with self.tracer.span('single_request', url=request_url):
+                response = self.cached_get(request_url)
+        except Exception as e:
+            response = {'results': None}
+
+            if self.debug:
+                print('[single_request({}, {})] ERR: {}'.format(url, params, e))
+
+        return response['results']
+
+    def allocation_params(self, project):
+        '''query of the allocations/ endpoint for a project's allocation of its compute resource'''
+        return {'project': project, 'resources': allocations.compute_resource(self.compute_resources, project)}
+
+    def get_project_start(self, project):
+        return self.project_start(project, self.single_request(self.allocation_endpoint,
+                                                               self.allocation_params(project)))
+
+    def project_start(self, project, response):
+        '''local start time string of a project, from the results of its allocation query'''
+        if not response or len(response) == 0:
+            if self.debug:
+                print('[get_project_start({})] ERR'.format(project))
+
+            return None
+
+        try:
+            creation = response[0]['start_date']
+            return creation.split('.')[0] if '.' in creation else creation
+        except Exception as e:
+            if self.debug:
+                print('[get_project_start({})] ERR: {}'.format(project, e))
+
+            raise QueryError('information missing in {} database, contact Support ({}) if problem persists.'
+                             .format(self.support_team, self.support_email))
+
+    def period_start(self, start=None):
+        '''start, or the start of the allocation year'''
+        return start if start is not None else to_timestamp(default_start(self.mode))
+
+    def get_cpu_usage(self, start, end, user=None, account=None):
+        '''(jobs, cpu hours, SUs) of the jobs of a user and/or account. (-1, -1, -1) if a user can't be queried'''
+        params = {'start_time': start, 'end_time': end}
+        if user:
+            params['user'] = user
+
+        if account:
+            params['account'] = account
+
+        request_url = self.job_endpoint + '?' + urlencode(params)
+
+        try:
+            with self.tracer.span('get_cpu_usage', url=request_url):
+                response = self.cached_get(request_url)
+        except Exception as e:
+            response = {'count': 0, 'total_cpu_time': 0, 'total_amount': 0,
+                        'response': [], 'next': None}
+
+            if self.debug:
+                print('[get_cpu_usage({}, {})] ERR: {}'.format(user, account, e))
+
+            if user and not account:
+                return -1, -1, -1
+
+        job_count = response['count']
+        total_cpu = response['total_cpu_time']
+        total_amount = response['total_amount']
+
+        return job_count, total_cpu, total_amount
+
+    def account_start(self, account, start=None):
+        '''utc start time stamp of an account's queries: the project start, if no start was given'''
+        if start is not None:
+            return start
+
+        target_start_date = self.get_project_start(account)  # local time string
+        if target_start_date is None:
+            if self.debug:
+                print('[get_account_start({})] ERR'.format(account))
+            return self.period_start()
+
+        return to_timestamp(target_start_date)
+
+    def account_usage(self, account, start=None, end=None, expand=False):
+        '''usage record of an account, and of its users with expand.
+
+        Each request is sent as soon as the ones it depends on are answered, so a query waits for two round trips:
+
+            allocation ---------> attributes
+                       \\-------> account jobs, user jobs  (only for the start date: with a start they don't wait)
+            allocation users --> user jobs
+        '''
+        end = end if end is not None else now_rounded_up()
+        submit = self.submit
+        allocation = submit(self.single_request, self.allocation_endpoint, self.allocation_params(account))
+        members = None
+        if expand:
+            members = submit(list, self.paginate_requests(self.allocation_users_endpoint, {'project': account}))
+
+        account_begin = self.period_start(start)
+        if start is not None:
+            account_jobs = submit(self.get_cpu_usage, account_begin, end, account=account)
+
+        response = allocation.get()
+        if response and start is None:
+            account_begin = to_timestamp(self.project_start(account, response))
+            account_jobs = submit(self.get_cpu_usage, account_begin, end, account=account)
+
+        record = {'type': 'account', 'account': account,
+                  'start': to_timestring(account_begin), 'end': to_timestring(end)}
+
+        if not response or len(response) == 0:
+            if self.debug:
+                print('[account_usage({})] ERR'.format(account))
+
+            record['error'] = 'Account not found: {}'.format(account)
+            return record
+
+        allocation_id = response[0]['id']
+        allocation_url = self.allocation_endpoint + '{}/attributes/'.format(allocation_id)
+        attributes = submit(self.single_request, allocation_url, {'type': 'Service Units'})
+
+        member_jobs = []
+        if expand:
+            member_jobs = [(user['user'], submit(self.get_cpu_usage, account_begin, end, user['user'], account))
+                           for user in members.get() if user['user'] is not None]
+
+        response = attributes.get()
+        if not response or len(response) == 0:
+            if self.debug:
+                print('[account_usage()] ERR')
+
+            raise self.backend_error()
+
+        allocation = response[0]['value']
+        allocation = int(float(allocation))
+
+        if 'ac_' in account or 'co_' in account:
+            # get usage from allocation attribute
+            try:
+                usage = response[0]['usage']['value']
+            except KeyError:
+                raise self.backend_error()
+
+            job_count, cpu_usage, _ = account_jobs.get()
+        else:
+            # get usage from jobs
+            job_count, cpu_usage, usage = account_jobs.get()
+
+        record.update(jobs=job_count, cpu_hours=cpu_usage, service_units=usage)
+        if start is None:
+            record['allocation'] = allocation
+
+        if expand:
+            record['users'] = []
+            for user, jobs in member_jobs:
+                user_jobs, user_cpu, user_usage = jobs.get()
+
+                percentage = 0.0
+                try:
+                    percentage = (float(user_usage) / float(usage)) * 100
+                except Exception:
+                    percentage = 0.00
+
+                record['users'].append({'user': user, 'jobs': user_jobs, 'cpu_hours': user_cpu,
+                                        'service_units': user_usage, 'percent': percentage})
+
+        return record
+
+    def user_usage(self, user, start=None, end=None, expand=False):
+        '''usage record of a user, and of the user in each of their accounts with expand.
+        The user's jobs and accounts are requested at the same time, then the jobs in each account.'''
+        user_begin = self.period_start(start)
+        end = end if end is not None else now_rounded_up()
+        record = {'type': 'user', 'user': user, 'start': to_timestring(user_begin), 'end': to_timestring(end)}
+
+        total = self.submit(self.get_cpu_usage, user_begin, end, user)
+        memberships = None
+        if expand:
+            memberships = self.submit(list, self.paginate_requests(self.allocation_users_endpoint, {'user': user}))
+
+        total_jobs, total_cpu, total_usage = total.get()
+        if total_jobs == total_cpu == total_usage == -1:
+            record['error'] = 'User not found: {}'.format(user)
+            return record
+
+        record.update(jobs=total_jobs, cpu_hours=total_cpu, service_units=total_usage)
+
+        if expand:
+            record['accounts'] = []
+            account_jobs = [(allocation, self.submit(self.get_cpu_usage, user_begin, end, user, allocation['project']))
+                            for allocation in memberships.get()]
+            for allocation, jobs in account_jobs:
+                allocation_jobs, allocation_cpu, allocation_usage = jobs.get()
+                record['accounts'].append({'account': allocation['project'], 'jobs': allocation_jobs,
+                                           'cpu_hours': allocation_cpu, 'service_units': allocation_usage,
+                                           'removed': allocation['status'] == 'Removed'})
+
+        return record
+
+    def query(self, kind, name, start=None, end=None, expand=False):
+        '''usage record of a user or account (kind), errors are reported in the record'''
+        try:
+            if kind == 'user':
+                return self.user_usage(name, start, end, expand)
+            return self.account_usage(name, start, end, expand)
+
+        except QueryError as e:
+            error = str(e)
+
+        except IOError as e:  # URLError, HTTPError and socket errors
+            error = 'Could not connect to backend, contact {} Support ({}) if problem persists.'.format(
+                self.support_team, self.support_email)
+            if self.debug:
+                print('[query({}, {})] ERR: {}'.format(kind, name, e))
+
+        except Exception as e:
+            error = 'Unexpected error, contact {} Support ({}) if problem persists.'.format(
+                self.support_team, self.support_email)
+            if self.debug:
+                print('[query({}, {})] ERR: {}'.format(kind, name, e))
+
+        return {'type': kind, kind: name, 'error': error}
+
+    def batch(self, queries, start=None, end=None, expand=False):
+        '''usage records of (kind, name) queries, in order. They run `workers` at a time, starting right away'''
+        end = end if end is not None else now_rounded_up()
+        with self.lock:
+            if self.queries is None:
+                self.queries = tasks.TaskPool(self.workers)
+        return self.queries.imap(lambda query: self.query(query[0], query[1], start, end, expand), queries)
+
+    def accounts_usage(self, accounts, start=None, end=None, expand=False):
+        return self.batch([('account', account) for account in accounts], start, end, expand)
+
+    def users_usage(self, users, start=None, end=None, expand=False):
+        return self.batch([('user', user) for user in users], start, end, expand)
+
+    def usage_report(self, start=None, end=None, expand=False):
+        '''usage records of every account, sorted by account, from one pass over the period's jobs.
+        Allocations and their Service Units are read in bulk instead of per account.'''
+        end = end if end is not None else now_rounded_up()
+        period_start = self.period_start(start)
+        index = allocations.AllocationIndex.load(self.paginate_requests, self.base_url)
+        index.load_attributes(self.single_request, self.base_url, workers=self.workers)
+
+        projects = {}  # account -> (allocation start time stamp, Service Units attribute)
+        for project, resource in index.allocations:
+            if resource != allocations.compute_resource(self.compute_resources, project):
+                continue
+
+            project_start = index.start_date(project, resource) if start is None else None
+            projects[project] = (to_timestamp(project_start) if project_start else period_start,
+                                 index.attribute(project, resource))
+
+        # account -> [jobs, cpu hours, SUs], account -> user -> [jobs, cpu hours, SUs]
+        totals = dict((project, [0, 0.0, 0.0]) for project in projects)
+        user_totals = dict((project, {}) for project in projects)
+        sweep_start = min([project_start for project_start, _ in projects.values()] or [period_start])
+        params = {'start_time': sweep_start, 'end_time': end, 'page_size': REPORT_PAGE_SIZE, 'fields': REPORT_FIELDS}
+        for job in self.paginate_requests(self.job_endpoint, params):
+            account = job['accountid']
+            if account not in projects:
+                continue
+            if job['startdate'] and timeconv.parse_timestamp(job['startdate']) < projects[account][0]:
+                continue  # before the start of the account's allocation
+
+            amount = float(job['amount'] or 0)
+            cpu_time = job['cpu_time'] or 0.0
+            for total in (totals[account], user_totals[account].setdefault(job['userid'], [0, 0.0, 0.0])):
+                total[0] += 1
+                total[1] += cpu_time
+                total[2] += amount
+
+        for account in sorted(projects):
+            account_begin, attribute = projects[account]
+            job_count, cpu_usage, usage = totals[account]
+            record = {'type': 'account', 'account': account, 'start': to_timestring(account_begin),
+                      'end': to_timestring(end), 'jobs': job_count, 'cpu_hours': cpu_usage,
+                      'service_units': round(usage, 2)}
+
+            if attribute is not None:
+                if ('ac_' in account or 'co_' in account) and attribute.get('usage'):
+                    record['service_units'] = round(float(attribute['usage']['value']), 2)
+                record['allocation'] = int(float(attribute['value']))
+                if record['allocation']:
+                    record['percent_used'] = record['service_units'] / record['allocation'] * 100
+
+            if expand:
+                record['users'] = []
+                for user, (user_jobs, user_cpu, user_usage) in sorted(user_totals[account].items()):
+                    percentage = user_usage / usage * 100 if usage else 0.0
+                    record['users'].append({'user': user, 'jobs': user_jobs, 'cpu_hours': user_cpu,
+                                            'service_units': round(user_usage, 2), 'percent': percentage})
+
+            yield record
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+'''
+Memory benchmark for the job table of full_sync_coldfront.py.
+
+Parses generated sacct output (see fake_slurm.py) into the job table the way
+full_sync does, once with the old layout (every raw sacct line kept until the
+end, plus a dict per job) and once with bankutils.jobs.JobTable (sacct output
+parsed one account at a time), each in a fresh process, and reports peak RSS
+and the RSS per million jobs.
+
+usage: python bench_memory.py [--jobs 1000000] [--layout dict|table]
+'''
+import os
+import sys
+import json
+import argparse
+import resource
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import fake_slurm  # noqa: E402
+from bankutils import jobs, timeconv  # noqa: E402
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KB on linux
+
+
+def sacct_output(config, account_index):
+    '''`sacct -A <account> -naPX` with SLURM_TIME_FORMAT=%s, for the finished jobs of an account'''
+    lines = []
+    for job in fake_slurm.iter_jobs(config, [account_index]):
+        if job.end is None:
+            continue
+        elapsed = job.end - job.start
+        lines.append('|'.join([str(job.jobid), str(job.submit), str(job.start), str(job.end), str(job.uid),
+                               job.account, job.state, job.partition, job.qos, job.nodelist, str(job.cpus),
+                               str(max(1, job.nodes)), str(job.nodes), str(elapsed * job.cpus),
+                               fake_slurm.format_duration(elapsed * job.cpus)]))
+    return '\n'.join(lines) + '\n'
+
+
+def old_node_list(nodelist):
+    return [{'name': name} for name in jobs.expand_node_list(nodelist)]
+
+
+def run_dict(config, prices):
+    '''the layout before bankutils.jobs: raw lines per project, then a dict per job'''
+    projects = [{'jobs': sacct_output(config, index).splitlines()} for index in range(config.accounts)]
+    table = {}
+    for project in projects:
+        for line in project['jobs']:
+            values = [str(value) for value in line.split('|')]
+            jobid, submit, start, end, uid, account, state, partition, qos, nodelist, alloc_cpus, req_nodes, \
+                alloc_nodes, cpu_time_raw, cpu_time = values
+            _start, _end = int(start), int(end)
+            raw_time_hrs = (_end - _start) / 3600.0
+            table[jobid] = {
+                'jobslurmid': jobid,
+                'submitdate': timeconv.format_timestamp(int(submit)),
+                'startdate': timeconv.format_timestamp(_start),
+                'enddate': timeconv.format_timestamp(_end),
+                'userid': uid,
+                'accountid': account,
+                'amount': str(round(prices[partition] * int(alloc_cpus) * raw_time_hrs, 2)),
+                'jobstatus': state,
+                'partition': partition,
+                'qos': qos,
+                'nodes': old_node_list(nodelist),
+                'num_cpus': int(alloc_cpus),
+                'num_req_nodes': int(req_nodes),
+                'num_alloc_nodes': int(alloc_nodes),
+                'raw_time': raw_time_hrs,
+                'cpu_time': raw_time_hrs * float(alloc_cpus)}
+    return len(table)
+
+
+def run_table(config, prices):
+    table = jobs.JobTable()
+    for index in range(config.accounts):
+        out = sacct_output(config, index)
+        for line in out.splitlines():
+            jobid, submit, start, end, uid, account, state, partition, qos, nodelist, alloc_cpus, req_nodes, \
+                alloc_nodes, cpu_time_raw, cpu_time = line.split('|')
+            _start, _end = int(start), int(end)
+            amount = round(prices[partition] * int(alloc_cpus) * (_end - _start) / 3600.0, 2)
+            table.append(jobid, int(submit), _start, _end, uid, account, state, partition, qos, nodelist,
+                         alloc_cpus, req_nodes, alloc_nodes, amount)
+        del out
+    return len(table)
+
+
+LAYOUTS = {'dict': run_dict, 'table': run_table}
+
+
+def measure(layout, total_jobs):
+    '''run one layout in this process, print a json result line'''
+    accounts = 50
+    config = fake_slurm.Config({'FAKE_SLURM_ACCOUNTS': str(accounts),
+                                'FAKE_SLURM_JOBS_PER_ACCOUNT': str(max(1, total_jobs // accounts))})
+    prices = dict(config.partitions)
+    baseline = peak_rss_mb()
+    count = LAYOUTS[layout](config, prices)
+    peak = peak_rss_mb()
+    print(json.dumps({'layout': layout, 'jobs': count, 'baseline_mb': round(baseline, 1),
+                      'peak_mb': round(peak, 1),
+                      'mb_per_million_jobs': round((peak - baseline) / count * 1e6, 1) if count else None}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=1000000)
+    parser.add_argument('--layout', choices=sorted(LAYOUTS),
+                        help='measure a single layout in this process (default: each in a fresh process)')
+    parser.add_argument('--python', default=sys.executable, help='interpreter to measure with')
+    parsed = parser.parse_args()
+
+    if parsed.layout:
+        measure(parsed.layout, parsed.jobs)
+        return 0
+
+    for layout in sorted(LAYOUTS):
+        out = subprocess.check_output([parsed.python, os.path.realpath(__file__),
+                                       '--layout', layout, '--jobs', str(parsed.jobs)])
+        result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        print('{layout:>6}: {jobs} jobs, peak rss {peak_mb:.1f} MB, '
+              '{mb_per_million_jobs:.1f} MB per million jobs'.format(**result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+'''
+Startup benchmark for check_usage_coldfront.py.
+
+Runs an account query through the login node daemon (check_usage_daemon.py
+against the stand-in API), the way check_usage runs on login nodes, and reads
+the per-phase times the script prints with --timings. Reports the median of
+each phase over the runs, next to a bare `python -c pass` for the interpreter's
+own startup, for the script and its zipapp build (build_zipapp.py).
+
+Exits 1 if the median startup (import + config) of the script goes over
+--budget milliseconds, so it can guard against imports creeping back in.
+
+usage: python bench_startup.py [--python python2] [--runs 20] [--budget 60]
+'''
+import os
+import re
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+CHECK_USAGE_DIR = os.path.join(REPO_DIR, 'savio-check_usage')
+sys.path.insert(0, BENCH_DIR)
+import fake_api  # noqa: E402
+import fake_slurm  # noqa: E402
+
+
+TIMINGS_PATTERN = re.compile(r'(\w+) ([\d.]+)ms')
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def wait_for(path, timeout=10):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            raise RuntimeError('{} did not show up'.format(path))
+        time.sleep(0.05)
+
+
+def run(command, env):
+    '''(wall ms, {phase: ms}) of a check_usage run with --timings'''
+    started = time.time()
+    process = subprocess.Popen(command + ['--timings'], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    wall = (time.time() - started) * 1000
+    if process.returncode != 0:
+        raise RuntimeError('{} exited with {}: {}'.format(command, process.returncode, err.decode('utf-8')))
+
+    for line in err.decode('utf-8').splitlines():
+        if line.startswith('timings:'):
+            return wall, dict((phase, float(ms)) for phase, ms in TIMINGS_PATTERN.findall(line))
+    raise RuntimeError('no timings in the output of {}'.format(command))
+
+
+def bench(name, command, env, runs):
+    run(command, env)  # warm up: bytecode, page cache, the daemon's cache
+    walls = []
+    phases = {}
+    for _ in range(runs):
+        wall, timings = run(command, env)
+        walls.append(wall)
+        for phase, ms in timings.items():
+            phases.setdefault(phase, []).append(ms)
+
+    result = dict((phase, median(values)) for phase, values in phases.items())
+    result['wall'] = median(walls)
+    result['startup'] = result['import'] + result['config']
+    print('{:<10} wall {:6.1f}ms  startup {:6.1f}ms  ({})'.format(
+        name, result['wall'], result['startup'],
+        ', '.join('{} {:.1f}ms'.format(phase, result[phase]) for phase in ('import', 'config', 'network', 'render'))))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--python', default='python2',
+                        help='interpreter used to run check_usage and the daemon (default: python2)')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--budget', type=float, default=60,
+                        help='max median import + config time of the script, in ms (default: 60)')
+    parser.add_argument('--no-zipapp', dest='zipapp', action='store_false', help="don't bench the zipapp build")
+    parsed = parser.parse_args()
+
+    # check_usage picks its mode from the hostname, the stand-in data has to match
+    mode = fake_slurm.MODE_MYBRC if 'brc' in socket.gethostname() else fake_slurm.MODE_MYLRC
+    env = dict(os.environ)
+    env.update({
+        'FAKE_SLURM_MODE': mode,
+        'FAKE_SLURM_ACCOUNTS': '10',
+        'FAKE_SLURM_JOBS_PER_ACCOUNT': '100',
+        'FAKE_SLURM_NOW': str(int(time.time()) // 86400 * 86400),
+    })
+    config = fake_slurm.Config(env)
+    account = config.account_name(0)
+
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    server, api_url = fake_api.serve(config=config)
+    daemon = None
+    try:
+        token = os.path.join(workdir, 'token.conf')
+        with open(token, 'w') as f:
+            f.write('Token bench\n')
+
+        env['CHECK_USAGE_SOCKET'] = os.path.join(workdir, 'check_usage.sock')
+        daemon = subprocess.Popen([parsed.python, os.path.join(CHECK_USAGE_DIR, 'check_usage_daemon.py'),
+                                   '-T', mode, '--SOCKET', env['CHECK_USAGE_SOCKET'], '--CONFIG', token,
+                                   '--API_URL', api_url, '--LOG', os.path.join(workdir, 'daemon.log')],
+                                  stdout=subprocess.PIPE)
+        wait_for(env['CHECK_USAGE_SOCKET'])
+
+        walls = []
+        for _ in range(parsed.runs):
+            started = time.time()
+            subprocess.call([parsed.python, '-c', 'pass'])
+            walls.append((time.time() - started) * 1000)
+        print('{:<10} wall {:6.1f}ms'.format('python', median(walls)))
+
+        query = ['-a', account, '-E']
+        script = bench('script', [parsed.python, os.path.join(CHECK_USAGE_DIR, 'check_usage_coldfront.py')] + query,
+                       env, parsed.runs)
+
+        if parsed.zipapp:
+            zipapp = os.path.join(workdir, 'check_usage.pyz')
+            subprocess.check_call([parsed.python, os.path.join(CHECK_USAGE_DIR, 'build_zipapp.py'), '-o', zipapp],
+                                  stdout=subprocess.PIPE)
+            bench('zipapp', [parsed.python, zipapp] + query, env, parsed.runs)
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+    if script['startup'] > parsed.budget:
+        print('startup {:.1f}ms is over the budget of {:.0f}ms'.format(script['startup'], parsed.budget))
+        return 1
+    print('startup {:.1f}ms is within the budget of {:.0f}ms'.format(script['startup'], parsed.budget))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+'''
+Benchmark harness for the sync scripts in sync-brcdb/.
+
+Runs a sync script end to end against the fake `sacct`/`sacctmgr` in bench/bin
+and the stand-in API (fake_api.py), timestamps every line the script prints,
+and derives per-phase wall time plus parse/price throughput (jobs per second)
+from the phase markers. Each run is appended to a history file together with
+the current git commit, so throughput can be tracked across commits.
+
+usage: python bench_sync.py [--script full_sync] [--accounts 50] [--jobs-per-account 2000]
+'''
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+import fake_api  # noqa: E402
+import fake_slurm  # noqa: E402
+
+
+# script name -> (path, config file template, ordered (phase, marker regex) list)
+SCRIPTS = {
+    'full_sync': ('sync-brcdb/full_sync_coldfront.py', 'full_sync_{}.conf', [
+        ('api', r'^gathering accounts from'),
+        ('sacct', r'^gathering jobs from slurmdb'),
+        ('push', r'^(DEBUG: collected|updating mybrcdb with) (\d+) jobs'),
+        (None, r'run complete'),
+    ]),
+    'sync_running': ('sync-brcdb/sync_running_jobs.py', 'sync_running_jobs_{}.conf', [
+        ('api', r'^gathering running jobs from'),
+        ('sacct_parse', r'^gathering latest state from slurmdb'),
+        ('push', r'^(DEBUG: collected|updating mybrcdb with) (\d+) jobs'),
+        (None, r'run complete'),
+    ]),
+}
+
+JOBS_PATTERN = re.compile(r'^(DEBUG: collected|updating mybrcdb with) (\d+) jobs')
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR)
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--', 'sync-brcdb'], cwd=REPO_DIR)
+        return out.decode('utf-8').strip() + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_script(name, python, env, workdir, api_url, price_file, mode, push, verbose):
+    path, _, markers = SCRIPTS[name]
+    log_name = os.path.basename(path)[:-len('.py')].replace('_coldfront', '')
+    command = [python, '-u', os.path.join(REPO_DIR, path), '-T', mode,
+               '--API_URL', api_url, '--PRICE_FILE', price_file]
+    if push:
+        command.append('--PUSH')
+
+    started = time.time()
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    seen = []
+    jobs = None
+    compiled = [(phase, re.compile(pattern)) for phase, pattern in markers]
+    for raw in iter(process.stdout.readline, b''):
+        now = time.time()
+        line = raw.decode('utf-8', 'replace').rstrip()
+        if verbose:
+            print('  [{:8.3f}] {}'.format(now - started, line))
+
+        match = JOBS_PATTERN.search(line)
+        if match:
+            jobs = int(match.group(2))
+
+        for index, (phase, pattern) in enumerate(compiled):
+            if pattern.search(line) and index not in [i for i, _ in seen]:
+                seen.append((index, now))
+                break
+
+    status = process.wait()
+    finished = time.time()
+
+    phases = {}
+    seen.append((len(compiled), finished))
+    for (index, at), (_, until) in zip(seen, seen[1:]):
+        phase = compiled[index][0] if index < len(compiled) else None
+        if phase == 'push' and not push:
+            phase = 'log'  # DEBUG runs only log what they would push
+        if phase:
+            phases[phase] = round(until - at, 4)
+
+    # prefer the script's own run summary (bankutils.metrics) over stdout timestamps
+    summary_path = os.path.join(workdir, '{}_{}{}_summary.json'.format(log_name, mode, '' if push else '_debug'))
+    if os.path.exists(summary_path):
+        with open(summary_path, 'r') as f:
+            summary = json.load(f)
+        phases = {}
+        for phase, values in summary['phases'].items():
+            phases[phase] = round(values['wall_seconds'], 4)
+        if 'parse' in phases:
+            phases['parse_price'] = phases.pop('parse')
+        os.remove(summary_path)
+
+    result = {'status': status, 'wall': round(finished - started, 4), 'phases': phases, 'jobs': jobs}
+    if jobs and phases.get('parse_price'):
+        result['parse_price_jobs_per_sec'] = round(jobs / phases['parse_price'], 1)
+    if jobs and push and phases.get('push'):
+        result['push_jobs_per_sec'] = round(jobs / phases['push'], 1)
+    return result
+
+
+def previous_result(history, record):
+    if not os.path.exists(history):
+        return None
+
+    previous = None
+    with open(history, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('script') == record['script'] and entry.get('scale') == record['scale'] \
+                    and entry.get('commit') != record['commit']:
+                previous = entry
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--script', choices=sorted(SCRIPTS), default='full_sync')
+    parser.add_argument('-T', dest='mode', choices=[fake_slurm.MODE_MYBRC, fake_slurm.MODE_MYLRC],
+                        default=fake_slurm.MODE_MYBRC)
+    parser.add_argument('--accounts', type=int, default=50)
+    parser.add_argument('--jobs-per-account', type=int, default=2000)
+    parser.add_argument('--python', default='python2',
+                        help='interpreter used to run the sync script (default: python2)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--push', action='store_true', help='also benchmark pushing to the stand-in API')
+    parser.add_argument('--history', default=os.path.join(BENCH_DIR, 'bench_history.jsonl'),
+                        help='file to append results to (json lines)')
+    parser.add_argument('-v', dest='verbose', action='store_true', help='echo script output')
+    parsed = parser.parse_args()
+
+    if parsed.accounts < 10:
+        parser.error('--accounts must be at least 10 (the scripts report progress in tenths)')
+
+    env = dict(os.environ)
+    env.update({
+        'PATH': os.path.join(BENCH_DIR, 'bin') + os.pathsep + env.get('PATH', ''),
+        'FAKE_SLURM_MODE': parsed.mode,
+        'FAKE_SLURM_ACCOUNTS': str(parsed.accounts),
+        'FAKE_SLURM_JOBS_PER_ACCOUNT': str(parsed.jobs_per_account),
+        # data ends at midnight today, so the scripts' default allocation periods overlap it
+        'FAKE_SLURM_NOW': str(int(time.time()) // 86400 * 86400),
+    })
+    config = fake_slurm.Config(env)
+
+    workdir = tempfile.mkdtemp(prefix='bench_sync_')
+    env['FAKE_SLURM_STATE'] = os.path.join(workdir, 'slurm_state.json')
+    try:
+        _, config_template, _ = SCRIPTS[parsed.script]
+        with open(os.path.join(workdir, config_template.format(parsed.mode)), 'w') as f:
+            f.write('Token bench\n')
+
+        price_file = os.path.join(workdir, 'bank-config.toml')
+        with open(price_file, 'w') as f:
+            f.write(config.price_file())
+
+        record = {'script': parsed.script, 'commit': git_commit(), 'python': parsed.python,
+                  'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'scale': {'accounts': parsed.accounts, 'jobs_per_account': parsed.jobs_per_account,
+                            'mode': parsed.mode, 'push': parsed.push},
+                  'runs': []}
+
+        for run in range(parsed.repeat):
+            # fresh server per run, so pushed updates from one run don't leak into the next
+            server, api_url = fake_api.serve(config=config)
+            result = run_script(parsed.script, parsed.python, env, workdir, api_url, price_file,
+                                parsed.mode, parsed.push, parsed.verbose)
+            result['api_requests'] = server.RequestHandlerClass.store.requests
+            server.shutdown()
+
+            record['runs'].append(result)
+            print('run {}: {}'.format(run + 1, json.dumps(result, sort_keys=True)))
+            if result['status'] != 0:
+                print('script exited with status {}, see {}'.format(result['status'], workdir))
+                return result['status']
+
+        rates = [run['parse_price_jobs_per_sec'] for run in record['runs'] if 'parse_price_jobs_per_sec' in run]
+        if rates:
+            record['parse_price_jobs_per_sec'] = max(rates)
+            print('parse/price throughput: {:.1f} jobs/s (best of {})'.format(max(rates), len(rates)))
+
+            previous = previous_result(parsed.history, record)
+            if previous and previous.get('parse_price_jobs_per_sec'):
+                change = (max(rates) / previous['parse_price_jobs_per_sec'] - 1) * 100
+                print('previous: {:.1f} jobs/s at {} ({:+.1f}%)'.format(
+                    previous['parse_price_jobs_per_sec'], previous['commit'], change))
+
+        with open(parsed.history, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
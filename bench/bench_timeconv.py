@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+'''
+Micro-benchmarks for bankutils.timeconv.
+
+Times the per-job conversions of the sync scripts (three sacct timestamps per
+job: parse, format and duration) the old way (strptime/datetime) and with
+bankutils.timeconv, both on formatted sacct times and on epoch times
+(SLURM_TIME_FORMAT=%s), and projects the cost of a full sync.
+
+usage: python bench_timeconv.py [-n 200000] [--full-sync-timestamps 6000000]
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import calendar
+import datetime
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from bankutils import timeconv  # noqa: E402
+
+timestamp_format_complete = '%Y-%m-%dT%H:%M:%S'
+timestamp_format_minimal = '%Y-%m-%d'
+
+
+# the conversions the sync scripts used before bankutils.timeconv
+def to_timestamp(date_time, to_utc=False):
+    try:
+        dt_obj = datetime.datetime.strptime(date_time, timestamp_format_complete)
+    except ValueError:
+        dt_obj = datetime.datetime.strptime(date_time, timestamp_format_minimal)
+
+    if to_utc:
+        return time.mktime(dt_obj.timetuple())
+
+    else:
+        return calendar.timegm(dt_obj.timetuple())
+
+
+def to_timestring(timestamp):
+    date_time = datetime.datetime.utcfromtimestamp(timestamp)
+    return date_time.strftime(timestamp_format_complete), date_time
+
+
+def strptime_job(submit, start, end):
+    submit, _ = to_timestring(to_timestamp(submit, to_utc=False))
+    start, _start = to_timestring(to_timestamp(start, to_utc=False))
+    end, _end = to_timestring(to_timestamp(end, to_utc=False))
+    return submit, start, end, (_end - _start).total_seconds()
+
+
+def timeconv_job(submit, start, end):
+    _start, _end = timeconv.sacct_timestamp(start), timeconv.sacct_timestamp(end)
+    submit = timeconv.format_timestamp(timeconv.sacct_timestamp(submit))
+    start, end = timeconv.format_timestamp(_start), timeconv.format_timestamp(_end)
+    return submit, start, end, _end - _start
+
+
+def sample_jobs(count, seed=0):
+    '''(submit, start, end) epochs spread over a year, like a full sync'''
+    rng = random.Random(seed)
+    base = calendar.timegm((2023, 6, 1, 0, 0, 0))
+    jobs = []
+    for _ in range(count):
+        submit = base + rng.randint(0, 365 * 86400)
+        start = submit + rng.randint(0, 3600)
+        jobs.append((submit, start, start + rng.randint(1, 3 * 86400)))
+    return jobs
+
+
+def measure(name, function, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        for row in rows:
+            function(*row)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return name, best / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', dest='jobs', type=int, default=200000, help='jobs per measurement')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--full-sync-timestamps', type=int, default=6000000,
+                        help='timestamps in a full sync, for the projected cost')
+    parsed = parser.parse_args()
+
+    epochs = sample_jobs(parsed.jobs)
+    # sacct formats times in the local zone
+    formatted = [tuple(timeconv.format_timestamp(timeconv.utc2local(value)) for value in row) for row in epochs]
+    as_sacct = [tuple(str(value) for value in row) for row in epochs]
+
+    # they must agree before their timings mean anything. The old conversions kept sacct's local wall time,
+    # the same as timeconv's utc only when the local zone is utc
+    utc = not any(timeconv.utc_offset(value) for row in epochs[:1000] for value in row)
+    for row, text in zip(as_sacct[:1000], formatted[:1000]):
+        assert timeconv_job(*text) == timeconv_job(*row), (row, text)
+        assert not utc or strptime_job(*text) == timeconv_job(*text), (row, text)
+
+    results = [
+        measure('strptime, formatted sacct times', strptime_job, formatted, parsed.repeat),
+        measure('timeconv, formatted sacct times', timeconv_job, formatted, parsed.repeat),
+        measure('timeconv, epoch sacct times', timeconv_job, as_sacct, parsed.repeat),
+        measure('timeconv.parse_timestamp', timeconv.parse_timestamp,
+                [(row[0],) for row in formatted], parsed.repeat),
+        measure('timeconv.parse_timestamp(local=True)', lambda value: timeconv.parse_timestamp(value, local=True),
+                [(row[0],) for row in formatted], parsed.repeat),
+        measure('timeconv.format_timestamp', timeconv.format_timestamp,
+                [(row[0],) for row in epochs], parsed.repeat),
+        measure('timeconv.utc2local', timeconv.utc2local, [(row[0],) for row in epochs], parsed.repeat),
+    ]
+
+    jobs = parsed.full_sync_timestamps / 3.0
+    print('{:<40} {:>12} {:>22}'.format('', 'us per call', 'full sync ({:.1f}M ts)'.format(
+        parsed.full_sync_timestamps / 1e6)))
+    for name, seconds in results:
+        calls = jobs if name.startswith(('strptime', 'timeconv,')) else parsed.full_sync_timestamps
+        print('{:<40} {:>12.2f} {:>21.1f}s'.format(name, seconds * 1e6, seconds * calls))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
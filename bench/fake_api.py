@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+'''
+Stand-in MyBRC/MyLRC API server, backed by fake_slurm.py.
+
+Serves the endpoints the scripts use (projects/, allocations/,
+allocations/<id>/attributes/, allocation_users/, jobs/ and jobs/<id>/) with
+DRF-style pagination, or a keyset cursor for jobs/. Jobs are derived from the
+same generator as the fake `sacct`, except that a configurable fraction is
+still RUNNING in the API after slurm finished them, and a fraction never
+reached the API at all. GETs answer conditional requests (ETag,
+Last-Modified) with 304 Not Modified, and larger responses are gzipped for
+clients that accept it.
+
+usage: python fake_api.py [--port 8000]
+'''
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import bisect
+import random
+import hashlib
+import argparse
+import calendar
+import threading
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import urlencode
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, urlencode
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import fake_slurm  # noqa: E402
+from bankutils import jobs  # noqa: E402
+
+
+COMPUTE_RESOURCES = {
+    fake_slurm.MODE_MYBRC: 'Savio Compute',
+    fake_slurm.MODE_MYLRC: 'LAWRENCIUM Compute',
+}
+
+
+def timestring(epoch):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch)) if epoch is not None else None
+
+
+KEYSET_ORDERING = 'startdate,jobslurmid'
+
+
+def keyset_key(job):
+    '''where a job sorts in a keyset listing, job ids compare as numbers'''
+    return job['startdate'] or '', int(job['jobslurmid'])
+
+
+def parse_cursor(after):
+    '''keyset_key of an after=<startdate>,<jobslurmid> cursor'''
+    startdate, _, jobid = after.rpartition(',')
+    return startdate, int(jobid)
+
+
+class Store(object):
+    '''API-side view of the generated data, plus whatever has been PUT since startup'''
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.updates = {}
+        self.created = []  # jobs the API didn't have until they were PUT, in jobs() form
+        self.query_cache = {}
+        self.page_size = int(os.environ.get('FAKE_API_PAGE_SIZE', 100))
+        self.fail_permille = int(os.environ.get('FAKE_API_FAIL_PERMILLE', 0))
+        self.latency = float(os.environ.get('FAKE_API_LATENCY_MS', 0)) / 1000
+        self.truncate_permille = int(os.environ.get('FAKE_API_TRUNCATE_PERMILLE', 0))
+        self.requests = 0
+        self.not_modified = 0
+        self.modified = int(time.time())  # Last-Modified of every response, bumped by PUTs
+        self._jobs = None
+        self._jobids = None
+
+    def api_state(self, job):
+        '''the state the API believes a job is in, None if it never got the job'''
+        permille = (job.hash >> 1) % 1000
+        if permille < self.config.api_missing_permille:
+            return None
+        if job.state == 'PENDING':
+            return None
+        if job.state == 'RUNNING' or (job.hash >> 11) % 1000 < self.config.api_stale_permille:
+            return 'RUNNING'
+        return job.state
+
+    def api_job(self, job, state):
+        config = self.config
+        elapsed = job.elapsed(config.now) if state != 'RUNNING' else 0
+        hours = elapsed / 3600.0
+        return {
+            'jobslurmid': str(job.jobid),
+            'submitdate': timestring(job.submit),
+            'startdate': timestring(job.start),
+            'enddate': timestring(job.end) if state != 'RUNNING' else None,
+            'userid': 'user{}'.format(job.uid),
+            'accountid': job.account,
+            'amount': '{:.2f}'.format(round(job.price * job.cpus * hours, 2)),
+            'jobstatus': state,
+            'partition': job.partition,
+            'qos': job.qos,
+            'nodes': [{'name': name} for name in jobs.expand_node_list(job.nodelist)],
+            'num_cpus': job.cpus,
+            'num_req_nodes': max(1, job.nodes),
+            'num_alloc_nodes': job.nodes,
+            'raw_time': hours,
+            'cpu_time': hours * job.cpus,
+        }
+
+    def jobs(self):
+        '''all jobs known to the API as (jobid, account, user, start, job dict) tuples'''
+        with self.lock:
+            if self._jobs is None:
+                jobs = []
+                for job in fake_slurm.iter_jobs(self.config):
+                    state = self.api_state(job)
+                    if state is None:
+                        continue
+                    record = self.api_job(job, state)
+                    jobs.append((job.jobid, job.account, record['userid'],
+                                 job.start if job.start is not None else job.submit, record))
+                self._jobs = jobs
+                self._jobids = set(job[0] for job in jobs)
+            return self._jobs
+
+    def query_jobs(self, params):
+        return self._query(params)[0]
+
+    def query_totals(self, params):
+        return self._query(params)[1]
+
+    def query_keyset(self, params):
+        '''(jobs ordered by (startdate, jobslurmid), their sort keys) of a jobs/ query'''
+        key = (self._query_key(params), 'keyset')
+        with self.lock:
+            if key in self.query_cache:
+                return self.query_cache[key]
+
+        ordered = sorted(self.query_jobs(params), key=keyset_key)
+        result = ordered, [keyset_key(job) for job in ordered]
+        with self.lock:
+            self.query_cache[key] = result
+        return result
+
+    def _query_key(self, params):
+        return tuple(sorted((k, v) for k, v in params.items()
+                            if k not in ('page', 'page_size', 'fields', 'ordering', 'after')))
+
+    def _query(self, params):
+        '''(jobs, totals) of a jobs/ query'''
+        key = self._query_key(params)
+        with self.lock:
+            if key in self.query_cache:
+                return self.query_cache[key]
+
+        start = float(params['start_time']) if params.get('start_time') else None
+        end = float(params['end_time']) if params.get('end_time') else None
+        account = params.get('account')
+        user = params.get('user')
+        status = params.get('jobstatus')
+
+        results = []
+        for jobid, job_account, job_user, job_start, record in self.jobs() + self.created:
+            record = self.updates.get(jobid, record)
+            if account and job_account != account:
+                continue
+            if user and job_user != user:
+                continue
+            if start is not None and job_start < start:
+                continue
+            if end is not None and job_start > end:
+                continue
+            if status and record['jobstatus'] != status:
+                continue
+            results.append(record)
+
+        totals = {'total_cpu_time': sum(job['cpu_time'] for job in results if job['cpu_time']),
+                  'total_amount': '{:.2f}'.format(sum(float(job['amount']) for job in results))}
+        with self.lock:
+            self.query_cache[key] = results, totals
+        return results, totals
+
+    def update_job(self, jobid, fields):
+        record = dict((key, values[-1]) for key, values in fields.items())
+        record['jobslurmid'] = str(jobid)
+        for key, kind in (('raw_time', float), ('cpu_time', float), ('num_cpus', int),
+                          ('num_req_nodes', int), ('num_alloc_nodes', int)):
+            if key in record:
+                record[key] = kind(record[key])  # form values are strings, totals need numbers
+        self.jobs()
+        with self.lock:
+            if int(jobid) not in self._jobids and int(jobid) not in self.updates:
+                start = record.get('startdate') or record.get('submitdate')
+                start = calendar.timegm(time.strptime(start[:19], '%Y-%m-%dT%H:%M:%S')) if start else 0
+                self.created.append((int(jobid), record.get('accountid'), record.get('userid'), start, record))
+            self.updates[int(jobid)] = record
+            self.query_cache.clear()
+            self.modified = int(time.time())
+        return record
+
+    def projects(self):
+        return [{'id': index + 1, 'name': name, 'status': 'Active', 'title': name}
+                for index, name in enumerate(self.config.account_names())]
+
+    def allocation(self, index):
+        config = self.config
+        return {'id': index + 1, 'project': config.account_name(index),
+                'resources': [COMPUTE_RESOURCES[config.mode]], 'status': 'Active',
+                'start_date': timestring(fake_slurm.allocation_start(config, index)).replace('Z', '.000000Z'),
+                'end_date': None}
+
+    def allocations(self, params):
+        allocations = [self.allocation(index) for index in range(self.config.accounts)]
+        if params.get('project'):
+            allocations = [a for a in allocations if a['project'] == params['project']]
+        if params.get('resources'):
+            allocations = [a for a in allocations if params['resources'] in a['resources']]
+        return allocations
+
+    def attributes(self, allocation_id, params):
+        index = allocation_id - 1
+        if index < 0 or index >= self.config.accounts:
+            return None
+
+        usage = 0.0
+        for record in self.query_jobs({'account': self.config.account_name(index)}):
+            usage += float(record['amount'])
+
+        attribute = {'id': allocation_id, 'allocation': allocation_id, 'type': 'Service Units',
+                     'value': '{:.2f}'.format(fake_slurm.allocation(self.config, index)),
+                     'usage': {'value': '{:.2f}'.format(usage)}}
+        if params.get('type') and params['type'] != attribute['type']:
+            return []
+        return [attribute]
+
+    def allocation_users(self, params):
+        users = []
+        for index, name in enumerate(self.config.account_names()):
+            if params.get('project') and params['project'] != name:
+                continue
+            for uid in self.config.account_uids(index):
+                user = 'user{}'.format(uid)
+                if params.get('user') and params['user'] != user:
+                    continue
+                users.append({'id': len(users) + 1, 'allocation': index + 1, 'project': name,
+                              'user': user, 'status': 'Active'})
+        return users
+
+
+class Handler(BaseHTTPRequestHandler):
+    store = None
+    protocol_version = 'HTTP/1.1'  # keep-alive, every response has a Content-Length
+
+    def log_message(self, format, *args):
+        if os.environ.get('FAKE_API_VERBOSE'):
+            request_id = self.headers.get('X-Request-ID') if getattr(self, 'headers', None) else None
+            if request_id:
+                format += ' [%s]'
+                args += (request_id,)
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def not_modified(self, etag, modified):
+        '''whether the client's copy (If-None-Match, or else If-Modified-Since) is still current'''
+        if self.headers.get('If-None-Match'):
+            tags = [tag.strip() for tag in self.headers.get('If-None-Match').split(',')]
+            return etag in tags or '*' in tags
+
+        since = parsedate_tz(self.headers.get('If-Modified-Since') or '')
+        return since is not None and mktime_tz(since) >= modified
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        validators = []
+        if self.command == 'GET' and status == 200:
+            modified = self.store.modified
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            validators = [('ETag', etag), ('Last-Modified', formatdate(modified, usegmt=True))]
+            if self.not_modified(etag, modified):
+                self.store.not_modified += 1
+                status, body = 304, b''
+
+        # gzipped like the API's GZipMiddleware does: bodies of 200+ bytes, for clients that accept it
+        gzipped = status == 200 and len(body) >= 200 and 'gzip' in (self.headers.get('Accept-Encoding') or '')
+        if gzipped:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+        # the connection drops part way through the body
+        truncated = status == 200 and random.randrange(1000) < self.store.truncate_permille
+
+        self.send_response(status)
+        for name, value in validators:
+            self.send_header(name, value)
+        if self.headers.get('X-Request-ID'):
+            self.send_header('X-Request-ID', self.headers.get('X-Request-ID'))
+        if status != 304:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if truncated:
+            self.close_connection = True
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+    def route(self):
+        parsed = urlparse(self.path)
+        path = re.sub('/+', '/', parsed.path).strip('/').split('/')
+        if path and path[0] == 'api':
+            path = path[1:]
+        params = dict((key, values[-1]) for key, values in parse_qs(parsed.query).items())
+        return path, params
+
+    def paginate(self, path, params, results, extra=None):
+        try:
+            page = int(params.get('page', 1))
+            size = int(params.get('page_size', self.store.page_size))
+        except ValueError:
+            return self.send_json(404, {'detail': 'Invalid page.'})
+
+        pages = max(1, (len(results) + size - 1) // size)
+        if page < 1 or page > pages:
+            return self.send_json(404, {'detail': 'Invalid page.'})
+
+        def link(number):
+            query = dict(params, page=number)
+            return 'http://{}/api/{}/?{}'.format(self.headers.get('Host'), '/'.join(path), urlencode(query))
+
+        results_page = results[(page - 1) * size:page * size]
+        if params.get('fields'):  # ?fields=a,b only returns these fields of each result
+            names = params['fields'].split(',')
+            results_page = [dict((name, result[name]) for name in names if name in result) for result in results_page]
+
+        payload = {'count': len(results),
+                   'next': link(page + 1) if page < pages else None,
+                   'previous': link(page - 1) if page > 1 else None,
+                   'results': results_page}
+        payload.update(extra or {})
+        return self.send_json(200, payload)
+
+    def paginate_keyset(self, path, params, results, keys, extra=None):
+        '''one page of the results after the after= cursor, found by bisecting on the keys'''
+        try:
+            size = int(params.get('page_size', self.store.page_size))
+            start = bisect.bisect_right(keys, parse_cursor(params['after'])) if params.get('after') else 0
+        except ValueError:
+            return self.send_json(400, {'detail': 'Invalid cursor.'})
+
+        results_page = results[start:start + size]
+        query = dict((key, value) for key, value in params.items() if key != 'page')
+        if results_page and start + size < len(results):
+            last = results_page[-1]
+            query['after'] = '{},{}'.format(last['startdate'] or '', last['jobslurmid'])
+            next_link = 'http://{}/api/{}/?{}'.format(self.headers.get('Host'), '/'.join(path), urlencode(query))
+        else:
+            next_link = None
+
+        if params.get('fields'):
+            names = params['fields'].split(',')
+            results_page = [dict((name, result[name]) for name in names if name in result) for result in results_page]
+
+        payload = {'count': len(results), 'next': next_link, 'previous': None, 'results': results_page}
+        payload.update(extra or {})
+        return self.send_json(200, payload)
+
+    def do_GET(self):
+        self.store.requests += 1
+        if self.store.latency:  # round trip to a remote API
+            time.sleep(self.store.latency)
+
+        if not self.headers.get('Authorization'):
+            return self.send_json(401, {'detail': 'Authentication credentials were not provided.'})
+
+        if random.randrange(1000) < self.store.fail_permille:  # transient backend errors
+            return self.send_json(503, {'detail': 'Service temporarily unavailable.'})
+
+        path, params = self.route()
+        store = self.store
+        if path == ['projects']:
+            return self.paginate(path, params, store.projects())
+
+        if path == ['allocations']:
+            return self.paginate(path, params, store.allocations(params))
+
+        if len(path) == 3 and path[0] == 'allocations' and path[2] == 'attributes':
+            attributes = store.attributes(int(path[1]), params)
+            if attributes is None:
+                return self.send_json(404, {'detail': 'Not found.'})
+            return self.paginate(path, params, attributes)
+
+        if path == ['allocation_users']:
+            return self.paginate(path, params, store.allocation_users(params))
+
+        if path == ['jobs'] and params.get('ordering') == KEYSET_ORDERING:
+            results, keys = store.query_keyset(params)
+            return self.paginate_keyset(path, params, results, keys, store.query_totals(params))
+
+        if path == ['jobs']:
+            return self.paginate(path, params, store.query_jobs(params), store.query_totals(params))
+
+        return self.send_json(404, {'detail': 'Not found.'})
+
+    def do_PUT(self):
+        self.store.requests += 1
+        if not self.headers.get('Authorization'):
+            return self.send_json(401, {'detail': 'Authentication credentials were not provided.'})
+
+        path, _ = self.route()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        if len(path) == 2 and path[0] == 'jobs' and path[1].isdigit():
+            return self.send_json(200, self.store.update_job(path[1], parse_qs(body)))
+
+        return self.send_json(404, {'detail': 'Not found.'})
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port=0, config=None):
+    '''start the stand-in API on a background thread, returns (server, base url)'''
+    handler = type('BoundHandler', (Handler,), {'store': Store(config or fake_slurm.Config())})
+    server = Server(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}/api/'.format(server.server_address[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parsed = parser.parse_args()
+
+    server, url = serve(parsed.port)
+    print('serving stand-in API on {}'.format(url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
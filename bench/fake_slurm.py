@@ -0,0 +1,290 @@
+'''
+Deterministic stand-in for the slurm accounting db.
+
+Every job is a pure function of its job id, so `sacct -A`, `sacct -j` and the
+stand-in API (fake_api.py) all agree on the same data without sharing state.
+Scale and shape are controlled through FAKE_SLURM_* environment variables.
+'''
+import os
+import time
+import calendar
+
+
+MODE_MYBRC = 'mybrc'
+MODE_MYLRC = 'mylrc'
+
+JOBID_BASE = 1000000
+MAX_DURATION = 3 * 24 * 3600
+timestamp_format_complete = '%Y-%m-%dT%H:%M:%S'
+
+PARTITIONS = {
+    MODE_MYBRC: [('savio', 0.75), ('savio2', 1.0), ('savio2_htc', 1.2), ('savio2_gpu', 2.67),
+                 ('savio3', 1.0), ('savio3_htc', 1.2), ('savio3_gpu', 3.67), ('savio4_htc', 1.0)],
+    MODE_MYLRC: [('lr3', 1.0), ('lr4', 1.0), ('lr5', 1.0), ('lr6', 1.0),
+                 ('es1', 2.0), ('cf1', 0.5), ('cm1', 0.75)],
+}
+
+QOS = {
+    MODE_MYBRC: ['savio_normal', 'savio_debug', 'savio_lowprio'],
+    MODE_MYLRC: ['lr_normal', 'lr_debug', 'lr_lowprio'],
+}
+
+PREFIXES = {
+    MODE_MYBRC: ['fc', 'co', 'ac', 'ic', 'pc'],
+    MODE_MYLRC: ['pc', 'lr', 'ac'],
+}
+
+CPUS_PER_NODE = [20, 24, 32, 40, 56]
+
+# (cumulative permille, state) for jobs that have ended
+END_STATES = [(760, 'COMPLETED'), (850, 'FAILED'), (910, 'CANCELLED by {uid}'),
+              (950, 'TIMEOUT'), (975, 'OUT_OF_MEMORY'), (985, 'NODE_FAIL'),
+              (995, 'REQUEUED'), (1000, 'DEADLINE')]
+
+STATE_ABBREVIATIONS = {
+    'R': 'RUNNING', 'PD': 'PENDING', 'CD': 'COMPLETED', 'F': 'FAILED', 'CA': 'CANCELLED',
+    'TO': 'TIMEOUT', 'OOM': 'OUT_OF_MEMORY', 'NF': 'NODE_FAIL', 'RQ': 'REQUEUED',
+    'DL': 'DEADLINE', 'CG': 'COMPLETING',
+}
+
+FIELDS = ['JobID', 'JobIDRaw', 'Submit', 'Start', 'End', 'UID', 'User', 'Account', 'State',
+          'Partition', 'QOS', 'NodeList', 'AllocCPUS', 'NCPUS', 'ReqNodes', 'AllocNodes',
+          'NNodes', 'CPUTimeRAW', 'CPUTime', 'Elapsed', 'ElapsedRaw']
+
+
+def _env_int(env, name, default):
+    return int(env.get(name, default))
+
+
+def _env_time(env, name, default):
+    value = env.get(name)
+    if not value:
+        return default
+    if value == 'now':
+        return int(time.time())
+    if value.isdigit():
+        return int(value)
+    return calendar.timegm(time.strptime(value, timestamp_format_complete))
+
+
+class Config(object):
+    '''scale / shape knobs, read from the environment'''
+
+    def __init__(self, env=None):
+        env = os.environ if env is None else env
+
+        self.mode = env.get('FAKE_SLURM_MODE', MODE_MYBRC)
+        self.accounts = _env_int(env, 'FAKE_SLURM_ACCOUNTS', 20)
+        self.jobs_per_account = _env_int(env, 'FAKE_SLURM_JOBS_PER_ACCOUNT', 500)
+        self.users_per_account = _env_int(env, 'FAKE_SLURM_USERS_PER_ACCOUNT', 8)
+        self.span = _env_int(env, 'FAKE_SLURM_SPAN_DAYS', 365) * 24 * 3600
+
+        # jobs are spread over [start, start + span], and the ones still going at `now` are RUNNING
+        if env.get('FAKE_SLURM_NOW'):
+            self.now = _env_time(env, 'FAKE_SLURM_NOW', None)
+            self.start = _env_time(env, 'FAKE_SLURM_START', self.now - self.span)
+        else:
+            self.start = _env_time(env, 'FAKE_SLURM_START', calendar.timegm((2023, 6, 1, 0, 0, 0)))
+            self.now = self.start + self.span
+
+        # fraction (permille) of jobs the API still believes are RUNNING after they ended,
+        # and of jobs that never reached the API at all
+        self.api_stale_permille = _env_int(env, 'FAKE_API_STALE_PERMILLE', 30)
+        self.api_missing_permille = _env_int(env, 'FAKE_API_MISSING_PERMILLE', 5)
+
+        self.partitions = PARTITIONS[self.mode]
+        self.qos = QOS[self.mode]
+        self.prefixes = PREFIXES[self.mode]
+
+    def total_jobs(self):
+        return self.accounts * self.jobs_per_account
+
+    def account_name(self, index):
+        prefix = self.prefixes[index % len(self.prefixes)]
+        return '{}_proj{:04d}'.format(prefix, index)
+
+    def account_names(self):
+        return [self.account_name(index) for index in range(self.accounts)]
+
+    def account_index(self, name):
+        try:
+            index = int(name.rsplit('proj', 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+        return index if 0 <= index < self.accounts and self.account_name(index) == name else None
+
+    def account_uids(self, index):
+        base = 40000 + index * self.users_per_account
+        return list(range(base, base + self.users_per_account))
+
+    def price_file(self):
+        lines = ['[PartitionPrice]', '# partition = price per cpu hour']
+        for name, price in self.partitions:
+            lines.append('{} = {}'.format(name, price))
+        return '\n'.join(lines) + '\n'
+
+    def job_range(self, account_index, start=None, end=None):
+        '''range of job indices (within an account) that may overlap [start, end]'''
+        per = self.jobs_per_account
+        slot = float(self.span) / per
+        low, high = 0, per
+        if start is not None:
+            low = max(0, int((start - MAX_DURATION - self.start) / slot) - 1)
+        if end is not None:
+            high = min(per, int((end - self.start) / slot) + 2)
+        return range(low, max(low, high))
+
+    def jobid(self, account_index, job_index):
+        return JOBID_BASE + account_index * self.jobs_per_account + job_index
+
+    def split_jobid(self, jobid):
+        offset = int(jobid) - JOBID_BASE
+        if offset < 0 or offset >= self.total_jobs():
+            return None
+        return divmod(offset, self.jobs_per_account)
+
+
+def _mix(value):
+    '''cheap 64 bit integer hash (splitmix64 finalizer)'''
+    value = (value + 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+    return value ^ (value >> 31)
+
+
+def node_list(partition, first, count, gap):
+    '''slurm-style compressed nodelist, e.g. n0012.savio3 or n[0100-0103,0110].savio3'''
+    suffix = partition.split('_')[0]
+    if count == 1:
+        return 'n{:04d}.{}'.format(first, suffix)
+
+    if not gap:
+        return 'n[{:04d}-{:04d}].{}'.format(first, first + count - 1, suffix)
+
+    head = count - 1
+    ranges = '{:04d}'.format(first) if head == 1 else '{:04d}-{:04d}'.format(first, first + head - 1)
+    return 'n[{},{:04d}].{}'.format(ranges, first + head + gap, suffix)
+
+
+def format_duration(seconds):
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return '{}-{:02d}:{:02d}:{:02d}'.format(days, hours, minutes, seconds)
+    return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+class Job(object):
+    __slots__ = ('jobid', 'account_index', 'account', 'uid', 'submit', 'start', 'end', 'state',
+                 'partition', 'price', 'qos', 'nodelist', 'cpus', 'nodes', 'hash')
+
+    def elapsed(self, now):
+        if self.start is None:
+            return 0
+        return (self.end if self.end is not None else now) - self.start
+
+    def base_state(self):
+        '''state without the "by <uid>" suffix'''
+        return self.state.split(' ', 1)[0]
+
+
+def make_job(config, account_index, job_index):
+    jobid = config.jobid(account_index, job_index)
+    h = _mix(jobid)
+
+    job = Job()
+    job.jobid = jobid
+    job.hash = h
+    job.account_index = account_index
+    job.account = config.account_name(account_index)
+
+    uids = config.account_uids(account_index)
+    job.uid = uids[(h >> 8) % len(uids)]
+
+    slot = float(config.span) / config.jobs_per_account
+    job.submit = config.start + int(job_index * slot + (h >> 16) % max(1, int(slot)))
+    queued = (h >> 24) % 7200
+    duration = 30 + (h >> 32) % (MAX_DURATION - 30) if (h >> 12) % 10 == 0 else 30 + (h >> 32) % 14400
+
+    partition_index = (account_index + (h >> 40)) % len(config.partitions)
+    job.partition, job.price = config.partitions[partition_index]
+    job.qos = config.qos[0] if (h >> 44) % 8 else config.qos[(h >> 48) % len(config.qos)]
+
+    multi = (h >> 52) % 16 == 0
+    job.nodes = 1 + (h >> 56) % 8 if multi else 1
+    cores = CPUS_PER_NODE[(h >> 20) % len(CPUS_PER_NODE)]
+    if '_htc' in job.partition and not multi:
+        cores = 1 + (h >> 28) % 8
+    job.cpus = cores * job.nodes
+    first_node = 1 + (h >> 36) % 900
+    gap = (h >> 60) % 3 if job.nodes > 2 else 0
+
+    start = job.submit + queued
+    end = start + duration
+    if start > config.now:
+        job.start, job.end, job.state = None, None, 'PENDING'
+        job.nodelist = 'None assigned'
+        job.nodes = 0
+        return job
+
+    job.start = start
+    job.nodelist = node_list(job.partition, first_node, job.nodes, gap)
+    if end > config.now:
+        job.end, job.state = None, 'RUNNING'
+        return job
+
+    job.end = end
+    permille = (h >> 4) % 1000
+    for limit, state in END_STATES:
+        if permille < limit:
+            job.state = state.format(uid=job.uid)
+            break
+
+    return job
+
+
+def iter_jobs(config, accounts=None, start=None, end=None):
+    '''yield all jobs for the given account indices that may overlap [start, end]'''
+    indices = range(config.accounts) if accounts is None else accounts
+    for account_index in indices:
+        for job_index in config.job_range(account_index, start, end):
+            yield make_job(config, account_index, job_index)
+
+
+def get_job(config, jobid):
+    split = config.split_jobid(jobid)
+    return make_job(config, *split) if split else None
+
+
+def in_window(job, config, start, end, states=None):
+    '''sacct -S/-E/--state selection semantics'''
+    job_end = job.end if job.end is not None else config.now
+    if states:
+        if job.base_state() not in states:
+            return False
+
+        if job.state == 'PENDING':
+            return job.submit <= end
+        if job.state == 'RUNNING':
+            return job.start <= end and job_end >= start
+        return start <= job.end <= end
+
+    eligible = job.start if job.start is not None else job.submit
+    return eligible <= end and job_end >= start
+
+
+def amount(job, now):
+    hours = job.elapsed(now) / 3600.0
+    return round(job.price * job.cpus * hours, 2)
+
+
+def allocation(config, account_index):
+    '''Service Units allocated to an account'''
+    return (1 + _mix(account_index + 7) % 20) * 50000
+
+
+def allocation_start(config, account_index):
+    '''allocation start date of an account, as epoch'''
+    return config.start + (account_index % 30) * 86400
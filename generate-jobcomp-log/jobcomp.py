@@ -4,11 +4,15 @@ from collections import defaultdict
 import json
 import os
 import string
+import sys
 import time
 import urllib
 
 import urllib2
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from bankutils import ratelimit  # noqa: E402
+
 
 # staging is hit iff DBEUG is True
 # production is hit iff DEBUG is False
@@ -39,6 +43,9 @@ if DEBUG:
     DEBUG_TARGET += '' if MODE == MODE_MYBRC else ':8443'
     BASE_URL = 'https://{}/api/'.format(DEBUG_TARGET)
 
+# shared with the other scripts on this host
+LIMITER = ratelimit.RateLimiter.for_api(BASE_URL)
+
 FILE_NAME = 'jobcomp.log'
 timestamp_format = '%Y-%m-%dT%H:%M:%S'
 
@@ -86,7 +93,7 @@ def get_job_url(start, end, user, account, page=1):
 def paginate_req_table(url_function, params=[None, None, None, None]):
     req = urllib2.Request(url_function(*params))
     req.add_header('Authorization', AUTH_TOKEN)
-    response = json.loads(urllib2.urlopen(req).read())
+    response = json.loads(LIMITER.urlopen(req))
 
     yield response['results']
     page = 2
@@ -94,7 +101,7 @@ def paginate_req_table(url_function, params=[None, None, None, None]):
         try:
             req = urllib2.Request(url_function(*params, page=page))
             req.add_header('Authorization', AUTH_TOKEN)
-            response = json.loads(urllib2.urlopen(req).read())
+            response = json.loads(LIMITER.urlopen(req))
 
             yield response['results']
             page += 1
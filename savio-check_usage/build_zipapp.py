@@ -0,0 +1,78 @@
+#!/usr/bin/python
+'''
+Build check_usage_coldfront.py and the bankutils modules it uses into a single
+executable zip file.
+
+On login nodes the script and bankutils usually live on NFS, where every
+module is a few stat() and open() calls, and a bankutils/ that users can't
+write to is compiled again on every run. The zipapp is one file, opened once,
+with everything compiled ahead of time. Build it with the python that will run
+it, the bytecode is specific to the python version:
+
+    /usr/bin/python build_zipapp.py -o /usr/local/bin/check_usage.pyz
+
+check_usage_<mode>.conf is read from the directory the zipapp is in.
+'''
+import os
+import sys
+import stat
+import shutil
+import zipfile
+import argparse
+import tempfile
+import py_compile
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(SCRIPT_DIR)
+
+# the bankutils modules check_usage_coldfront.py imports, directly or not
+MODULES = ['__init__', 'allocations', 'coalesce', 'httppool', 'jsonstream', 'pagination', 'ratelimit', 'tasks',
+           'timeconv', 'tracing', 'usage']
+
+
+def compiled(source, name, workdir):
+    '''path of source compiled to bytecode, tracebacks show it as name'''
+    target = os.path.join(workdir, name.replace('/', '_') + 'c')
+    py_compile.compile(source, cfile=target, dfile=name, doraise=True)
+    return target
+
+
+def build(output, python):
+    workdir = tempfile.mkdtemp(prefix='check_usage_zipapp_')
+    try:
+        files = [(os.path.join(SCRIPT_DIR, 'check_usage_coldfront.py'), '__main__.py')]
+        files += [(os.path.join(REPO_DIR, 'bankutils', module + '.py'), 'bankutils/{}.py'.format(module))
+                  for module in MODULES]
+
+        partial = output + '.tmp'
+        with open(partial, 'wb') as f:
+            f.write('#!{}\n'.format(python).encode('utf-8'))
+
+        # the shebang line stays in front of the zip, zipimport reads from the end of the file
+        archive = zipfile.ZipFile(partial, 'a', zipfile.ZIP_DEFLATED)
+        try:
+            for source, name in files:
+                archive.write(compiled(source, name, workdir), name + 'c')
+        finally:
+            archive.close()
+
+        mode = os.stat(partial).st_mode
+        os.chmod(partial, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        os.rename(partial, output)
+    finally:
+        shutil.rmtree(workdir)
+
+    return [name for _, name in files]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', dest='output', default=os.path.join(SCRIPT_DIR, 'check_usage.pyz'),
+                        help='zipapp to write. default is check_usage.pyz next to this script')
+    parser.add_argument('--python', dest='python', default='/usr/bin/env python{}'.format(sys.version_info[0]),
+                        help='interpreter in the shebang line. default is python<major version of this python>')
+    parsed = parser.parse_args()
+
+    names = build(parsed.output, parsed.python)
+    print('wrote {} ({} modules, {} bytes) for python {}.{}'.format(
+        parsed.output, len(names), os.path.getsize(parsed.output), *sys.version_info[:2]))
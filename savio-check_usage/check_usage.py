@@ -4,11 +4,17 @@ import datetime
 import time
 import getpass
 import calendar
+import itertools
+import os
+import sys
 
 import urllib2
 import urllib
 import json
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from bankutils import pagination, ratelimit, timeconv, tracing  # noqa: E402
+
 
 DEBUG = False
 VERSION = 1.5
@@ -85,7 +91,7 @@ def get_account_start(account, user=None):
 
     try:
         req = urllib2.Request(url_transactions)
-        response = json.loads(urllib2.urlopen(req).read())['results']
+        response = json.loads(api_read(req))['results']
         target_start_date = response[0]['date_time']
     except urllib2.URLError:
         return None
@@ -98,15 +104,10 @@ def get_account_start(account, user=None):
 
 
 def utc2local(utc):
-    utc = datetime.datetime.utcfromtimestamp(utc)
-    epoch = time.mktime(utc.timetuple())
-    offset = datetime.datetime.fromtimestamp(epoch) - datetime.datetime.utcfromtimestamp(epoch)
-
-    local = utc + datetime.timedelta(hours=-7)  # + offset
-    local = time.mktime(local.timetuple())  # calendar.timegm(local.timetuple())
+    local = timeconv.utc2local(utc)
 
     if DEBUG:
-        print '[utc2local] utc_timestamp:', epoch, 'local_timestamp:', local
+        print '[utc2local] utc_timestamp:', utc, 'local_timestamp:', local
 
     return local
 
@@ -131,6 +132,8 @@ parser.add_argument('-e', dest='end', type=check_valid_date,
                     help='endtime for the query period (YYYY-MM-DD[THH:MM:SS])',
                     default=datetime.datetime.now()
                     .strftime(timestamp_format_complete))
+parser.add_argument('--trace', dest='trace', metavar='FILE',
+                    help='write a trace of the API requests to FILE (chrome trace-event json)')
 parsed = parser.parse_args()
 user = parsed.user
 account = parsed.account
@@ -140,6 +143,23 @@ _end = parsed.end
 start = to_timestamp(_start)
 end = to_timestamp(_end)
 
+TRACER = tracing.Tracer(parsed.trace)
+TRACER.install()
+RETRY = pagination.Retry(attempts=3, on_retry=TRACER.add_retry)
+LIMITER = ratelimit.RateLimiter.for_api(BASE_URL, interactive=True)
+
+
+def api_read(req):
+    '''the body of the response to req, sent once the rate limit allows it'''
+    with LIMITER.acquire() as ticket:
+        try:
+            body = TRACER.urlopen(req)
+        except urllib2.HTTPError as e:
+            ticket.status = e.code
+            raise
+        ticket.status = 200
+        return body
+
 default_start_used = _start == '{}-06-01T00:00:00'.format(default_start)
 calculate_account_start_hide_allocation = default_start_used and account and not user
 calculate_user_account_start = default_start_used and account and user
@@ -149,10 +169,8 @@ if calculate_account_start_hide_allocation:
     target_start_date = get_account_start(account)
     if target_start_date is not None:
         _start = target_start_date
-        _mystart = to_timestamp(_start)
-        _mystart = utc2local(_mystart)
-        _start = to_timestring(_mystart)
-        start = to_timestamp(_start)
+        start = utc2local(to_timestamp(_start))
+        _start = timeconv.format_timestamp(start)
     elif DEBUG:
         print('[get_account_start(account)] failed...')
 
@@ -161,10 +179,8 @@ if calculate_user_account_start:
     target_start_date = get_account_start(account, user)
     if target_start_date is not None:
         _start = target_start_date
-        _mystart = to_timestamp(_start)
-        _mystart = utc2local(_mystart)
-        _start = to_timestring(_mystart)
-        start = to_timestamp(_start)
+        start = utc2local(to_timestamp(_start))
+        _start = timeconv.format_timestamp(start)
     elif DEBUG:
         print('[get_account_start(account, user)] failed...')
 
@@ -271,8 +287,9 @@ def get_cpu_usage(user=None, account=None):
         urllib.urlencode(request_params)
 
     try:
-        req = urllib2.Request(req_url)
-        response = json.loads(urllib2.urlopen(req).read())
+        with TRACER.span('get_cpu_usage', url=req_url):
+            req = urllib2.Request(req_url)
+            response = json.loads(api_read(req))
     except urllib2.URLError:
         response = {'count': 0, 'total_cpu_time': 0, 'response': [], 'next': None}
 
@@ -295,7 +312,7 @@ def get_cpu_usage_old(user=None, account=None, page=1):
 
     try:
         req = urllib2.Request(req_url)
-        response = json.loads(urllib2.urlopen(req).read())
+        response = json.loads(api_read(req))
     except urllib2.URLError:
         response = {'next': None, 'response': []}
 
@@ -319,7 +336,7 @@ def get_account_allocation(account):
 
     try:
         req = urllib2.Request(req_url)
-        response = json.loads(urllib2.urlopen(req).read())
+        response = json.loads(api_read(req))
         response = response['results']
 
     except urllib2.URLError:
@@ -329,33 +346,38 @@ def get_account_allocation(account):
         return response[0]['allocation']  # best match
 
 
+def fetch_json(request_url):
+    return json.loads(api_read(urllib2.Request(request_url)))
+
+
 def paginate_requests(url_function, params):
-    req = urllib2.Request(url_function(*params))
-    response = json.loads(urllib2.urlopen(req).read())
+    '''yield the results of a paginated endpoint, one page at a time.
+    pages are retried, one that still fails raises URLError rather than ending the listing early'''
+    with TRACER.span('paginate_requests', endpoint=url_function.__name__, params=params):
+        response = RETRY.call(fetch_json, url_function(*params))
 
-    table = response['results']
-    page = 2
-    while response['next'] is not None:
-        try:
-            req = urllib2.Request(url_function(*params, page=page))
-            response = json.loads(urllib2.urlopen(req).read())
-            table.extend(response['results'])
-            page += 1
-        except urllib2.URLError:
-            response['next'] = None
+        page = 2
+        while True:
+            for result in response['results']:
+                yield result
 
-    return table
+            if response['next'] is None:
+                return
+
+            response = RETRY.call(fetch_json, url_function(*params, page=page))
+            page += 1
 
 
 def process_account_query():
-    response = paginate_requests(url_get_account_usages, [start, end, account])
-    response = response if len(response) != 0 else paginate_requests(url_get_zero_accounts, [account])
+    # only the first result is needed, so only the first page is requested
+    single = next(paginate_requests(url_get_account_usages, [start, end, account]), None)
+    if single is None:
+        single = next(paginate_requests(url_get_zero_accounts, [account]), None)
 
-    if len(response) == 0:
+    if single is None:
         print 'ERROR: Account', account, 'not defined.'
         return
 
-    single = response[0]
     if 'usage' not in single:
         usage = 0
         account_project = single['name']
@@ -433,15 +455,19 @@ def process_account_query():
 def process_user_query():
     zero_user = False
     response = paginate_requests(url_get_user_usages, [start, end, user])
+    first = next(response, None)
 
-    if len(response) == 0:
+    if first is None:
         response = paginate_requests(url_get_zero_users, [user])
+        first = next(response, None)
         zero_user = True
 
-    if len(response) == 0:
+    if first is None:
         print 'ERROR: User', user, 'not defined.'
         return
 
+    response = itertools.chain([first], response)
+
     usage = 0.0
     extended = []
     if not zero_user:
@@ -1,15 +1,41 @@
 #!/usr/bin/python
-import argparse
-import calendar
-import datetime
-import getpass
-import json
 import time
-import socket
-import urllib
-import os
+STARTED = time.time()  # --timings counts from here, the other imports included
 
-import urllib2
+import argparse  # noqa: E402
+import atexit  # noqa: E402
+import itertools  # noqa: E402
+import json  # noqa: E402
+import socket  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+if os.path.isfile(SCRIPT_DIR):  # run from the zipapp (build_zipapp.py), bankutils is in it
+    SCRIPT_DIR = os.path.dirname(SCRIPT_DIR)
+else:
+    sys.path.insert(0, os.path.join(SCRIPT_DIR, '..'))
+from bankutils import ratelimit, timeconv, tracing, usage  # noqa: E402
+
+# --timings: seconds spent per phase, lap(phase) adds the time since the previous lap to it
+TIMING_PHASES = ('import', 'config', 'network', 'render')
+timings = dict((phase, 0.0) for phase in TIMING_PHASES)
+last_lap = [STARTED]
+
+
+def lap(phase):
+    now = time.time()
+    timings[phase] += now - last_lap[0]
+    last_lap[0] = now
+
+
+def print_timings():
+    sys.stderr.write('timings: {}, total {:.1f}ms\n'.format(
+        ', '.join('{} {:.1f}ms'.format(phase, timings[phase] * 1000) for phase in TIMING_PHASES),
+        (time.time() - STARTED) * 1000))
+
+
+lap('import')
 
 
 # TOGGLES:
@@ -26,56 +52,33 @@ docstr = '''
 '''.format(VERSION)
 
 # get runtime information
-MODE_MYBRC = 'mybrc'
-MODE_MYLRC = 'mylrc'
+MODE_MYBRC = usage.MODE_MYBRC
+MODE_MYLRC = usage.MODE_MYLRC
 MODE = MODE_MYBRC if 'brc' in socket.gethostname() else MODE_MYLRC
 
 # set contact information
-SUPPORT_TEAM = 'BRC' if MODE == MODE_MYBRC else 'LRC'
-SUPPORT_EMAIL = 'brc-hpc-help@berkeley.edu' if MODE == MODE_MYBRC else 'hpcshelp@lbl.gov'
+SUPPORT_TEAM, SUPPORT_EMAIL = usage.SUPPORT[MODE]
 
 # constants
-timestamp_format_complete = '%Y-%m-%dT%H:%M:%S'
-timestamp_format_minimal = '%Y-%m-%d'
-
 BASE_URL = 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
-ALLOCATION_ENDPOINT = BASE_URL + 'allocations/'
-ALLOCATION_USERS_ENDPOINT = BASE_URL + 'allocation_users/'
-JOB_ENDPOINT = BASE_URL + 'jobs/'
-
-COMPUTE_RESOURCES_TABLE = {
-    MODE_MYBRC: {
-        'ac': 'Savio Compute',
-        'co': 'Savio Compute',
-        'fc': 'Savio Compute',
-        'ic': 'Savio Compute',
-        'pc': 'Savio Compute',
-        'vector': 'Vector Compute',
-        'abc': 'ABC Compute',
-    },
-
-    MODE_MYLRC: {
-        'ac': 'LAWRENCIUM Compute',
-        'lr': 'LAWRENCIUM Compute',
-        'pc': 'LAWRENCIUM Compute',
-    }
-}
-
-
 if DEBUG:
     BASE_URL = 'http://scgup-dev.lbl.gov/api/' if MODE == MODE_MYBRC else 'http://scgup-dev.lbl.gov:8443/api/'
 
 # CONFIG_FILE = 'check_usage_{}.conf'.format(MODE)
-CONFIG_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                           'check_usage_{}.conf'.format(MODE))
+CONFIG_FILE = os.path.join(SCRIPT_DIR, 'check_usage_{}.conf'.format(MODE))
+
+# the login node daemon (check_usage_daemon.py) makes the requests for us if it is running
+SOCKET_PATH = os.environ.get('CHECK_USAGE_SOCKET', '/run/check_usage/{}.sock'.format(MODE))
+
+AUTH_TOKEN = None
+if os.path.exists(CONFIG_FILE):
+    with open(CONFIG_FILE, 'r') as f:
+        AUTH_TOKEN = f.read().strip()
 
-if not os.path.exists(CONFIG_FILE):
+elif not os.path.exists(SOCKET_PATH):
     print('config file {0} missing...'.format(CONFIG_FILE))
     exit()
 
-with open(CONFIG_FILE, 'r') as f:
-    AUTH_TOKEN = f.read().strip()
-
 def red_str(vector):
     return "\033[91m{}\033[00m".format(vector)
 
@@ -90,146 +93,46 @@ def yellow_str(vector):
 
 def check_valid_date(s):
     '''check if date is in valid format(s)'''
-    complete, minimal = None, None
-
-    try:
-        complete = datetime.datetime.strptime(s, timestamp_format_complete)
-    except Exception:
-        pass
-
     try:
-        minimal = datetime.datetime.strptime(s, timestamp_format_minimal)
-    except Exception:
-        pass
-
-    if not complete and not minimal:  # doesn't fit either format
+        timeconv.parse_timestamp(s)
+    except ValueError:  # doesn't fit either format
         raise argparse.ArgumentTypeError('Invalid time specification {}'.format(s))
-    else:
-        return s
-
-
-# date time string -> time stamp
-def to_timestamp(date_time, to_utc=False):
-    try:
-        dt_obj = datetime.datetime.strptime(date_time, timestamp_format_complete)
-    except ValueError:
-        dt_obj = datetime.datetime.strptime(date_time, timestamp_format_minimal)
-
-    if to_utc:
-        return time.mktime(dt_obj.timetuple())
-
-    else:
-        return calendar.timegm(dt_obj.timetuple())
-
-
-# utc time stamp -> utc date time string
-def to_timestring(timestamp):
-    date_time = datetime.datetime.utcfromtimestamp(timestamp)
-    return date_time.strftime(timestamp_format_complete) + 'Z'
-
-
-# utc time stamp -> local time stamp
-def utc2local(utc):
-    utc = datetime.datetime.utcfromtimestamp(utc)
-    local = utc + datetime.timedelta(hours=-7)
-    local = time.mktime(local.timetuple())
-
-    if DEBUG:
-        print('[utc2local] utc_timestamp: {} local_timestamp: {}'.format(utc, local))
-
-    return local
-
-
-def paginate_requests(url, params):
-    request_url = url + '?' + urllib.urlencode(params)
-    request = urllib2.Request(request_url)
-    request.add_header('Authorization', AUTH_TOKEN)
-
-    try:
-        response = json.loads(urllib2.urlopen(request).read())
-    except Exception as e:
-        response = {'results': None}
-        if DEBUG:
-            print('[paginate_requests({}, {})] ERR: {}'.format(url, params, e))
-
-        return []
-
-    next_page = 2
-    results = response['results']
-    while response['next'] is not None:
-        params['page'] = next_page
-        request_url = url + '?' + urllib.urlencode(params)
-        request = urllib2.Request(request_url)
-        request.add_header('Authorization', AUTH_TOKEN)
-
-        try:
-            response = json.loads(urllib2.urlopen(request).read())
-            results.extend(response['results'])
-            next_page += 1
-        except urllib2.URLError as e:
-            response['next'] = None
-
-            if DEBUG:
-                print('[paginate_requests({}, {})] ERR: {}'.format(url, params, e))
-
-    return results
-
-
-def single_request(url, params=None):
-    request_url = url
-    if params:
-        request_url += '?' + urllib.urlencode(params)
-    request = urllib2.Request(request_url)
-    request.add_header('Authorization', AUTH_TOKEN)
-
-    try:
-        response = json.loads(urllib2.urlopen(request).read())
-    except Exception as e:
-        response = {'results': None}
-
-        if DEBUG:
-            print('[single_request({}, {})] ERR: {}'.format(url, params, e))
-
-    return response['results']
-
 
-def get_project_start(project):
-    allocation_id_url = ALLOCATION_ENDPOINT
+    return s
 
-    header = project.split('_')[0]
-    compute_resources = COMPUTE_RESOURCES_TABLE[MODE].get(header, '{} Compute'.format(header.upper()))
-    params = {'project': project, 'resources': compute_resources}
 
-    response = single_request(allocation_id_url, params)
-    if not response or len(response) == 0:
-        if DEBUG:
-            print('[get_project_start({}, {})] ERR'.format(project, user))
+to_timestamp = usage.to_timestamp
+to_timestring = usage.to_timestring
 
-        return None
 
-    try:
-        creation = response[0]['start_date']
-        return creation.split('.')[0] if '.' in creation else creation
-    except Exception as e:
-        if DEBUG:
-            print('[get_project_start({}, {})] ERR: {}'.format(project, user, e))
+def parse_names(value):
+    '''-u/-a value -> names. a name, a comma separated list, or @file with names separated by commas or whitespace'''
+    names = []
+    for part in value.split(','):
+        part = part.strip()
+        if part.startswith('@'):
+            try:
+                with open(part[1:], 'r') as f:
+                    names.extend(f.read().replace(',', ' ').split())
+            except IOError as e:
+                raise argparse.ArgumentTypeError('Could not read {}: {}'.format(part[1:], e.strerror))
+        elif part:
+            names.append(part)
 
-        print('ERR: information missing in {} database, contact Support ({}) if problem persists.'
-              .format(SUPPORT_TEAM, SUPPORT_EMAIL))
-        exit(0)
+    unique = []
+    for name in names:
+        if name not in unique:
+            unique.append(name)
+    return unique
 
 
-current_month = datetime.datetime.now().month
-current_year = datetime.datetime.now().year
-break_month = '06' if MODE == MODE_MYBRC else '10'
-year = current_year if current_month >= int(break_month) else (current_year - 1)
-default_start = '{}-{}-01T00:00:00'.format(year, break_month)
+default_start = usage.default_start(MODE)
 
 parser = argparse.ArgumentParser(description=docstr)
-parser.add_argument('-u', dest='user',
-                    help='check usage of this user')
-parser.add_argument('-a', dest='account',
-                    help='check usage of this account')
+parser.add_argument('-u', dest='users', type=parse_names, default=[],
+                    help='check usage of these users (comma separated, or @file with one per line)')
+parser.add_argument('-a', dest='accounts', type=parse_names, default=[],
+                    help='check usage of these accounts (comma separated, or @file with one per line)')
 
 parser.add_argument('-E', dest='expand', action='store_true',
                     help='expand user/account usage')
@@ -238,202 +141,180 @@ parser.add_argument('-s', dest='start', type=check_valid_date,
                     default=default_start)
 parser.add_argument('-e', dest='end', type=check_valid_date,
                     help='endtime for the query period (YYYY-MM-DD[THH:MM:SS])',
-                    default=datetime.datetime.now().strftime(timestamp_format_complete))
+                    default=timeconv.format_timestamp(timeconv.utc2local(usage.now_rounded_up())))
+parser.add_argument('-R', dest='report', action='store_true',
+                    help='report the usage of every account, from one pass over the jobs of the period (admins)')
+parser.add_argument('-j', dest='json', action='store_true',
+                    help='print one json object per user/account instead of text')
+parser.add_argument('-w', dest='workers', type=int, default=8,
+                    help='number of users/accounts queried at the same time. default is 8')
+parser.add_argument('--timings', dest='timings', action='store_true',
+                    help='print the time spent on imports, config, network and output to stderr')
+parser.add_argument('--trace', dest='trace', metavar='FILE',
+                    help='write a trace of the API requests to FILE (chrome trace-event json)')
 parsed = parser.parse_args()
-user = parsed.user
-account = parsed.account
+users = parsed.users
+accounts = parsed.accounts
 expand = parsed.expand
+report = parsed.report
+output_json = parsed.json
+workers = max(1, parsed.workers)
 _start = parsed.start
 _end = parsed.end
 
-default_start_used = _start == default_start
-calculate_project_start = default_start_used and account
+if parsed.timings:
+    atexit.register(print_timings)
 
-# convert all times to UTC
-start = to_timestamp(_start, to_utc=True)  # utc start time stamp
-end = to_timestamp(_end, to_utc=True)      # utc end time stamp
-_start = to_timestring(start)              # utc start time string
-_end = to_timestring(end)                  # utc end time string
+tracer = tracing.Tracer(parsed.trace)
+tracer.install()
 
-if calculate_project_start:
-    target_start_date = get_project_start(account)  # local time string
-
-    if target_start_date is not None:
-        start = to_timestamp(target_start_date, to_utc=True)
-        _start = to_timestring(start)
+default_start_used = _start == default_start
 
-    elif DEBUG:
-        print('[get_account_start({})] ERR'.format(account))
+# convert all times to UTC
+start = to_timestamp(_start)  # utc start time stamp
+end = to_timestamp(_end)      # utc end time stamp
+_start = to_timestring(start)  # utc start time string
+_end = to_timestring(end)      # utc end time string
 
 # defaults
-if not user and not account:
-    user = getpass.getuser()
+if not users and not accounts and not report:
+    import getpass
+    users = [getpass.getuser()]
 
-output_headers = {}
-if user:
-    output_header = 'Usage for USER {} [{}, {}]:'.format(user, _start, _end)
-    output_headers['user'] = output_header
+client = usage.UsageClient(BASE_URL, AUTH_TOKEN, MODE, socket_path=None if DEBUG else SOCKET_PATH,
+                           workers=workers, debug=DEBUG, tracer=tracer,
+                           limiter=ratelimit.RateLimiter.for_api(BASE_URL, interactive=True))
 
-if account:
-    output_header = 'Usage for ACCOUNT {} [{}, {}]:'.format(account, _start, _end)
-    output_headers['account'] = output_header
+# accounts are queried from the start of their allocation, unless a start was given
+query_start = None if default_start_used else start
 
 
-def get_cpu_usage(user=None, account=None):
-    params = {'start_time': start, 'end_time': end}
-    if user:
-        params['user'] = user
+REPORT_HEADER = '{:<24} {:>14} {:>14} {:>8} {:>9} {:>14}'.format(
+    'ACCOUNT', 'ALLOCATION', 'USAGE (SUs)', 'USED', 'JOBS', 'CPUHRS')
 
-    if account:
-        params['account'] = account
-
-    request_url = JOB_ENDPOINT + '?' + urllib.urlencode(params)
-    request = urllib2.Request(request_url)
-    request.add_header('Authorization', AUTH_TOKEN)
-
-    try:
-        response = json.loads(urllib2.urlopen(request).read())
-    except Exception as e:
-        response = {'count': 0, 'total_cpu_time': 0, 'total_amount': 0,
-                    'response': [], 'next': None}
-
-        if DEBUG:
-            print('[get_cpu_usage({}, {})] ERR: {}'.format(user, account, e))
-
-        if user and not account:
-            return -1, -1, -1
-
-    job_count = response['count']
-    total_cpu = response['total_cpu_time']
-    total_amount = response['total_amount']
-
-    return job_count, total_cpu, total_amount
-
-
-def process_account_query():
-    allocation_id_url = ALLOCATION_ENDPOINT
-
-    header = account.split('_')[0]
-    compute_resources = COMPUTE_RESOURCES_TABLE[MODE].get(header, '{} Compute'.format(header.upper()))
-    response = single_request(allocation_id_url, {'project': account, 'resources': compute_resources})
-    if not response or len(response) == 0:
-        if DEBUG:
-            print('[process_account_query()] ERR')
-
-        print('ERR: Account not found: {}'.format(account))
-        return
-
-    allocation_id = response[0]['id']
-    allocation_url = allocation_id_url + '{}/attributes/'.format(allocation_id)
-    response = single_request(allocation_url, {'type': 'Service Units'})
-    if not response or len(response) == 0:
-        if DEBUG:
-            print('[process_account_query()] ERR')
 
-        raise urllib2.URLError('ERR: Backend Error, contact {} Support ({}).'
-                               .format(SUPPORT_TEAM, SUPPORT_EMAIL))
-
-    allocation = response[0]['value']
-    allocation = int(float(allocation))
-
-    if 'ac_' in account or 'co_' in account:
-        # get usage from allocation attribute
-        try:
-            account_usage = response[0]['usage']['value']
-        except KeyError:
-            raise urllib2.URLError('ERR: Backend Error, contact {} Support ({}).'
-                                   .format(SUPPORT_TEAM, SUPPORT_EMAIL))
-
-        job_count, cpu_usage, _ = get_cpu_usage(account=account)
+def format_report(record):
+    '''the report table rows of an account, and its users with -E'''
+    used = record.get('percent_used')
+    if used is None:
+        used = '-'
     else:
-        # get usage from jobs
-        job_count, cpu_usage, account_usage = get_cpu_usage(account=account)
-
-    if not default_start_used:
-        print('{} {} jobs, {:.2f} CPUHrs, {} SUs.'.format(output_headers['account'], job_count, cpu_usage, account_usage))
-    else:
-        print('{} {} jobs, {:.2f} CPUHrs, {} SUs used from an allocation of {} SUs.'.format(output_headers['account'], job_count, cpu_usage, account_usage, allocation))
-
-    if expand:
-        user_url = ALLOCATION_USERS_ENDPOINT
-        user_list = paginate_requests(user_url, {'project': account})
-
-        for user in user_list:
-            if user['user'] is None:
-                continue
-
-            user_name = user['user']
-            user_jobs, user_cpu, user_usage = get_cpu_usage(user_name, account)
-
-            percentage = 0.0
-            try:
-                percentage = (float(user_usage) / float(account_usage)) * 100
-            except Exception:
-                percentage = 0.00
-
-            if percentage < 75:
+        color_fn = green_str if used < 75 else red_str if used > 100 else yellow_str
+        used = color_fn('{:>7.2f}%'.format(used))
+
+    lines = ['{:<24} {:>14} {:>14.2f} {:>8} {:>9} {:>14.2f}'.format(
+        record['account'], record.get('allocation', '-'), record['service_units'], used,
+        record['jobs'], record['cpu_hours'])]
+    for user in record.get('users', []):
+        lines.append('  {:<22} {:>14} {:>14.2f} {:>7.2f}% {:>9} {:>14.2f}'.format(
+            user['user'], '', user['service_units'], user['percent'], user['jobs'], user['cpu_hours']))
+    return lines
+
+
+def format_text(record):
+    '''the lines check_usage prints for a usage record'''
+    lines = []
+    if record['type'] == 'account' and record['account'].startswith('ac_'):
+        lines.append('INFO: Start Date shown may be inaccurate.')
+
+    if 'error' in record:
+        lines.append('ERR: {}'.format(record['error']))
+        return lines
+
+    if record['type'] == 'account':
+        header = 'Usage for ACCOUNT {} [{}, {}]:'.format(record['account'], record['start'], record['end'])
+        if 'allocation' not in record:
+            lines.append('{} {} jobs, {:.2f} CPUHrs, {} SUs.'.format(
+                header, record['jobs'], record['cpu_hours'], record['service_units']))
+        else:
+            lines.append('{} {} jobs, {:.2f} CPUHrs, {} SUs used from an allocation of {} SUs.'.format(
+                header, record['jobs'], record['cpu_hours'], record['service_units'], record['allocation']))
+
+        for user in record.get('users', []):
+            if user['percent'] < 75:
                 color_fn = green_str
-            elif percentage > 100:
+            elif user['percent'] > 100:
                 color_fn = red_str
             else:
                 color_fn = yellow_str
 
-            percentage = color_fn("{:.2f}".format(percentage))
-            print('\tUsage for USER {} in ACCOUNT {} [{}, {}]: {} jobs, {:.2f} CPUHrs, {} ({}%) SUs.'
-                  .format(user_name, account, _start, _end, user_jobs, user_cpu, user_usage, percentage))
-
+            percentage = color_fn("{:.2f}".format(user['percent']))
+            lines.append('\tUsage for USER {} in ACCOUNT {} [{}, {}]: {} jobs, {:.2f} CPUHrs, {} ({}%) SUs.'.format(
+                user['user'], record['account'], record['start'], record['end'], user['jobs'], user['cpu_hours'],
+                user['service_units'], percentage))
 
-def process_user_query():
-    global start, _start
-
-    total_jobs, total_cpu, total_usage = get_cpu_usage(user)
-    if total_jobs == total_cpu == total_usage == -1:
-        print('ERR: User not found: {}'.format(user))
-        return
-
-    print('{} {} jobs, {:.2f} CPUHrs, {} SUs used.'.format(output_headers['user'], total_jobs, total_cpu, total_usage))
-
-    if expand:
-        user_allocation_url = ALLOCATION_USERS_ENDPOINT
-        response = paginate_requests(user_allocation_url, {'user': user})
+    else:
+        header = 'Usage for USER {} [{}, {}]:'.format(record['user'], record['start'], record['end'])
+        lines.append('{} {} jobs, {:.2f} CPUHrs, {} SUs used.'.format(
+            header, record['jobs'], record['cpu_hours'], record['service_units']))
 
-        for allocation in response:
-            allocation_account = allocation['project']
-            allocation_jobs, allocation_cpu, allocation_usage = get_cpu_usage(user, allocation_account)
+        for allocation in record.get('accounts', []):
             prefix = '\t'
-            if allocation['status'] == 'Removed':
+            if allocation['removed']:
                 prefix += '(User removed from account) '
-            message = prefix + (
-                'Usage for USER {} in ACCOUNT {} [{}, {}]: {} jobs, {:.2f} CPUHrs, {} SUs.'.format(
-                    user, allocation_account, _start, _end, allocation_jobs, allocation_cpu, allocation_usage))
-            print(message)
+            lines.append(prefix + 'Usage for USER {} in ACCOUNT {} [{}, {}]: {} jobs, {:.2f} CPUHrs, {} SUs.'.format(
+                record['user'], allocation['account'], record['start'], record['end'], allocation['jobs'],
+                allocation['cpu_hours'], allocation['service_units']))
 
+    return lines
 
-for req_type in output_headers.keys():
-    try:
-        if start > end:
-            print('ERR: Start time ({}) requested is after end time ({}).'.format(_start, _end))
-            exit(0)
 
-        if to_timestamp('2020-06-01', to_utc=True) > start:
-            print('INFO: Information might be inaccurate, for accurate information contact {} support ({}).'
-                  .format(SUPPORT_TEAM, SUPPORT_EMAIL))
+# messages that aren't about a single query go to stderr with -j, stdout stays json lines
+notice = sys.stderr if output_json else sys.stdout
+
+if start > end:
+    notice.write('ERR: Start time ({}) requested is after end time ({}).\n'.format(_start, _end))
+    exit(0)
 
-        if req_type == 'user':
-            process_user_query()
+if to_timestamp('2020-06-01') > start:
+    notice.write('INFO: Information might be inaccurate, for accurate information contact {} support ({}).\n'
+                 .format(SUPPORT_TEAM, SUPPORT_EMAIL))
 
-        if req_type == 'account':
-            if account.startswith('ac_'):
-                print('INFO: Start Date shown may be inaccurate.')
+lap('config')
 
-            process_account_query()
+if report:
+    if not output_json:
+        print('Usage of all accounts until {}, from the allocation start of each account:'.format(_end)
+              if default_start_used else 'Usage of all accounts [{}, {}]:'.format(_start, _end))
+        print(REPORT_HEADER)
 
-    except urllib2.URLError as e:
+    try:
+        for record in client.usage_report(query_start, end, expand):
+            lap('network')
+            if output_json:
+                sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+            else:
+                sys.stdout.write(''.join(line + '\n' for line in format_report(record)))
+            lap('render')
+    except IOError as e:  # URLError
         print('ERR: Could not connect to backend, contact {} Support ({}) if problem persists.'
               .format(SUPPORT_TEAM, SUPPORT_EMAIL))
         if DEBUG:
             print('__main__ ERR: {}'.format(e))
+        exit(1)
 
-    except Exception as e:
-        if DEBUG:
-            print('__main__ ERR: {}'.format(e))
+    exit(0)
+
+# a user queried together with a single account is queried from the account's start, as before
+user_begin = start
+if users and len(accounts) == 1 and default_start_used:
+    try:
+        user_begin = client.account_start(accounts[0])
+    except (usage.QueryError, IOError):
+        pass  # reported with the account query
+    lap('network')
+
+# queries run concurrently, results are printed in the order they were asked for as soon as they are ready
+records = itertools.chain(client.accounts_usage(accounts, query_start, end, expand),
+                          client.users_usage(users, user_begin, end, expand))
+try:
+    for record in records:
+        lap('network')
+        if output_json:
+            sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+        else:
+            sys.stdout.write(''.join(line + '\n' for line in format_text(record)))
+        sys.stdout.flush()
+        lap('render')
+finally:
+    client.close()
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+import os
+import re
+import sys
+import json
+import socket
+import signal
+import logging
+import argparse
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+try:
+    from urlparse import parse_qsl
+except ImportError:
+    from urllib.parse import parse_qsl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from bankutils import coalesce, httpcache, httppool, ratelimit, tracing  # noqa: E402
+
+
+docstr = '''
+Login node daemon for check_usage_coldfront.py. Listens on a unix socket and
+makes the API requests of check_usage clients for them, over pooled
+keep-alive connections. Responses are shared between clients for --TTL
+seconds, and identical requests that arrive while one is in flight are sent
+to the API once. After that, requests for projects, allocations and their
+users are conditional, the API only sends them again if they changed. A
+request id sent along with a request (check_usage --trace) is passed on to
+the API as its X-Request-ID header, and logged.
+
+The socket is open to every user of the node, so only the requests
+check_usage makes are forwarded: its endpoints, with the query parameters it
+sends them. Replies are one json line each.
+'''
+
+MODE_MYBRC = 'mybrc'
+MODE_MYLRC = 'mylrc'
+
+# the endpoints check_usage reads and the query parameters it sends them, nothing else is forwarded
+ALLOWED_QUERIES = [
+    (re.compile(r'^allocations/$'), ('project', 'resources')),
+    (re.compile(r'^allocations/\d+/attributes/$'), ('type',)),
+    (re.compile(r'^allocation_users/$'), ('project', 'page')),
+    (re.compile(r'^jobs/$'), ('start_time', 'end_time', 'user', 'account', 'page', 'page_size', 'fields')),
+]
+MAX_REQUEST_LINE = 4096
+REQUEST_ID = re.compile(r'^[\w-]{1,64}$')
+
+
+def default_socket(mode):
+    return '/run/check_usage/{}.sock'.format(mode)
+
+
+parser = argparse.ArgumentParser(description=docstr)
+parser.add_argument('-T', dest='MODE', choices=[MODE_MYBRC, MODE_MYLRC],
+                    default=MODE_MYBRC if 'brc' in socket.gethostname() else MODE_MYLRC,
+                    help='which target API to use. default is picked from the hostname, like check_usage')
+parser.add_argument('--SOCKET', dest='socket', type=str,
+                    help='unix socket to listen on. default is /run/check_usage/<mode>.sock, '
+                         'check_usage reads it from CHECK_USAGE_SOCKET')
+parser.add_argument('--CONFIG', dest='config', type=str,
+                    help='file with the API token. default is check_usage_<mode>.conf next to this script')
+parser.add_argument('--API_URL', dest='api_url', type=str,
+                    help='override the target API base url (eg. staging, or the stand-in server in bench/)')
+parser.add_argument('--TTL', dest='ttl', type=float, default=60,
+                    help='seconds a response is shared between clients. default is 60')
+parser.add_argument('--POOL', dest='pool', type=int, default=8,
+                    help='max number of connections to the API. default is 8')
+parser.add_argument('--LOG', dest='log', type=str,
+                    help='log file. default is stderr')
+
+parsed = parser.parse_args()
+MODE = parsed.MODE
+SOCKET_PATH = parsed.socket or default_socket(MODE)
+CONFIG_FILE = parsed.config or os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                            'check_usage_{}.conf'.format(MODE))
+BASE_URL = parsed.api_url or 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
+
+logging.basicConfig(filename=parsed.log, level=logging.INFO,
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    datefmt='%Y-%m-%dT%H:%M:%S')
+
+if not os.path.exists(CONFIG_FILE):
+    print('config file {} missing'.format(CONFIG_FILE))
+    exit(1)
+
+with open(CONFIG_FILE, 'r') as f:
+    AUTH_TOKEN = f.read().strip()
+
+# check_usage traffic: the sync scripts on this host leave it a share of the API's rate limit
+POOL = httppool.ConnectionPool(BASE_URL, size=max(1, parsed.pool),
+                               limiter=ratelimit.RateLimiter.for_api(BASE_URL, interactive=True),
+                               cache=httpcache.ValidatorCache())
+CACHE = coalesce.CoalescingCache(ttl=parsed.ttl)
+
+
+def allowed(path):
+    '''whether path is a request check_usage makes: one of its endpoints, with its query parameters, once each'''
+    if re.search(r'\s', path):
+        return False
+
+    endpoint, _, query = path.partition('?')
+    for pattern, names in ALLOWED_QUERIES:
+        if pattern.match(endpoint):
+            try:
+                params = [name for name, _ in parse_qsl(query, keep_blank_values=True, strict_parsing=bool(query))]
+            except ValueError:
+                return False
+            return len(set(params)) == len(params) and all(name in names for name in params)
+    return False
+
+
+def reply(payload):
+    return (json.dumps(payload) + '\n').encode('utf-8')
+
+
+def fetch(path, request_id=None):
+    '''the reply line to a GET of path, with the API's json body on one line'''
+    headers = {'Authorization': AUTH_TOKEN}
+    if request_id:
+        headers[tracing.REQUEST_ID_HEADER] = request_id
+        logging.info('GET {} request id {}'.format(path, request_id))
+
+    try:
+        status, body = POOL.request('GET', BASE_URL + path, headers)
+    except Exception as e:
+        logging.error('GET {} failed: {} (request id {})'.format(path, e, request_id))
+        return reply({'status': 502, 'error': str(e)})
+
+    if status != 200:
+        logging.warning('GET {} returned {} (request id {})'.format(path, status, request_id))
+        return reply({'status': status, 'error': body[:200].decode('utf-8', 'replace')})
+
+    try:
+        body = json.loads(body.decode('utf-8'))
+    except ValueError as e:
+        logging.error('GET {} returned invalid json: {} (request id {})'.format(path, e, request_id))
+        return reply({'status': 502, 'error': 'invalid json from the API'})
+
+    # status first, see cacheable below: json.dumps() orders dicts arbitrarily under python 2
+    return '{{"status": 200, "body": {}}}\n'.format(json.dumps(body)).encode('utf-8')
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline(MAX_REQUEST_LINE).decode('utf-8'))
+        except ValueError:
+            self.wfile.write(reply({'status': 400, 'error': 'invalid request'}))
+            return
+
+        if request.get('stats'):
+            stats = CACHE.stats()
+            stats.update(POOL.cache.stats(), connects=POOL.connects, requests=POOL.requests)
+            self.wfile.write(reply({'status': 200, 'body': stats}))
+            return
+
+        path = request.get('path') or ''
+        if not allowed(path):
+            self.wfile.write(reply({'status': 403, 'error': 'not forwarded: {}'.format(path)}))
+            return
+
+        # only the request that reaches the API passes its id on, the ones answered from the cache don't
+        request_id = request.get('request_id')
+        if not (isinstance(request_id, type(u'')) and REQUEST_ID.match(request_id)):
+            request_id = None
+
+        self.wfile.write(CACHE.get(path, lambda: fetch(path, request_id),
+                                   cacheable=lambda line: line.startswith(b'{"status": 200')))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if os.path.exists(SOCKET_PATH):
+    os.remove(SOCKET_PATH)  # left behind by a previous run
+
+server = Server(SOCKET_PATH, Handler)
+os.chmod(SOCKET_PATH, 0o666)  # check_usage runs as whichever user asks
+
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+print('serving {} on {}'.format(BASE_URL, SOCKET_PATH))
+logging.info('serving {} on {}, ttl {}s'.format(BASE_URL, SOCKET_PATH, parsed.ttl))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    os.remove(SOCKET_PATH)
+    POOL.close()
+    logging.info('stopped, {}'.format(CACHE.stats()))
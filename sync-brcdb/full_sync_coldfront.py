@@ -1,14 +1,16 @@
 #!/usr/bin/python
 import os
-import time
 import urllib2
 import urllib
 import json
 import datetime
-import calendar
 import subprocess
 import logging
 import argparse
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from bankutils import allocations, httpcache, jobs, metrics, pagination, ratelimit, timeconv, tracing  # noqa: E402
 
 
 docstr = '''
@@ -17,30 +19,18 @@ By Default, will launch in DEBUG mode where data is only collected and logged, n
 To actually update data upstream, look at the --PUSH flag.
 '''
 
-timestamp_format_complete = '%Y-%m-%dT%H:%M:%S'
-timestamp_format_minimal = '%Y-%m-%d'
 MODE_MYBRC = 'mybrc'
 MODE_MYLRC = 'mylrc'
 
 
 def check_valid_date(s):
     '''check if date is in valid format(s)'''
-    complete, minimal = None, None
-
-    try:
-        complete = datetime.datetime.strptime(s, timestamp_format_complete)
-    except Exception:
-        pass
-
     try:
-        minimal = datetime.datetime.strptime(s, timestamp_format_minimal)
-    except Exception:
-        pass
-
-    if not complete and not minimal:  # doesn't fit either format
+        timeconv.parse_timestamp(s)
+    except ValueError:
         raise argparse.ArgumentTypeError('Invalid time specification {}'.format(s))
-    else:
-        return s
+
+    return s
 
 
 parser = argparse.ArgumentParser(description=docstr)
@@ -52,9 +42,18 @@ parser.add_argument('-T', dest='MODE',
                     choices=[MODE_MYBRC, MODE_MYLRC])
 parser.add_argument('--PUSH', dest='push', action='store_true',
                     help='launch script in PROD mode, this will PUSH updates to the target API.')
+parser.add_argument('--API_URL', dest='api_url', type=str,
+                    help='override the target API base url (eg. staging, or the stand-in server in bench/)')
 parser.add_argument('--PRICE_FILE', dest='price_file', type=str,
                     default='/etc/slurm/bank-config.toml',
                     help='which price file to use. default is /etc/slurm/bank-config.toml')
+parser.add_argument('--METRICS_DIR', dest='metrics_dir', type=str, default='.',
+                    help='where to write the run metrics (prometheus textfile + json summary). default is .')
+parser.add_argument('--TRACE', dest='trace', type=str,
+                    help='write a trace of the API requests to this file (chrome trace-event json)')
+parser.add_argument('--HTTP_CACHE_DIR', dest='http_cache_dir', type=str, default='.http_cache',
+                    help='where to keep projects/allocations responses for conditional requests, '
+                         '"" to always fetch them in full. default is .http_cache')
 
 parsed = parser.parse_args()
 DEBUG = not parsed.push
@@ -64,7 +63,7 @@ START = parsed.start
 PRICE_FILE = parsed.price_file
 CONFIG_FILE = 'full_sync_{}.conf'.format(MODE)
 LOG_FILE = ('full_sync_{}_debug.log' if DEBUG else 'full_sync_{}.log').format(MODE)
-BASE_URL = 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
+BASE_URL = parsed.api_url or 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
 
 COMPUTE_RESOURCES_TABLE = {
     MODE_MYBRC: {
@@ -97,6 +96,14 @@ if START is None:
 else:
     use_project_start = False
 
+TRACER = tracing.Tracer(parsed.trace)
+TRACER.install()
+LIMITER = ratelimit.RateLimiter.for_api(BASE_URL)  # shared with the other scripts on this host
+HTTP_CACHE = httpcache.ValidatorCache(parsed.http_cache_dir) if parsed.http_cache_dir else None
+METRICS = metrics.RunMetrics('full_sync', {'mode': MODE, 'debug': str(DEBUG).lower()},
+                             tracer=TRACER, limiter=LIMITER, cache=HTTP_CACHE)
+METRICS.install(parsed.metrics_dir, LOG_FILE[:-len('.log')])
+
 logging.basicConfig(filename=LOG_FILE, level=logging.INFO,
                     format='%(asctime)s %(levelname)-8s %(message)s',
                     datefmt='%Y-%m-%dT%H:%M:%S')
@@ -128,26 +135,6 @@ else:
     logging.info('using specified start date {}'.format(START))
 
 
-# date time string -> time stamp
-def to_timestamp(date_time, to_utc=False):
-    try:
-        dt_obj = datetime.datetime.strptime(date_time, timestamp_format_complete)
-    except ValueError:
-        dt_obj = datetime.datetime.strptime(date_time, timestamp_format_minimal)
-
-    if to_utc:
-        return time.mktime(dt_obj.timetuple())
-
-    else:
-        return calendar.timegm(dt_obj.timetuple())
-
-
-# utc time stamp -> utc date time string
-def to_timestring(timestamp):
-    date_time = datetime.datetime.utcfromtimestamp(timestamp)
-    return date_time.strftime(timestamp_format_complete), date_time
-
-
 def get_price_per_hour(partition):
     lines = PRICE_FILE_CONTENTS[:]
 
@@ -183,84 +170,39 @@ def get_price_per_hour(partition):
     return target
 
 
-def calculate_hours(duration_seconds):
-    return duration_seconds / 3600
-
-
-def calculate_amount(partition, cpu_count, duration_hrs):
-    return round(get_price_per_hour(partition) * int(cpu_count) * duration_hrs, 2)
-
-
-def calculate_cpu_time(num_cpus, duration_hrs):
-    return duration_hrs * float(num_cpus)
-
-
-def node_list_format(nodelist):
-    nodes = nodelist.split(',')
-
-    table = []
-    for node in nodes:
-        if '-' in node:
-            extension = node.split('.')[-1]
-            start, end = node.split(',')[0][1:]
+def log_retry(request_url, attempt, error):
+    logging.warning('retrying {} (attempt {}): {}'.format(request_url, attempt + 1, error))
+    METRICS.add_retry(request_url, attempt, error)
 
-            for current in range(int(start), int(end) + 1):
-                current = 'n{:04d}.{}'.format(current, extension)
-                table.append({"name": current})
 
-        else:
-            table.append({"name": node})
-
-    return table
+RETRY = pagination.Retry(on_retry=log_retry)
 
 
 def paginate_requests(url, params=None):
-    request_url = url
-    params = params or {}
-
-    if params:
-        request_url = url + '?' + urllib.urlencode(params)
+    '''yield the results of a paginated endpoint, one page at a time'''
+    pages = [0]
 
-    try:
+    def fetch(request_url):
         req = urllib2.Request(request_url)
         req.add_header('Authorization', AUTH_TOKEN)
-        response = json.loads(urllib2.urlopen(req).read())
-    except urllib2.URLError as e:
-        if DEBUG:
-            print('[paginate_requests({}, {})] failed: {}'.format(url, params, e))
-            logging.error('[paginate_requests({}, {})] failed: {}'.format(url, params, e))
-
-        return []
-
-    current_page = 0
-    results = []
-    results.extend(response['results'])
-    while response['next'] is not None:
-        try:
-            current_page += 1
-            params['page'] = current_page
-            request_url = url + '?' + urllib.urlencode(params)
-            req = urllib2.Request(request_url)
-            req.add_header('Authorization', AUTH_TOKEN)
-            response = json.loads(urllib2.urlopen(req).read())
-
-            results.extend(response['results'])
-            if current_page % 5 == 0:
-                print('\tgetting page: {}'.format(current_page))
-
-            if current_page > 50:
-                print('too many pages to sync at once, rerun script after this run completes')
-                logging.warning('too many pages to sync at once, rerun script after this run completes')
-                break
+        response = json.loads(METRICS.urlopen(req))
 
-        except urllib2.URLError as e:
-            response['next'] = None
+        pages[0] += 1
+        if pages[0] % 5 == 0:
+            print('\tgetting page: {}'.format(pages[0]))
+        return response
 
-            if DEBUG:
-                print('[paginate_requests()] failed: {}'.format(e))
-                logging.error('[paginate_requests({}, {})] failed: {}'.format(url, params, e))
-
-    return results
+    try:
+        with TRACER.span('paginate_requests', url=url, params=params):
+            for result in pagination.paginate(fetch, url, params, RETRY):
+                yield result
+    except pagination.PageError as e:
+        # a listing that stops early would look complete, stop the run instead
+        METRICS.add_error()
+        print('[paginate_requests({}, {})] failed: {}'.format(url, params, e))
+        logging.error('[paginate_requests({}, {})] failed: {}'.format(url, params, e))
+        METRICS.fail()
+        exit(1)
 
 
 def single_request(url, params=None):
@@ -271,9 +213,10 @@ def single_request(url, params=None):
         request_url = url + '?' + urllib.urlencode(params)
 
     try:
-        request = urllib2.Request(request_url)
-        request.add_header('Authorization', AUTH_TOKEN)
-        response = json.loads(urllib2.urlopen(request).read())
+        with TRACER.span('single_request', url=request_url):
+            request = urllib2.Request(request_url)
+            request.add_header('Authorization', AUTH_TOKEN)
+            response = json.loads(METRICS.urlopen(request))
     except Exception as e:
         response = {'results': None}
 
@@ -285,96 +228,78 @@ def single_request(url, params=None):
 
 
 def get_project_start(project):
-    allocations_url = BASE_URL + 'allocations/'
-
-    header = project.split('_')[0]
-    compute_resources = COMPUTE_RESOURCES_TABLE[MODE].get(header, '{} Compute'.format(header.upper()))
-    response = single_request(allocations_url, {'project': project, 'resources': compute_resources})
+    compute_resources = allocations.compute_resource(COMPUTE_RESOURCES_TABLE[MODE], project)
+    creation = ALLOCATIONS.start_date(project, compute_resources)
 
-    if not response or len(response) == 0:
+    if creation is None:
         if DEBUG:
             print('[get_project_start({})] ERR'.format(project))
             logging.error('[get_project_start({})] ERR'.format(project))
 
         return None
 
-    creation = response[0]['start_date']
-
-    if creation:
-        return creation.split('.')[0] if '.' in creation else creation
-    else:
-        return None
+    return creation
 
 
 print('gathering accounts from {}db'.format(MODE))
 logging.info('gathering data from {}db'.format(MODE))
 
 # collect projects
-project_table = []
+METRICS.start_phase('projects')
+project_names = []
+seen = set()
 for project in paginate_requests(BASE_URL + 'projects/'):
     project_name = str(project['name'])
+    if project_name in seen:
+        continue  # listed twice, don't collect its jobs twice
+    seen.add(project_name)
+    project_names.append(project_name)
+    METRICS.add_items()
+
+# all allocations in one sweep, instead of a request per project
+METRICS.start_phase('allocations')
+ALLOCATIONS = allocations.AllocationIndex.load(paginate_requests, BASE_URL)
+METRICS.add_items(len(ALLOCATIONS))
+
+METRICS.start_phase('project_start')
+project_table = []
+for project_name in project_names:
     project_start = get_project_start(project_name)
+    METRICS.add_items()
+
+    project_table.append({'name': project_name, 'start': START if not project_start else str(project_start)})
+
+
+def parse_jobs(out, table):
+    rows = len(table)
+    for jobid, reason in table.extend_sacct(out, get_price_per_hour):
+        METRICS.add_error()
+        logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, reason))
+    METRICS.add_items(len(table) - rows)
 
-    project['name'] = project_name
-    project['start'] = START if not project_start else str(project_start)
-    project_table.append(project)
 
 print('gathering jobs from slurmdb')
 logging.info('gathering data from slurmdb')
 
-# collect jobs
+# collect and parse jobs, one project at a time so only one project's sacct output is held at once
+table = jobs.JobTable()
 for index, project in enumerate(project_table):
+    METRICS.start_phase('sacct')
     start = project['start'] if use_project_start else START
     out, err = subprocess.Popen(['sacct', '-A', project['name'], '-S', start,
-                                 '--format=JobId,Submit,Start,End,UID,Account,State,Partition,QOS,NodeList,AllocCPUS,ReqNodes,AllocNodes,CPUTimeRAW,CPUTime', '-naPX'],
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()
-    project['jobs'] = out.splitlines()
+                                 '--format=' + jobs.SACCT_FORMAT, '-naPX'],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=timeconv.sacct_env()).communicate()
+    METRICS.add_items(out.count('\n'))
+    METRICS.add_bytes(len(out))
 
-    if index % int(len(project_table) / 10) == 0:
+    if index % max(1, len(project_table) // 10) == 0:
         print('\tprogress: {}/{}'.format(index, len(project_table)))
 
+    METRICS.start_phase('parse')
+    parse_jobs(out, table)
+    del out
 
-print('parsing jobs')
-logging.info('parsing jobs')
-
-# parse data
-table = {}
-for project in project_table:
-    for line in project['jobs']:
-        values = [str(value.decode('utf-8')) for value in line.split('|')]
-        jobid, submit, start, end, uid, account, state, partition, qos, nodelist, alloc_cpus, req_nodes, alloc_nodes, cpu_time_raw, cpu_time = values
-
-        try:
-            submit, _ = to_timestring(to_timestamp(submit, to_utc=False))
-            start, _start = to_timestring(to_timestamp(start, to_utc=False))
-            end, _end = to_timestring(to_timestamp(end, to_utc=False))
-            raw_time_hrs = calculate_hours((_end - _start).total_seconds())
-
-            cpu_time = calculate_cpu_time(alloc_cpus, raw_time_hrs)
-            amount = calculate_amount(partition, alloc_cpus, raw_time_hrs)
-            node_list_converted = node_list_format(nodelist)
-
-            table[jobid] = {
-                'jobslurmid': jobid,
-                'submitdate': submit,
-                'startdate': start,
-                'enddate': end,
-                'userid': uid,
-                'accountid': account,
-                'amount': str(amount),
-                'jobstatus': state,
-                'partition': partition,
-                'qos': qos,
-                'nodes': node_list_converted,
-                'num_cpus': int(alloc_cpus),
-                'num_req_nodes': int(req_nodes),
-                'num_alloc_nodes': int(alloc_nodes),
-                'raw_time': raw_time_hrs,
-                'cpu_time': float(cpu_time)}
-
-        except Exception as e:
-            logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, e))
-
+METRICS.end_phase()
 
 if not DEBUG:
     print('updating mybrcdb with {} jobs'.format(len(table)))
@@ -389,7 +314,7 @@ else:
     print('DEBUG: collected {} jobs to update'.format(len(table)))
     logging.info('DEBUG: collected {} jobs to update'.format(len(table)))
 
-    for jobid, job in table.items():
+    for jobid, job in table.payloads():
         logging.info('{} COLLECTED : {}'.format(jobid, job))
 
     print('DEBUG run complete, updated 0 jobs.')
@@ -397,8 +322,9 @@ else:
     exit(0)
 
 # push data
+METRICS.start_phase('push')
 counter = 0
-for jobid, job in table.items():
+for jobid, job in table.payloads():
     request_data = urllib.urlencode(job)
     url_target = BASE_URL + 'jobs/' + str(jobid) + '/'
     req = urllib2.Request(url=url_target, data=request_data)
@@ -407,11 +333,12 @@ for jobid, job in table.items():
     req.get_method = lambda: 'PUT'
 
     try:
-        json.loads(urllib2.urlopen(req).read())
+        json.loads(METRICS.urlopen(req))
         logging.info('{} PUSHED/UPDATED : {}'.format(jobid, job))
+        METRICS.add_items()
         counter += 1
 
-        if counter % int(len(table) / 10) == 0:
+        if counter % max(1, len(table) // 10) == 0:
             print('\tprogress: {}/{}'.format(counter, len(table)))
 
     except urllib2.HTTPError as e:
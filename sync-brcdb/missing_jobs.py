@@ -0,0 +1,361 @@
+#!/usr/bin/python
+import os
+import time
+import urllib2
+import urllib
+import json
+import datetime
+import subprocess
+import logging
+import argparse
+import sys
+from multiprocessing.pool import ThreadPool
+
+from six.moves import configparser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from bankutils import (httpcache, jobids, jobs, metrics, pagination, ratelimit, reconcile,  # noqa: E402
+                       timeconv, tracing)
+
+
+docstr = '''
+Find jobs that never made it from Slurm-DB to MyBRC/MyLRC DB, by comparing only the job ids on both sides,
+and push just those. Jobs in MyBRC/MyLRC DB that are not in Slurm-DB are reported.
+By Default, will launch in DEBUG mode where data is only collected and logged, not PUSHED upstream.
+To actually update data upstream, look at the --PUSH flag.
+'''
+
+MODE_MYBRC = 'mybrc'
+MODE_MYLRC = 'mylrc'
+
+
+def check_valid_date(s):
+    '''check if date is in valid format(s)'''
+    try:
+        timeconv.parse_timestamp(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid time specification {}'.format(s))
+
+    return s
+
+
+parser = argparse.ArgumentParser(description=docstr)
+parser.add_argument('-s', dest='start', type=check_valid_date,
+                    help='starttime for the query period (YYYY-MM-DD[THH:MM:SS]). Defaults to start of current allocation period.')
+parser.add_argument('-e', dest='end', type=check_valid_date,
+                    help='endtime for the query period (YYYY-MM-DD[THH:MM:SS]). Defaults to NOW.',
+                    default=timeconv.format_timestamp(timeconv.utc2local(time.time())))
+parser.add_argument('-T', dest='MODE',
+                    help='which target API to use', required=True,
+                    choices=[MODE_MYBRC, MODE_MYLRC])
+parser.add_argument('--PUSH', dest='push', action='store_true',
+                    help='launch script in PROD mode, this will PUSH updates to the target API.')
+parser.add_argument('--API_URL', dest='api_url', type=str,
+                    help='override the target API base url (eg. staging, or the stand-in server in bench/)')
+parser.add_argument('--PRICE_FILE', dest='price_file', type=str,
+                    default='/etc/slurm/bank-config.toml',
+                    help='which price file to use. default is /etc/slurm/bank-config.toml')
+parser.add_argument('--PAGE_SIZE', dest='page_size', type=int, default=1000,
+                    help='number of job ids requested per page from the target API. default is 1000')
+parser.add_argument('--WORKERS', dest='workers', type=int, default=8,
+                    help='number of API requests (and sacct calls) to run in parallel. default is 8')
+parser.add_argument('--SACCT_CHUNK', dest='sacct_chunk', type=int, default=1000,
+                    help='max number of job ids passed to a single sacct call. default is 1000')
+parser.add_argument('--KEYSET', dest='keyset', action='store_true',
+                    help='walk the TARGET jobs with a (startdate, jobslurmid) cursor, one page at a time, '
+                         'instead of fetching numbered pages in parallel.')
+parser.add_argument('--METRICS_DIR', dest='metrics_dir', type=str, default='.',
+                    help='where to write the run metrics (prometheus textfile + json summary). default is .')
+parser.add_argument('--TRACE', dest='trace', type=str,
+                    help='write a trace of the API requests to this file (chrome trace-event json)')
+parser.add_argument('--HTTP_CACHE_DIR', dest='http_cache_dir', type=str, default='.http_cache',
+                    help='where to keep projects/allocations responses for conditional requests, '
+                         '"" to always fetch them in full. default is .http_cache')
+
+parsed = parser.parse_args()
+START = parsed.start
+END = parsed.end
+DEBUG = not parsed.push
+MODE = parsed.MODE
+
+PRICE_FILE = parsed.price_file
+PAGE_SIZE = max(1, parsed.page_size)
+WORKERS = max(1, parsed.workers)
+SACCT_CHUNK_SIZE = max(1, parsed.sacct_chunk)
+KEYSET = parsed.keyset
+CONFIG_FILE = 'missing_jobs_{}.conf'.format(MODE)
+LOG_FILE = ('missing_jobs_{}_debug.log' if DEBUG else 'missing_jobs_{}.log').format(MODE)
+BASE_URL = parsed.api_url or 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
+
+if START is None:
+    current_month = datetime.datetime.now().month
+    current_year = datetime.datetime.now().year
+    break_month = '06' if MODE == MODE_MYBRC else '10'
+    year = current_year if current_month >= int(break_month) else (current_year - 1)
+    START = '{}-{}-01T00:00:00'.format(year, break_month)
+
+# sacct takes local times, the API utc time stamps
+START_TS = timeconv.parse_timestamp(START, local=True)
+END_TS = timeconv.parse_timestamp(END, local=True)
+
+TRACER = tracing.Tracer(parsed.trace)
+TRACER.install()
+LIMITER = ratelimit.RateLimiter.for_api(BASE_URL)  # shared with the other scripts on this host
+HTTP_CACHE = httpcache.ValidatorCache(parsed.http_cache_dir) if parsed.http_cache_dir else None
+METRICS = metrics.RunMetrics('missing_jobs', {'mode': MODE, 'debug': str(DEBUG).lower()},
+                             tracer=TRACER, limiter=LIMITER, cache=HTTP_CACHE)
+METRICS.install(parsed.metrics_dir, LOG_FILE[:-len('.log')])
+
+logging.basicConfig(filename=LOG_FILE, level=logging.INFO,
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    datefmt='%Y-%m-%dT%H:%M:%S')
+
+if not os.path.exists(CONFIG_FILE):
+    print('config file {} missing'.format(CONFIG_FILE))
+    logging.info('auth config file missing [{}], exiting run'.format(CONFIG_FILE))
+    exit(0)
+
+with open(CONFIG_FILE, 'r') as f:
+    AUTH_TOKEN = f.read().strip()
+
+if DEBUG:
+    print('---DEBUG RUN---')
+
+print('starting run, using endpoint {} [{}, {}]'.format(BASE_URL, START, END))
+logging.info('starting run, using endpoint {} [{}, {}]'.format(BASE_URL, START, END))
+
+
+def get_prices_by_partition(price_file_path):
+    """Return a dict that maps partition name to a float representing
+    the price of a single CPU-hour on that partition, given the path to
+    the pricing file."""
+    config = configparser.ConfigParser()
+    parsed_file_paths = config.read(price_file_path)
+    assert price_file_path in parsed_file_paths
+    prices_by_partition = {}
+    for name, price in config.items('PartitionPrice'):
+        prices_by_partition[name.strip()] = float(price.strip())
+    return prices_by_partition
+
+
+def get_price_per_hour(partition):
+    if partition in PRICES_BY_PARTITION:
+        return PRICES_BY_PARTITION[partition]
+
+    # If the partition is not found, use a multiplier of 0.
+    message = 'Unexpected partition: {}'.format(partition)
+    print(message)
+    logging.info(message)
+    return float(0)
+
+
+def api_page(request_url):
+    '''a page of jobs/, its jobs decoded as they are read'''
+    request = urllib2.Request(request_url)
+    request.add_header('Authorization', AUTH_TOKEN)
+    return METRICS.urlopen_page(request)
+
+
+def read_jobids_page(request_url):
+    '''(ids of the jobs on a page of jobs/, count of the listing)'''
+    page = api_page(request_url)
+    ids = [job['jobslurmid'] for job in page.iter_results()]
+    return ids, page['count']
+
+
+def log_retry(request_url, attempt, error):
+    logging.warning('retrying {} (attempt {}): {}'.format(request_url, attempt + 1, error))
+    METRICS.add_retry(request_url, attempt, error)
+
+
+RETRY = pagination.Retry(on_retry=log_retry)
+
+
+def chunked(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def slurm_jobids():
+    '''ids of the jobs that started in the window, from a single sacct call'''
+    METRICS.start_phase('sacct_ids')
+    process = subprocess.Popen(['sacct', '-a', '-S', START, '-E', END, '--format=JobID,Start', '-naPX'],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=timeconv.sacct_env())
+    ids = jobids.JobIdSet()
+    for line in process.stdout:
+        METRICS.add_bytes(len(line))
+        jobid, _, start = line.rstrip('\n').partition('|')
+        # pending jobs haven't started, jobs that started before the window are not asked from the API either
+        if start.isdigit() and START_TS <= int(start) <= END_TS:
+            ids.add(jobid)
+    process.wait()
+
+    METRICS.add_items(len(ids))
+    return ids
+
+
+def api_jobids():
+    '''ids of the jobs the API has that started in the window, pages fetched WORKERS at a time
+    (or walked with the keyset cursor, with --KEYSET).
+    Returns None if a page could not be fetched after retrying, the difference would be wrong.'''
+    METRICS.start_phase('api_ids')
+    # fields= keeps the pages small where the API supports it, the ids are all that's needed
+    params = {'start_time': START_TS, 'end_time': END_TS, 'page_size': PAGE_SIZE, 'fields': 'jobslurmid'}
+
+    def fetch(page):
+        try:
+            with TRACER.span('api_jobids_page', page=page):
+                ids, _ = RETRY.call(read_jobids_page, pagination.page_url(BASE_URL + 'jobs/', dict(params, page=page)))
+            return ids
+        except Exception as e:
+            logging.error('[api_jobids()] page {} failed: {}'.format(page, e))
+            return None
+
+    if KEYSET:
+        try:
+            ids = jobids.JobIdSet(job['jobslurmid'] for job in
+                                  pagination.paginate_keyset(api_page, BASE_URL + 'jobs/', params, RETRY))
+        except Exception as e:
+            logging.error('[api_jobids()] failed: {}'.format(e))
+            return None
+
+        METRICS.add_items(len(ids))
+        return ids
+
+    try:
+        first, count = RETRY.call(read_jobids_page, pagination.page_url(BASE_URL + 'jobs/', params))
+    except Exception as e:
+        logging.error('[api_jobids()] failed: {}'.format(e))
+        return None
+
+    ids = jobids.JobIdSet(first)
+    page_size = len(first) or PAGE_SIZE  # what the API actually used
+    pages = (count + page_size - 1) // page_size
+
+    pool = ThreadPool(WORKERS)
+    try:
+        for results in pool.imap_unordered(fetch, range(2, pages + 1)):
+            if results is None:
+                return None
+            ids.update(results)
+    finally:
+        pool.close()
+
+    METRICS.add_items(len(ids))
+    return ids
+
+
+def sacct_jobs(chunk):
+    out, _ = subprocess.Popen(['sacct', '-j', ','.join(chunk), '--format=' + jobs.SACCT_FORMAT, '-n', '-P', '-X'],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=timeconv.sacct_env()).communicate()
+    return out
+
+
+def lookup_jobs(missing):
+    '''JobTable of the missing jobs that have finished, and the number still running'''
+    METRICS.start_phase('sacct')
+    table = jobs.JobTable()
+    running = []
+
+    def finished(jobid, state):
+        if state in reconcile.SKIPPED_STATES:
+            running.append(jobid)
+            return False
+        return True
+
+    pool = ThreadPool(WORKERS)
+    try:
+        for out in pool.imap_unordered(sacct_jobs, list(chunked(list(missing), SACCT_CHUNK_SIZE))):
+            METRICS.add_bytes(len(out))
+            errors = table.extend_sacct(out, get_price_per_hour, select=finished)
+            for jobid, reason in errors:
+                METRICS.add_error()
+                logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, reason))
+    finally:
+        pool.close()
+
+    METRICS.add_items(len(table))
+    return table, len(running)
+
+
+def push_jobs(table):
+    '''PUT jobs to the TARGET (or only log them in DEBUG), returns the number of jobs handled'''
+    if DEBUG:
+        for jobid, job in table.payloads():
+            logging.info('{} COLLECTED : {}'.format(jobid, job))
+
+        return 0
+
+    METRICS.start_phase('push')
+    counter = 0
+    for jobid, job in table.payloads():
+        request_data = urllib.urlencode(job)
+        url_target = BASE_URL + 'jobs/' + str(jobid) + '/'
+        req = urllib2.Request(url=url_target, data=request_data)
+
+        req.add_header('Authorization', AUTH_TOKEN)
+        req.get_method = lambda: 'PUT'
+
+        try:
+            json.loads(METRICS.urlopen(req))
+            logging.info('{} PUSHED/UPDATED : {}'.format(jobid, job))
+            METRICS.add_items()
+            counter += 1
+
+        except urllib2.URLError as e:
+            METRICS.add_error()
+            logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, getattr(e, 'reason', e)))
+
+    return counter
+
+
+print('Reading partition prices from {}'.format(PRICE_FILE))
+logging.info('Reading partition prices from {}'.format(PRICE_FILE))
+PRICES_BY_PARTITION = get_prices_by_partition(PRICE_FILE)
+
+started = time.time()
+print('gathering job ids from slurmdb')
+logging.info('gathering job ids from slurmdb')
+slurm = slurm_jobids()
+
+print('gathering job ids from {}db'.format(MODE))
+logging.info('gathering job ids from {}db'.format(MODE))
+api = api_jobids()
+if api is None:
+    print('ERR: could not read all job ids from {}, exiting run'.format(BASE_URL))
+    logging.error('could not read all job ids from {}, exiting run'.format(BASE_URL))
+    METRICS.fail()
+    exit(1)
+
+METRICS.start_phase('compare')
+missing = slurm - api
+orphans = api - slurm
+METRICS.add_items(len(slurm) + len(api))
+
+message = '{} jobs in slurmdb, {} in {}db: {} missing from {}db, {} not in slurmdb ({:.1f}s)'.format(
+    len(slurm), len(api), MODE, len(missing), MODE, len(orphans), time.time() - started)
+print(message)
+logging.info(message)
+if len(orphans):
+    logging.warning('jobs in {}db that are not in slurmdb: {}'.format(MODE, ', '.join(orphans)))
+
+table, running = lookup_jobs(missing)
+if running:
+    print('{} missing jobs are still running, rerun after they end to push them'.format(running))
+    logging.info('{} missing jobs are still running'.format(running))
+
+if not DEBUG:
+    print('updating mybrcdb with {} jobs'.format(len(table)))
+    logging.info('updating mybrcdb with {} jobs'.format(len(table)))
+else:
+    print('DEBUG: collected {} jobs to update'.format(len(table)))
+    logging.info('DEBUG: collected {} jobs to update'.format(len(table)))
+
+counter = push_jobs(table)
+
+if DEBUG:
+    print('DEBUG run complete, updated 0 jobs.')
+    logging.info('DEBUG run complete, updated 0 jobs.')
+else:
+    print('run complete, pushed/updated {} jobs.'.format(counter))
+    logging.info('run complete, pushed/updated {} jobs.'.format(counter))
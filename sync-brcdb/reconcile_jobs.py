@@ -0,0 +1,400 @@
+#!/usr/bin/python
+import os
+import time
+import urllib2
+import urllib
+import json
+import datetime
+import itertools
+import subprocess
+import logging
+import argparse
+import sys
+from multiprocessing.pool import ThreadPool
+
+from six.moves import configparser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from bankutils import httpcache, jobs, metrics, pagination, ratelimit, reconcile, timeconv, tracing  # noqa: E402
+
+
+docstr = '''
+Find where MyBRC/MyLRC DB and Slurm-DB disagree, by comparing job totals per account, then per month and
+per day (see bankutils/reconcile.py), and re-push only the jobs of the days that differ.
+By Default, will launch in DEBUG mode where data is only collected and logged, not PUSHED upstream.
+To actually update data upstream, look at the --PUSH flag.
+'''
+
+MODE_MYBRC = 'mybrc'
+MODE_MYLRC = 'mylrc'
+
+
+def check_valid_date(s):
+    '''check if date is in valid format(s)'''
+    try:
+        timeconv.parse_timestamp(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid time specification {}'.format(s))
+
+    return s
+
+
+parser = argparse.ArgumentParser(description=docstr)
+parser.add_argument('-s', dest='start', type=check_valid_date,
+                    help='starttime for the query period (YYYY-MM-DD[THH:MM:SS]). Defaults to start of current allocation period.')
+parser.add_argument('-e', dest='end', type=check_valid_date,
+                    help='endtime for the query period (YYYY-MM-DD[THH:MM:SS]). Defaults to NOW.',
+                    default=timeconv.format_timestamp(timeconv.utc2local(time.time())))
+parser.add_argument('-T', dest='MODE',
+                    help='which target API to use', required=True,
+                    choices=[MODE_MYBRC, MODE_MYLRC])
+parser.add_argument('--PUSH', dest='push', action='store_true',
+                    help='launch script in PROD mode, this will PUSH updates to the target API.')
+parser.add_argument('--API_URL', dest='api_url', type=str,
+                    help='override the target API base url (eg. staging, or the stand-in server in bench/)')
+parser.add_argument('--PRICE_FILE', dest='price_file', type=str,
+                    default='/etc/slurm/bank-config.toml',
+                    help='which price file to use. default is /etc/slurm/bank-config.toml')
+parser.add_argument('--WORKERS', dest='workers', type=int, default=8,
+                    help='number of API requests to run in parallel. default is 8')
+parser.add_argument('--SACCT_BLOCK', dest='sacct_block', type=int, default=100000,
+                    help='number of sacct lines parsed at once. default is 100000')
+parser.add_argument('--METRICS_DIR', dest='metrics_dir', type=str, default='.',
+                    help='where to write the run metrics (prometheus textfile + json summary). default is .')
+parser.add_argument('--TRACE', dest='trace', type=str,
+                    help='write a trace of the API requests to this file (chrome trace-event json)')
+parser.add_argument('--HTTP_CACHE_DIR', dest='http_cache_dir', type=str, default='.http_cache',
+                    help='where to keep projects/allocations responses for conditional requests, '
+                         '"" to always fetch them in full. default is .http_cache')
+
+parsed = parser.parse_args()
+START = parsed.start
+END = parsed.end
+DEBUG = not parsed.push
+MODE = parsed.MODE
+
+PRICE_FILE = parsed.price_file
+WORKERS = max(1, parsed.workers)
+SACCT_BLOCK = max(1, parsed.sacct_block)
+CONFIG_FILE = 'reconcile_jobs_{}.conf'.format(MODE)
+LOG_FILE = ('reconcile_jobs_{}_debug.log' if DEBUG else 'reconcile_jobs_{}.log').format(MODE)
+BASE_URL = parsed.api_url or 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
+
+if START is None:
+    current_month = datetime.datetime.now().month
+    current_year = datetime.datetime.now().year
+    break_month = '06' if MODE == MODE_MYBRC else '10'
+    year = current_year if current_month >= int(break_month) else (current_year - 1)
+    START = '{}-{}-01T00:00:00'.format(year, break_month)
+
+# sacct takes local times, the API utc time stamps
+START_TS = timeconv.parse_timestamp(START, local=True)
+END_TS = timeconv.parse_timestamp(END, local=True)
+
+TRACER = tracing.Tracer(parsed.trace)
+TRACER.install()
+LIMITER = ratelimit.RateLimiter.for_api(BASE_URL)  # shared with the other scripts on this host
+HTTP_CACHE = httpcache.ValidatorCache(parsed.http_cache_dir) if parsed.http_cache_dir else None
+METRICS = metrics.RunMetrics('reconcile_jobs', {'mode': MODE, 'debug': str(DEBUG).lower()},
+                             tracer=TRACER, limiter=LIMITER, cache=HTTP_CACHE)
+METRICS.install(parsed.metrics_dir, LOG_FILE[:-len('.log')])
+
+logging.basicConfig(filename=LOG_FILE, level=logging.INFO,
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    datefmt='%Y-%m-%dT%H:%M:%S')
+
+if not os.path.exists(CONFIG_FILE):
+    print('config file {} missing'.format(CONFIG_FILE))
+    logging.info('auth config file missing [{}], exiting run'.format(CONFIG_FILE))
+    exit(0)
+
+with open(CONFIG_FILE, 'r') as f:
+    AUTH_TOKEN = f.read().strip()
+
+if DEBUG:
+    print('---DEBUG RUN---')
+
+print('starting run, using endpoint {} [{}, {}]'.format(BASE_URL, START, END))
+logging.info('starting run, using endpoint {} [{}, {}]'.format(BASE_URL, START, END))
+
+
+def get_prices_by_partition(price_file_path):
+    """Return a dict that maps partition name to a float representing
+    the price of a single CPU-hour on that partition, given the path to
+    the pricing file."""
+    config = configparser.ConfigParser()
+    parsed_file_paths = config.read(price_file_path)
+    assert price_file_path in parsed_file_paths
+    prices_by_partition = {}
+    for name, price in config.items('PartitionPrice'):
+        prices_by_partition[name.strip()] = float(price.strip())
+    return prices_by_partition
+
+
+def get_price_per_hour(partition):
+    if partition in PRICES_BY_PARTITION:
+        return PRICES_BY_PARTITION[partition]
+
+    # If the partition is not found, use a multiplier of 0.
+    message = 'Unexpected partition: {}'.format(partition)
+    print(message)
+    logging.info(message)
+    return float(0)
+
+
+def api_request(request_url):
+    request = urllib2.Request(request_url)
+    request.add_header('Authorization', AUTH_TOKEN)
+    return json.loads(METRICS.urlopen(request))
+
+
+def api_page(request_url):
+    '''a page of a listing, its results decoded as they are read'''
+    request = urllib2.Request(request_url)
+    request.add_header('Authorization', AUTH_TOKEN)
+    return METRICS.urlopen_page(request)
+
+
+def log_retry(request_url, attempt, error):
+    logging.warning('retrying {} (attempt {}): {}'.format(request_url, attempt + 1, error))
+    METRICS.add_retry(request_url, attempt, error)
+
+
+RETRY = pagination.Retry(on_retry=log_retry)
+
+
+def paginate_requests(url, params):
+    '''yield the results of a paginated endpoint, one page at a time.
+    A page that still fails after retrying raises pagination.PageError'''
+    with TRACER.span('paginate_requests', url=url, params=params):
+        for result in pagination.paginate(api_page, url, params, RETRY):
+            yield result
+
+
+def get_totals(account, begin, end):
+    '''totals of the jobs of account that started in [begin, end] according to the API'''
+    # only the totals are needed, not the jobs on the first page
+    params = {'account': account, 'start_time': begin, 'end_time': end, 'page_size': 1}
+    try:
+        with TRACER.span('get_totals', account=account):
+            response = RETRY.call(api_request, pagination.page_url(BASE_URL + 'jobs/', params))
+        return reconcile.Totals.from_response(response)
+    except Exception as e:
+        logging.error('[get_totals({}, {}, {})] failed: {}'.format(account, begin, end, e))
+        return None
+
+
+def sacct(accounts, start, end):
+    '''running `sacct` over [start, end] (local time strings), for all accounts if accounts is None'''
+    command = ['sacct', '-S', start, '-E', end, '--format=' + jobs.SACCT_FORMAT, '-naPX']
+    command.extend(['-a'] if accounts is None else ['-A', ','.join(accounts)])
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=timeconv.sacct_env())
+
+
+def local_time(epoch):
+    return timeconv.format_timestamp(timeconv.utc2local(epoch))
+
+
+def collect_totals():
+    '''per account, per day totals of every job in the window, from a single sacct call
+    parsed SACCT_BLOCK lines at a time'''
+    totals = reconcile.DayTotals(START_TS, END_TS)
+    METRICS.start_phase('sacct')
+    process = sacct(None, START, END)
+    while True:
+        block = ''.join(itertools.islice(process.stdout, SACCT_BLOCK))
+        if not block:
+            break
+        METRICS.add_bytes(len(block))
+
+        METRICS.start_phase('parse')
+        for jobid, reason in totals.add_sacct(block, get_price_per_hour):
+            METRICS.add_error()
+            logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, reason))
+        METRICS.add_items(block.count('\n'))
+        METRICS.start_phase('sacct')
+
+    process.wait()
+    METRICS.end_phase()
+    return totals
+
+
+def differs(job, api_job):
+    '''True if the API's copy of a job is out of date'''
+    if api_job is None:
+        return True
+
+    try:
+        end = timeconv.parse_timestamp(api_job['enddate']) if api_job.get('enddate') else None
+        return api_job['jobstatus'] != job['jobstatus'] or \
+            abs(float(api_job['amount']) - float(job['amount'])) > reconcile.AMOUNT_TOLERANCE or \
+            end != timeconv.parse_timestamp(job['enddate'])
+    except (KeyError, TypeError, ValueError):
+        return True
+
+
+def collect_jobs(account, days):
+    '''the jobs of the given days of an account that the API is missing or has out of date,
+    and the ids of the jobs only the API has'''
+    process = sacct([account], local_time(min(days)), local_time(min(max(days) + reconcile.DAY - 1, END_TS)))
+    out, _ = process.communicate()
+    METRICS.add_bytes(len(out))
+
+    sacct_jobids = set()  # every job sacct listed, also those left out of the table (pending, running, no Start)
+
+    def select(jobid, state):
+        sacct_jobids.add(jobid)
+        return state not in reconcile.SKIPPED_STATES
+
+    table = jobs.JobTable()
+    errors = table.extend_sacct(out, get_price_per_hour, select=select)
+    for jobid, reason in errors:
+        sacct_jobids.add(jobid)
+        METRICS.add_error()
+        logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, reason))
+
+    api_jobs = {}
+    failed_days = set()
+    for day in days:
+        params = {'account': account, 'start_time': max(day, START_TS),
+                  'end_time': min(day + reconcile.DAY - 1, END_TS)}
+        day_jobs = {}
+        try:
+            for api_job in paginate_requests(BASE_URL + 'jobs/', params):
+                day_jobs[str(api_job['jobslurmid'])] = api_job
+        except Exception as e:
+            # with part of the day's jobs its other jobs would look missing, leave the day for a later run
+            METRICS.add_error()
+            logging.error('[paginate_requests({}, {})] failed, skipping the day: {}'.format(
+                BASE_URL + 'jobs/', params, e))
+            failed_days.add(day)
+            continue
+        api_jobs.update(day_jobs)
+
+    collected = {}
+    for row in range(len(table)):
+        day = reconcile.day_start(table.start[row])
+        if day not in days or day in failed_days or not START_TS <= table.start[row] <= END_TS:
+            continue
+
+        jobid = table.jobid(row)
+        job = table.payload(row)
+        if differs(job, api_jobs.get(jobid)):
+            collected[jobid] = job
+
+    return collected, sorted(set(api_jobs) - sacct_jobids)
+
+
+def push_jobs(table):
+    '''PUT jobs to the TARGET (or only log them in DEBUG), returns the number of jobs handled'''
+    if DEBUG:
+        for jobid, job in sorted(table.items()):
+            logging.info('{} COLLECTED : {}'.format(jobid, job))
+
+        return 0
+
+    METRICS.start_phase('push')
+    counter = 0
+    for jobid, job in sorted(table.items()):
+        request_data = urllib.urlencode(job)
+        url_target = BASE_URL + 'jobs/' + str(jobid) + '/'
+        req = urllib2.Request(url=url_target, data=request_data)
+
+        req.add_header('Authorization', AUTH_TOKEN)
+        req.get_method = lambda: 'PUT'
+
+        try:
+            json.loads(METRICS.urlopen(req))
+            logging.info('{} PUSHED/UPDATED : {}'.format(jobid, job))
+            METRICS.add_items()
+            counter += 1
+
+        except urllib2.URLError as e:
+            METRICS.add_error()
+            logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, getattr(e, 'reason', e)))
+
+    return counter
+
+
+print('Reading partition prices from {}'.format(PRICE_FILE))
+logging.info('Reading partition prices from {}'.format(PRICE_FILE))
+PRICES_BY_PARTITION = get_prices_by_partition(PRICE_FILE)
+
+print('gathering accounts from {}db'.format(MODE))
+logging.info('gathering accounts from {}db'.format(MODE))
+
+METRICS.start_phase('projects')
+try:
+    accounts = sorted(set(str(project['name']) for project in paginate_requests(BASE_URL + 'projects/', {})))
+except Exception as e:
+    print('ERR: could not read projects from {}, exiting run'.format(BASE_URL))
+    logging.error('[paginate_requests({}, {})] failed: {}'.format(BASE_URL + 'projects/', {}, e))
+    METRICS.fail()
+    exit(1)
+METRICS.add_items(len(accounts))
+
+print('gathering job totals from slurmdb')
+logging.info('gathering job totals from slurmdb')
+totals = collect_totals()
+
+unknown = totals.accounts() - set(accounts)
+if unknown:
+    logging.info('{} accounts in slurmdb are not in {}db: {}'.format(len(unknown), MODE, ', '.join(sorted(unknown))))
+
+print('comparing job totals of {} accounts with {}db'.format(len(accounts), MODE))
+logging.info('comparing job totals of {} accounts with {}db'.format(len(accounts), MODE))
+
+METRICS.start_phase('compare')
+pool = ThreadPool(WORKERS)
+try:
+    mismatched, unsettled, stats = reconcile.compare(totals, accounts, get_totals, pool.map)
+finally:
+    pool.close()
+METRICS.add_items(sum(count for level, count in stats.items() if level != 'failed'))
+METRICS.add_error(stats['failed'])
+
+message = 'compared {} account, {} month and {} day totals ({} failed): {} days differ, {} more have running jobs'.format(
+    stats['account'], stats.get('month', 0), stats.get('day', 0), stats['failed'], len(mismatched), len(unsettled))
+print(message)
+logging.info(message)
+for account, day in unsettled:
+    logging.info('{} {} differs, but has running jobs'.format(account, timeconv.format_timestamp(day)[:10]))
+
+# drill into the days that differ, one sacct call per account
+METRICS.start_phase('jobs')
+days_by_account = {}
+for account, day in mismatched:
+    days_by_account.setdefault(account, set()).add(day)
+
+table = {}
+orphans = 0
+for account, days in sorted(days_by_account.items()):
+    collected, only_api = collect_jobs(account, days)
+    table.update(collected)
+    METRICS.add_items(len(collected))
+
+    logging.info('{} {} days differ ({}), {} jobs to update'.format(
+        account, len(days), ', '.join(timeconv.format_timestamp(day)[:10] for day in sorted(days)), len(collected)))
+    if only_api:
+        orphans += len(only_api)
+        logging.warning('{} {} jobs in {}db are not in slurmdb: {}'.format(
+            account, len(only_api), MODE, ', '.join(only_api)))
+
+if orphans:
+    print('{} jobs in {}db are not in slurmdb, see {}'.format(orphans, MODE, LOG_FILE))
+
+if not DEBUG:
+    print('updating mybrcdb with {} jobs'.format(len(table)))
+    logging.info('updating mybrcdb with {} jobs'.format(len(table)))
+else:
+    print('DEBUG: collected {} jobs to update'.format(len(table)))
+    logging.info('DEBUG: collected {} jobs to update'.format(len(table)))
+
+counter = push_jobs(table)
+
+if DEBUG:
+    print('DEBUG run complete, updated 0 jobs.')
+    logging.info('DEBUG run complete, updated 0 jobs.')
+else:
+    print('run complete, pushed/updated {} jobs.'.format(counter))
+    logging.info('run complete, pushed/updated {} jobs.'.format(counter))
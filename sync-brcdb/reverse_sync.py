@@ -6,14 +6,23 @@ import urllib2
 import json
 import argparse
 import subprocess
+import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from bankutils import allocations, httpcache, metrics, pagination, ratelimit, tracing  # noqa: E402
 
-docstr = '''
-Sync projects (and all their jobs) between MyBRC/MyLRC with Slurm-DB.
-This will update SLURM with the latest values for each job collected from MyBRC/MyLRC.
 
-This will only write out a file containing all changes to be made (corresponding slurm commands).
-It will not update ANY data in SLURM on its own. To do so, run the output file generated.
+docstr = '''
+Sync the allocations of projects from MyBRC/MyLRC to Slurm-DB.
+This compares each project's allocation in MyBRC/MyLRC with the
+GrpTRESMins cpu limit of its account in SLURM (read with a single sacctmgr call).
+
+The sacctmgr commands for the accounts whose limit drifted (every account with --ALL) are
+written to reverse_sync_output_<mode>.sh, and a drift summary (accounts changed, unchanged and
+not in SLURM, and the largest changes) is printed. Without --APPLY, SLURM is not updated: run
+the output file to do so. With --APPLY, the changes are also applied through one sacctmgr -i
+session per batch of accounts (--APPLY_BATCH), then the limits are read back from SLURM and
+every account whose limit is not the one asked for is reported as an error.
 '''
 
 MODE_MYBRC = 'mybrc'
@@ -23,6 +32,21 @@ parser = argparse.ArgumentParser(description=docstr)
 parser.add_argument('-T', dest='MODE',
                     help='which target API to use', required=True,
                     choices=[MODE_MYBRC, MODE_MYLRC])
+parser.add_argument('--API_URL', dest='api_url', type=str,
+                    help='override the target API base url (eg. staging, or the stand-in server in bench/)')
+parser.add_argument('--ALL', dest='all', action='store_true',
+                    help='write commands for every account, even if its limit in slurm is already up to date')
+parser.add_argument('--APPLY', dest='apply', action='store_true',
+                    help='also apply the changes, through a single sacctmgr -i session per batch, and verify them')
+parser.add_argument('--APPLY_BATCH', dest='apply_batch', type=int, default=500,
+                    help='max number of accounts modified per sacctmgr session in --APPLY mode. default is 500')
+parser.add_argument('--METRICS_DIR', dest='metrics_dir', type=str, default='.',
+                    help='where to write the run metrics (prometheus textfile + json summary). default is .')
+parser.add_argument('--TRACE', dest='trace', type=str,
+                    help='write a trace of the API requests to this file (chrome trace-event json)')
+parser.add_argument('--HTTP_CACHE_DIR', dest='http_cache_dir', type=str, default='.http_cache',
+                    help='where to keep projects/allocations responses for conditional requests, '
+                         '"" to always fetch them in full. default is .http_cache')
 
 parsed = parser.parse_args()
 MODE = parsed.MODE
@@ -30,7 +54,7 @@ DEBUG = False
 
 CONFIG_FILE = 'reverse_sync_{}.conf'.format(MODE)
 LOG_FILE = ('reverse_sync_{}_debug.log' if DEBUG else 'reverse_sync_{}.log').format(MODE)
-BASE_URL = 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
+BASE_URL = parsed.api_url or 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
 
 COMPUTE_RESOURCES_TABLE = {
     MODE_MYBRC: {
@@ -50,6 +74,14 @@ COMPUTE_RESOURCES_TABLE = {
     }
 }
 
+TRACER = tracing.Tracer(parsed.trace)
+TRACER.install()
+LIMITER = ratelimit.RateLimiter.for_api(BASE_URL)  # shared with the other scripts on this host
+HTTP_CACHE = httpcache.ValidatorCache(parsed.http_cache_dir) if parsed.http_cache_dir else None
+METRICS = metrics.RunMetrics('reverse_sync', {'mode': MODE, 'debug': str(DEBUG).lower()},
+                             tracer=TRACER, limiter=LIMITER, cache=HTTP_CACHE)
+METRICS.install(parsed.metrics_dir, LOG_FILE[:-len('.log')])
+
 logging.basicConfig(filename=LOG_FILE, level=logging.INFO,
                     format='%(asctime)s %(levelname)-8s %(message)s',
                     datefmt='%Y-%m-%dT%H:%M:%S')
@@ -69,54 +101,39 @@ print('starting run, using endpoint {0} ...'.format(BASE_URL))
 logging.info('starting run, using endpoint {0} ...'.format(BASE_URL))
 
 
-def paginate_requests(url, params=None):
-    request_url = url
-    params = params or {}
+def log_retry(request_url, attempt, error):
+    logging.warning('retrying {0} (attempt {1}): {2}'.format(request_url, attempt + 1, error))
+    METRICS.add_retry(request_url, attempt, error)
 
-    if params:
-        request_url = url + '?' + urllib.urlencode(params)
 
-    try:
-        req = urllib2.Request(request_url)
-        req.add_header('Authorization', AUTH_TOKEN)
-        response = json.loads(urllib2.urlopen(req).read())
-
-    except urllib2.URLError as e:
-        if DEBUG:
-            print('[paginate_requests({0}, {1})] failed: {2}'.format(url, params, e))
-            logging.error('[paginate_requests({0}, {1})] failed: {2}'.format(url, params, e))
+RETRY = pagination.Retry(on_retry=log_retry)
 
-        return []
 
-    current_page = 1
-    results = []
-    results.extend(response['results'])
-    while response['next'] is not None:
-        try:
-            current_page += 1
-            params['page'] = current_page
-            request_url = url + '?' + urllib.urlencode(params)
-            req = urllib2.Request(request_url)
-            req.add_header('Authorization', AUTH_TOKEN)
-            response = json.loads(urllib2.urlopen(req).read())
-
-            results.extend(response['results'])
-            if current_page % 5 == 0:
-                print('\tgetting page: {0}'.format(current_page))
-
-            if current_page > 50:
-                print('too many pages to sync at once, rerun script after this run completes...')
-                logging.warning('too many pages to sync at once, rerun script after this run completes...')
-                break
+def paginate_requests(url, params=None):
+    '''yield the results of a paginated endpoint, one page at a time'''
+    pages = [0]
 
-        except urllib2.URLError as e:
-            response['next'] = None
+    def fetch(request_url):
+        req = urllib2.Request(request_url)
+        req.add_header('Authorization', AUTH_TOKEN)
+        response = json.loads(METRICS.urlopen(req))
 
-            if DEBUG:
-                print('[paginate_requests()] failed: {0}'.format(e))
-                logging.error('[paginate_requests({0}, {1})] failed: {2}'.format(url, params, e))
+        pages[0] += 1
+        if pages[0] % 5 == 0:
+            print('\tgetting page: {0}'.format(pages[0]))
+        return response
 
-    return results
+    try:
+        with TRACER.span('paginate_requests', url=url, params=params):
+            for result in pagination.paginate(fetch, url, params, RETRY):
+                yield result
+    except pagination.PageError as e:
+        # a listing that stops early would look complete, stop the run instead
+        METRICS.add_error()
+        print('[paginate_requests({0}, {1})] failed: {2}'.format(url, params, e))
+        logging.error('[paginate_requests({0}, {1})] failed: {2}'.format(url, params, e))
+        METRICS.fail()
+        exit(1)
 
 
 def single_request(url, params=None):
@@ -127,9 +144,10 @@ def single_request(url, params=None):
         request_url = url + '?' + urllib.urlencode(params)
 
     try:
-        request = urllib2.Request(request_url)
-        request.add_header('Authorization', AUTH_TOKEN)
-        response = json.loads(urllib2.urlopen(request).read())
+        with TRACER.span('single_request', url=request_url):
+            request = urllib2.Request(request_url)
+            request.add_header('Authorization', AUTH_TOKEN)
+            response = json.loads(METRICS.urlopen(request))
     except Exception as e:
         response = {'results': None}
 
@@ -141,62 +159,132 @@ def single_request(url, params=None):
 
 
 def get_project_allocation(project_name):
-    allocation_id_url = BASE_URL + 'allocations/'
-
-    header = project.split('_')[0]
-    compute_resources = COMPUTE_RESOURCES_TABLE[MODE].get(header, '{} Compute'.format(header.upper()))
-    response = single_request(allocation_id_url, {'project': project_name, 'resources': compute_resources})
-    if not response or len(response) == 0:
+    compute_resources = allocations.compute_resource(COMPUTE_RESOURCES_TABLE[MODE], project_name)
+    attribute = ALLOCATIONS.attribute(project_name, compute_resources)
+    if attribute is None:
         if DEBUG:
             print('[get_project_allocation({0})] ERR'.format(project_name))
             logging.error('[get_project_allocation({0})] ERR'.format(project_name))
 
         return None
 
-    allocation_id = response[0]['id']
-    allocation_url = allocation_id_url + '{0}/attributes/'.format(allocation_id)
-    response = single_request(allocation_url, {'type': 'Service Units'})
-    if not response:
-        return None
-
-    allocation = response[0]['value']
+    allocation = attribute['value']
     allocation = int(float(allocation))
 
     return allocation
 
 
 def get_project_start(project_name):
-    allocations_url = BASE_URL + 'allocations/'
-
-    header = project.split('_')[0]
-    compute_resources = COMPUTE_RESOURCES_TABLE[MODE].get(header, '{} Compute'.format(header.upper()))
-    response = single_request(allocations_url, {'project': project_name, 'resources': compute_resources})
-    if not response or len(response) == 0:
+    compute_resources = allocations.compute_resource(COMPUTE_RESOURCES_TABLE[MODE], project_name)
+    creation = ALLOCATIONS.start_date(project_name, compute_resources)
+    if creation is None:
         if DEBUG:
             print('[get_project_start({0})] ERR'.format(project_name))
             logging.error('[get_project_start({0})] ERR'.format(project_name))
 
         return None
 
-    creation = response[0]['start_date']
-    if not creation:
+    return creation
+    # return '{0}T00:00:00'.format(creation)
+
+
+def get_slurm_limits():
+    """Current GrpTRESMins of every account in the slurmdb, as
+    {account: {tres: minutes}}, from a single sacctmgr call. Returns None if
+    sacctmgr could not be run."""
+    try:
+        process = subprocess.Popen(['sacctmgr', 'show', 'assoc', '-P', '-n', 'format=Account,User,GrpTRESMins'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+    except OSError as e:
+        print('[get_slurm_limits()] failed: {0}'.format(e))
+        logging.error('[get_slurm_limits()] failed: {0}'.format(e))
         return None
 
-    return creation if '.' not in creation else creation.split('.')[0]
-    # return '{0}T00:00:00'.format(creation)
+    if process.returncode != 0:
+        print('[get_slurm_limits()] failed: {0}'.format(err.strip()))
+        logging.error('[get_slurm_limits()] failed: {0}'.format(err.strip()))
+        return None
+
+    METRICS.add_bytes(len(out))
+    limits = {}
+    for line in out.splitlines():
+        fields = line.split('|')
+        if len(fields) < 3 or fields[1]:  # user associations carry no account limit
+            continue
+
+        tres = {}
+        for item in fields[2].split(','):
+            name, _, value = item.partition('=')
+            if name and value.isdigit():
+                tres[name] = int(value)
+        limits[fields[0]] = tres
+
+    return limits
+
+
+def apply_limits(changes):
+    """Set GrpTRESMins cpu=<minutes> for {account: minutes}, feeding the
+    modify commands to one `sacctmgr -i` process per batch of accounts
+    (accounts with the same limit share a command), instead of one
+    sacctmgr process per account. Returns the accounts whose limit is not
+    what was asked for afterwards."""
+    names = sorted(changes)
+    batch_size = max(1, parsed.apply_batch)
+    for index in range(0, len(names), batch_size):
+        by_limit = {}
+        for name in names[index:index + batch_size]:
+            by_limit.setdefault(changes[name], []).append(name)
+
+        script = ''.join('modify account where name={0} set GrpTRESMins=cpu={1}\n'.format(','.join(accounts), minutes)
+                         for minutes, accounts in sorted(by_limit.items()))
+        process = subprocess.Popen(['sacctmgr', '-i'], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out, _ = process.communicate(script)
+        logging.info('sacctmgr -i ({0} accounts, {1} commands), exit {2}: {3}'.format(
+            len(names[index:index + batch_size]), len(by_limit), process.returncode, out.strip()))
+        METRICS.add_items(len(names[index:index + batch_size]))
+
+    # sacctmgr's own output is not per account, check the result instead
+    limits = get_slurm_limits() or {}
+    return [name for name in names if limits.get(name, {}).get('cpu') != changes[name]]
 
 
 print('gathering accounts from {}db...'.format(MODE))
 logging.info('gathering data from {}db...'.format(MODE))
 
 # NOTE(vir): ignore abc and vector for now
-project_table = paginate_requests(BASE_URL + 'projects/')
-project_table = filter(
-    lambda p: p['name'] != 'abc' and not p['name'].startswith('vector_'),
-    project_table)
+METRICS.start_phase('projects')
+project_table = [project for project in paginate_requests(BASE_URL + 'projects/')
+                 if project['name'] != 'abc' and not project['name'].startswith('vector_')]
+METRICS.add_items(len(project_table))
+
+# all allocations in one sweep, then the Service Units of the ones we need
+METRICS.start_phase('allocations')
+ALLOCATIONS = allocations.AllocationIndex.load(paginate_requests, BASE_URL)
+METRICS.add_items(len(ALLOCATIONS))
+
+METRICS.start_phase('attributes')
+keys = [(project['name'], allocations.compute_resource(COMPUTE_RESOURCES_TABLE[MODE], project['name']))
+        for project in project_table]
+METRICS.add_items(ALLOCATIONS.load_attributes(single_request, BASE_URL, keys=keys))
+
+METRICS.start_phase('project_allocation')
 for project in project_table:
     project['allocation'] = get_project_allocation(project['name'])
     project['start'] = get_project_start(project['name'])
+    METRICS.add_items()
+
+print('gathering current limits from slurmdb...')
+logging.info('gathering current limits from slurmdb...')
+
+METRICS.start_phase('slurm_limits')
+slurm_limits = get_slurm_limits()
+if slurm_limits is None:
+    print('could not read current limits, writing commands for every account')
+    logging.warning('could not read current limits, writing commands for every account')
+else:
+    METRICS.add_items(len(slurm_limits))
 
 # NOTE(vir): can use this to update fca.conf file
 '''
@@ -214,16 +302,39 @@ for project in project_table:
 print('writing data to file (slurmdb commands)...')
 logging.info('writing data to file (slurmdb commands)...')
 
+METRICS.start_phase('write')
 commands = ''
+changes = {}
+drift = {'unchanged': 0, 'changed': 0, 'missing': 0}
+largest = []
 for project in project_table:
     if ('allocation' not in project) or ('name' not in project) or (project['allocation'] == None):
         print('[project: {0}] ERR, could not set allocation (value={1})'.format(project['name'], project['allocation']))
         logging.error('[project: {0}] ERR, could not set allocation (value={1})'.format(project['name'], project['allocation']))
+        METRICS.add_error()
         continue
 
     allocation_in_seconds = 60 * project['allocation']
+    if slurm_limits is not None:
+        if project['name'] not in slurm_limits:
+            logging.warning('[project: {0}] not found in slurmdb, skipping'.format(project['name']))
+            drift['missing'] += 1
+            continue
+
+        current = slurm_limits[project['name']].get('cpu')
+        if current == allocation_in_seconds:
+            drift['unchanged'] += 1
+            if not parsed.all:
+                continue
+        else:
+            drift['changed'] += 1
+            largest.append((abs(allocation_in_seconds - (current or 0)), project['name'], current, allocation_in_seconds))
+            logging.info('[project: {0}] GrpTRESMins cpu={1} -> cpu={2}'.format(project['name'], current, allocation_in_seconds))
+
     command = 'yes | sacctmgr modify account {0} set GrpTRESMins="cpu={1}"'.format(project['name'], allocation_in_seconds)
     commands += '\n' + command
+    changes[project['name']] = allocation_in_seconds
+    METRICS.add_items()
 
     # NOTE(vir): actually update data in SLURM
     # out, _ = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True).communicate()
@@ -236,6 +347,28 @@ for project in project_table:
 with open('reverse_sync_output_{}.sh'.format(MODE), 'w') as f:
     f.writelines(commands)
 
+if slurm_limits is not None:
+    print('drift: {0} accounts changed, {1} unchanged, {2} not in slurmdb'.format(
+        drift['changed'], drift['unchanged'], drift['missing']))
+    logging.info('drift: {0} accounts changed, {1} unchanged, {2} not in slurmdb'.format(
+        drift['changed'], drift['unchanged'], drift['missing']))
+    for _, name, current, target in sorted(largest, reverse=True)[:10]:
+        print('\t{0}: cpu={1} -> cpu={2}'.format(name, current, target))
+
+if parsed.apply and changes:
+    print('applying {0} changes with sacctmgr...'.format(len(changes)))
+    logging.info('applying {0} changes with sacctmgr...'.format(len(changes)))
+
+    METRICS.start_phase('apply')
+    failed = apply_limits(changes)
+    METRICS.add_error(len(failed))
+    for name in failed:
+        print('[project: {0}] ERR, GrpTRESMins not updated'.format(name))
+        logging.error('[project: {0}] ERR, GrpTRESMins not updated'.format(name))
+
+    print('applied {0} changes, {1} failed'.format(len(changes) - len(failed), len(failed)))
+    logging.info('applied {0} changes, {1} failed'.format(len(changes) - len(failed), len(failed)))
+
 print('run complete, wrote output to reverse_sync_output_{}.sh, exiting...'.format(MODE))
 logging.info('run complete, wrote output to reverse_sync_output_{}.sh, exiting...'.format(MODE))
 
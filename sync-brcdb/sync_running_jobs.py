@@ -5,14 +5,19 @@ import urllib2
 import urllib
 import json
 import datetime
-import calendar
 import subprocess
 import argparse
 import datetime
 import logging
+import signal
+import sys
+from multiprocessing.pool import ThreadPool
 
 from six.moves import configparser
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from bankutils import httpcache, jobs, metrics, pagination, ratelimit, timeconv, tracing  # noqa: E402
+
 
 docstr = '''
 Sync running jobs between MyBRC/MyLRC DB with Slurm-DB.
@@ -21,50 +26,18 @@ To actually update data upstream, look at the --PUSH flag.
 '''
 
 
-timestamp_format_complete = '%Y-%m-%dT%H:%M:%S'
-timestamp_format_minimal = '%Y-%m-%d'
 MODE_MYBRC = 'mybrc'
 MODE_MYLRC = 'mylrc'
 
 
 def check_valid_date(s):
     '''check if date is in valid format(s)'''
-    complete, minimal = None, None
-
-    try:
-        complete = datetime.datetime.strptime(s, timestamp_format_complete)
-    except Exception:
-        pass
-
-    try:
-        minimal = datetime.datetime.strptime(s, timestamp_format_minimal)
-    except Exception:
-        pass
-
-    if not complete and not minimal:
-        raise argparse.ArgumentTypeError('Invalid time specification {}'.format(s))
-    else:
-        return s
-
-
-# date time string -> time stamp
-def to_timestamp(date_time, to_utc=False):
     try:
-        dt_obj = datetime.datetime.strptime(date_time, timestamp_format_complete)
+        timeconv.parse_timestamp(s)
     except ValueError:
-        dt_obj = datetime.datetime.strptime(date_time, timestamp_format_minimal)
-
-    if to_utc:
-        return time.mktime(dt_obj.timetuple())
-
-    else:
-        return calendar.timegm(dt_obj.timetuple())
-
+        raise argparse.ArgumentTypeError('Invalid time specification {}'.format(s))
 
-# utc time stamp -> utc date time string
-def to_timestring(timestamp):
-    date_time = datetime.datetime.utcfromtimestamp(timestamp)
-    return date_time.strftime(timestamp_format_complete), date_time
+    return s
 
 
 parser = argparse.ArgumentParser(description=docstr)
@@ -72,15 +45,36 @@ parser.add_argument('-s', dest='start', type=check_valid_date,
                     help='starttime for the query period (YYYY-MM-DD[THH:MM:SS]). Defaults to start of current allocation period.')
 parser.add_argument('-e', dest='end', type=check_valid_date,
                     help='endtime for the query period (YYYY-MM-DD[THH:MM:SS]). Defaults to NOW.',
-                    default=datetime.datetime.utcnow().strftime(timestamp_format_complete))
+                    default=timeconv.format_timestamp(time.time()))
 parser.add_argument('-T', dest='MODE',
                     help='which target API to use', required=True,
                     choices=[MODE_MYBRC, MODE_MYLRC])
 parser.add_argument('--PUSH', dest='push', action='store_true',
                     help='launch script in PROD mode, this will PUSH updates to the TARGET.')
+parser.add_argument('--API_URL', dest='api_url', type=str,
+                    help='override the target API base url (eg. staging, or the stand-in server in bench/)')
 parser.add_argument('--PRICE_FILE', dest='price_file', type=str,
                     default='/etc/slurm/bank-config.toml',
                     help='which price file to use. default is /etc/slurm/bank-config.toml')
+parser.add_argument('--SACCT_CHUNK', dest='sacct_chunk', type=int, default=1000,
+                    help='max number of job ids passed to a single sacct call. default is 1000')
+parser.add_argument('--SACCT_WORKERS', dest='sacct_workers', type=int, default=4,
+                    help='number of sacct calls to run in parallel. default is 4')
+parser.add_argument('--METRICS_DIR', dest='metrics_dir', type=str, default='.',
+                    help='where to write the run metrics (prometheus textfile + json summary). default is .')
+parser.add_argument('--TRACE', dest='trace', type=str,
+                    help='write a trace of the API requests to this file (chrome trace-event json)')
+parser.add_argument('--HTTP_CACHE_DIR', dest='http_cache_dir', type=str, default='.http_cache',
+                    help='where to keep projects/allocations responses for conditional requests, '
+                         '"" to always fetch them in full. default is .http_cache')
+parser.add_argument('--RECONCILE', dest='reconcile', action='store_true',
+                    help='keep running after the initial sync, and update jobs as soon as they finish in the slurmdb.')
+parser.add_argument('--INTERVAL', dest='interval', type=int, default=60,
+                    help='seconds between slurmdb polls in --RECONCILE mode. default is 60')
+parser.add_argument('--REFRESH', dest='refresh', type=int, default=300,
+                    help='seconds between checks for new RUNNING jobs in the TARGET in --RECONCILE mode. default is 300')
+parser.add_argument('--KEYSET', dest='keyset', action='store_true',
+                    help='page through the TARGET jobs with a (startdate, jobslurmid) cursor instead of page numbers.')
 
 parsed = parser.parse_args()
 START = parsed.start
@@ -89,9 +83,17 @@ DEBUG = not parsed.push
 MODE = parsed.MODE
 
 PRICE_FILE = parsed.price_file
+SACCT_CHUNK_SIZE = max(1, parsed.sacct_chunk)
+SACCT_WORKERS = max(1, parsed.sacct_workers)
+RECONCILE = parsed.reconcile
+INTERVAL = max(1, parsed.interval)
+REFRESH = max(INTERVAL, parsed.refresh)
+KEYSET = parsed.keyset
+POLL_OVERLAP = 120
+FINISHED_STATES = 'BF,CA,CD,DL,F,NF,OOM,PR,RQ,TO'
 CONFIG_FILE = 'sync_running_jobs_{}.conf'.format(MODE)
 LOG_FILE = ('sync_running_jobs_{}_debug.log' if DEBUG else 'sync_running_jobs_{}.log').format(MODE)
-BASE_URL = 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
+BASE_URL = parsed.api_url or 'https://{}/api/'.format('mybrc.brc.berkeley.edu' if MODE == MODE_MYBRC else 'mylrc.lbl.gov')
 
 if START is None:
     current_month = datetime.datetime.now().month
@@ -102,7 +104,15 @@ if START is None:
     START = default_start
 
 # convert to UTC
-START = to_timestring(to_timestamp(START, to_utc=True))[0]
+START = timeconv.format_timestamp(timeconv.parse_timestamp(START, local=True))
+
+TRACER = tracing.Tracer(parsed.trace)
+TRACER.install()
+LIMITER = ratelimit.RateLimiter.for_api(BASE_URL)  # shared with the other scripts on this host
+HTTP_CACHE = httpcache.ValidatorCache(parsed.http_cache_dir) if parsed.http_cache_dir else None
+METRICS = metrics.RunMetrics('sync_running_jobs', {'mode': MODE, 'debug': str(DEBUG).lower()},
+                             tracer=TRACER, limiter=LIMITER, cache=HTTP_CACHE)
+METRICS.install(parsed.metrics_dir, LOG_FILE[:-len('.log')])
 
 logging.basicConfig(filename=LOG_FILE, level=logging.INFO,
                     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -136,183 +146,252 @@ def get_prices_by_partition(price_file_path):
     return prices_by_partition
 
 
-def calculate_hours(duration_seconds):
-    return duration_seconds / 3600
+def get_price_per_hour(partition):
+    if partition in PRICES_BY_PARTITION:
+        return PRICES_BY_PARTITION[partition]
 
+    # If the partition is not found, use a multiplier of 0.
+    message = 'Unexpected partition: {}'.format(partition)
+    print(message)
+    logging.info(message)
+    return float(0)
 
-def calculate_amount(partition, cpu_count, duration_hrs, prices_by_partition):
-    if partition in prices_by_partition:
-        price_per_hour = prices_by_partition[partition]
-    else:
-        # If the partition is not found, use a multiplier of 0.
-        message = 'Unexpected partition: {}'.format(partition)
-        print(message)
-        logging.info(message)
-        price_per_hour = float(0)
-    return round(price_per_hour * int(cpu_count) * duration_hrs, 2)
 
+def chunked(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
 
-def calculate_cpu_time(num_cpus, duration_hrs):
-    return duration_hrs * float(num_cpus)
 
+def sacct_jobs(jobids):
+    out, _ = subprocess.Popen(['sacct', '-j', ','.join(jobids), '--format=' + jobs.SACCT_FORMAT, '-n', '-P', '-X'],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=timeconv.sacct_env()).communicate()
+    return out
 
-def node_list_format(nodelist):
-    nodes = nodelist.split(',')
 
-    table = []
-    for node in nodes:
-        if '-' in node:
-            extension = node.split('.')[-1]
-            start, end = node.split(',')[0][1:]
+def log_retry(request_url, attempt, error):
+    logging.warning('retrying {} (attempt {}): {}'.format(request_url, attempt + 1, error))
+    METRICS.add_retry(request_url, attempt, error)
 
-            for current in range(int(start), int(end) + 1):
-                current = 'n{:04d}.{}'.format(current, extension)
-                table.append({"name": current})
 
-        else:
-            table.append({"name": node})
+RETRY = pagination.Retry(on_retry=log_retry)
 
-    return table
 
+def get_running_jobs(start_ts=None, end_ts=None, resume=None):
+    """Yield the jobs the TARGET believes are RUNNING, one page at a time.
+    A page that can't be fetched, even after retrying, raises
+    pagination.PageError. Its params continue the listing where it stopped,
+    when passed back as resume."""
+    if resume is None:
+        start_ts = timeconv.parse_timestamp(START) if start_ts is None else start_ts
+        end_ts = timeconv.parse_timestamp(END) if end_ts is None else end_ts
+        request_params = {'jobstatus': 'RUNNING',
+                          'start_time': start_ts, 'end_time': end_ts}
+    else:
+        request_params = resume
+    pages = [0]
 
-def get_running_jobs():
-    start_ts = to_timestamp(START)
-    end_ts = to_timestamp(END)
-
-    request_params = {'jobstatus': 'RUNNING',
-                      'start_time': start_ts, 'end_time': end_ts}
-    url_target = BASE_URL + 'jobs?' + urllib.urlencode(request_params)
-
-    try:
+    def fetch(url_target):
         req = urllib2.Request(url_target)
         req.add_header('Authorization', AUTH_TOKEN)
-        response = json.loads(urllib2.urlopen(req).read())
-    except urllib2.URLError as e:
-        if DEBUG:
-            print('[get_running_jobs()] failed: {} {}'.format(request_params, e))
-            logging.error('[get_running_jobs()] failed: {} {}'.format(request_params, e))
-
-        return []
-
-    current_page = 0
-    job_table = []
-    job_table.extend(response['results'])
-    while response['next'] is not None:
-        try:
-            current_page += 1
-            request_params = {'jobstatus': 'RUNNING', 'page': current_page,
-                              'start_time': start_ts, 'end_time': end_ts}
-            url_target = BASE_URL + '/jobs?' + urllib.urlencode(request_params)
-            req = urllib2.Request(url_target)
-            req.add_header('Authorization', AUTH_TOKEN)
-            response = json.loads(urllib2.urlopen(req).read())
-
-            job_table.extend(response['results'])
-            if current_page % 5 == 0:
-                print("\tgetting page: {}".format(current_page))
-
-            if current_page > 50:
-                print('too many jobs to update at once, rerun script after this run completes')
-                logging.warning('too many jobs to update at once, rerun script after this run completes')
-                break
+        response = METRICS.urlopen_page(req)  # the jobs are decoded as paginate() reads them
+
+        pages[0] += 1
+        if pages[0] % 5 == 0:
+            print("\tgetting page: {}".format(pages[0]))
+        return response
+
+    paginate = pagination.paginate_keyset if KEYSET else pagination.paginate
+    with TRACER.span('get_running_jobs', params=request_params):
+        for job in paginate(fetch, BASE_URL + 'jobs/', request_params, RETRY):
+            yield job
+
+
+def parse_jobs(out, running, table):
+    """Add the jobs in a block of sacct output to table, except for job
+    steps, jobs still running in the slurmdb and jobs that are not RUNNING
+    in the TARGET."""
+    METRICS.start_phase('parse')
+    parsed_jobs = jobs.JobTable()
+    errors = parsed_jobs.extend_sacct(out, get_price_per_hour,
+                                      select=lambda jobid, state: state != 'RUNNING' and '.' not in jobid and jobid in running)
+    for jobid, reason in errors:
+        METRICS.add_error()
+        logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, reason))
+
+    for jobid, job in parsed_jobs.payloads():
+        if job['jobstatus'] == 'COMPLETED':
+            job['jobstatus'] = 'COMPLETING'
+
+        table[jobid] = job
+        METRICS.add_items()
+
+
+def lookup_jobs(jobids, running):
+    """Collect the latest state of the given jobs from the slurmdb.
+
+    Job ids are passed to sacct in bounded chunks (a single -j argument with
+    every job id can exceed ARG_MAX), with a few calls in flight at once, and
+    each chunk is parsed as soon as it comes back."""
+    chunks = list(chunked(jobids, SACCT_CHUNK_SIZE))
+    print('gathering latest state from slurmdb ({} jobs, {} sacct calls)'.format(len(jobids), len(chunks)))
+    logging.info('gathering latest state from slurmdb ({} jobs, {} sacct calls)'.format(len(jobids), len(chunks)))
+
+    table = {}
+    METRICS.start_phase('sacct')
+    pool = ThreadPool(SACCT_WORKERS)
+    for index, out in enumerate(pool.imap_unordered(sacct_jobs, chunks)):
+        METRICS.add_items(out.count('\n'))
+        METRICS.add_bytes(len(out))
+
+        parse_jobs(out, running, table)
+
+        METRICS.start_phase('sacct')
+        if (index + 1) % max(1, int(len(chunks) / 10)) == 0:
+            print('\tprogress: {}/{}'.format(index + 1, len(chunks)))
+
+    pool.close()
+    return table
 
-        except urllib2.URLError as e:
-            response['next'] = None
 
-            if DEBUG:
-                print('[get_running_jobs()] failed: {}'.format(e))
-                logging.error('[get_running_jobs()] failed: {}'.format(e))
+def push_jobs(table):
+    """PUT jobs to the TARGET (or only log them in DEBUG), returns the ids of
+    the jobs that were handled."""
+    if DEBUG:
+        for jobid, job in table.items():
+            logging.info('{} COLLECTED : {}'.format(jobid, job))
 
-    return job_table
+        return list(table.keys())
 
+    METRICS.start_phase('push')
+    pushed = []
+    for jobid, job in table.items():
+        request_data = urllib.urlencode(job)
+        url_target = BASE_URL + 'jobs/' + str(jobid) + '/'
+        req = urllib2.Request(url=url_target, data=request_data)
 
-print('Reading partition prices from {}'.format(PRICE_FILE))
-logging.info('Reading partition prices from {}'.format(PRICE_FILE))
-PRICES_BY_PARTITION = get_prices_by_partition(PRICE_FILE)
+        req.add_header('Authorization', AUTH_TOKEN)
+        req.get_method = lambda: 'PUT'
 
+        try:
+            json.loads(METRICS.urlopen(req))
+            logging.info('{} UPDATED : {}'.format(jobid, job))
+            METRICS.add_items()
+            pushed.append(jobid)
 
-print('gathering running jobs from {}db'.format(MODE))
-logging.info('gathering running jobs from {}db'.format(MODE))
+            if len(pushed) % max(1, int(len(table) / 10)) == 0 and len(table) >= 10:
+                print('\tprogress: {}/{}'.format(len(pushed), len(table)))
 
-# collect jobs
-jobs = ''
-for job in get_running_jobs():
-    jobs += job['jobslurmid'] + '\n'
+        except urllib2.URLError as e:
+            logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, getattr(e, 'reason', e)))
 
-print('gathering latest state from slurmdb')
-logging.info('gathering latest state from slurmdb')
-lines = jobs.splitlines()
+    return pushed
 
-# collect job stats from slurm
-jobids_str = ''
-for line in lines:
-    jobids_str += line.strip() + ','
-jobids_str = jobids_str[:-1]
 
-out = subprocess.Popen(['sacct', '-j', jobids_str,
-                        '--format=JobId,Submit,Start,End,UID,Account,State,Partition,QOS,NodeList,AllocCPUS,ReqNodes,AllocNodes,CPUTimeRAW,CPUTime', '-n', '-P'],
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-job_stats = out.communicate()[0].splitlines()
+def poll_finished_jobs(since, until, running):
+    """Jobs that left the RUNNING state in the slurmdb within [since, until]."""
+    METRICS.start_phase('poll')
+    out, _ = subprocess.Popen(['sacct', '-a', '-X', '-n', '-P',
+                               '-S', timeconv.format_timestamp(since), '-E', timeconv.format_timestamp(until),
+                               '--state={}'.format(FINISHED_STATES),
+                               '--format=' + jobs.SACCT_FORMAT],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=timeconv.sacct_env()).communicate()
+    METRICS.add_items(out.count('\n'))
+    METRICS.add_bytes(len(out))
 
-print('parsing jobs')
-logging.info('parsing jobs')
+    table = {}
+    parse_jobs(out, running, table)
+    return table
 
-# parse data
-table = {}
-for current in job_stats:
-    current = current.split('|')
-    current = [str(temp.decode('utf-8')) for temp in current]
-    jobid, submit, start, end, uid, account, state, partition, qos, nodelist, alloc_cpus, req_nodes, alloc_nodes, cpu_time_raw, cpu_time = current
 
-    if '.bat' in jobid:
-        continue
+def reconcile(running, last_poll, resume=None):
+    """Keep the set of jobs the TARGET believes are RUNNING in memory, and
+    poll the slurmdb for jobs that finished since the previous poll. New
+    RUNNING jobs are picked up from the TARGET every REFRESH seconds. resume
+    continues a listing of RUNNING jobs that failed part way."""
+    print('reconciling {} running jobs every {}s, ctrl-c to stop'.format(len(running), INTERVAL))
+    logging.info('reconciling {} running jobs every {}s'.format(len(running), INTERVAL))
+
+    last_refresh = last_poll
+    unpushed = {}
+    while True:
+        time.sleep(max(0, last_poll + INTERVAL - time.time()))
+        now = time.time()
+        table = {}
+
+        if now - last_refresh >= REFRESH:
+            METRICS.start_phase('refresh')
+            added = set()
+
+            def collect(listing):
+                for job in listing:
+                    jobid = str(job['jobslurmid'])
+                    if jobid not in running:
+                        added.add(jobid)
+
+            try:
+                if resume is not None:  # the rest of a listing that failed before
+                    collect(get_running_jobs(resume=resume))
+                    resume = None
+                collect(get_running_jobs(last_refresh - POLL_OVERLAP, now))
+                last_refresh = now
+            except pagination.PageError as e:
+                # the window is listed again next time, a failed resume continues where it stopped
+                METRICS.add_error()
+                logging.error('[reconcile()] refresh failed, retrying at the next poll: {}'.format(e))
+                if resume is not None:
+                    resume = e.params
+            METRICS.add_items(len(added))
+
+            # these may have finished before they made it into the set
+            if added:
+                running |= added
+                table.update(lookup_jobs(sorted(added), added))
+
+        # overlap the windows a little, slurmdb writes can lag behind the job end
+        table.update(poll_finished_jobs(last_poll - POLL_OVERLAP, now, running))
+        table.update(unpushed)
+        last_poll = now
+
+        handled = push_jobs(table)
+        for jobid in handled:
+            running.discard(jobid)
+            unpushed.pop(jobid, None)
+        for jobid in set(table) - set(handled):
+            unpushed[jobid] = table[jobid]
+
+        if table:
+            print('{} reconciled {} jobs, {} failed, {} still running'.format(
+                timeconv.format_timestamp(now), len(handled), len(unpushed), len(running)))
+        logging.info('reconciled {} jobs, {} failed, {} still running'.format(len(handled), len(unpushed), len(running)))
+        METRICS.write(parsed.metrics_dir, LOG_FILE[:-len('.log')])
 
-    # if it is running in the slurmdb, skip it
-    if state == 'RUNNING':
-        continue
 
-    if jobid not in jobs:
-        continue
+print('Reading partition prices from {}'.format(PRICE_FILE))
+logging.info('Reading partition prices from {}'.format(PRICE_FILE))
+PRICES_BY_PARTITION = get_prices_by_partition(PRICE_FILE)
 
-    if '.' in jobid:
-        continue
 
-    if state == 'COMPLETED':
-        state = 'COMPLETING'
+print('gathering running jobs from {}db'.format(MODE))
+logging.info('gathering running jobs from {}db'.format(MODE))
 
-    try:
-        # NOTE(vir): times in SLURM are UTC
-        submit, _ = to_timestring(to_timestamp(submit, to_utc=False))
-        start, _start = to_timestring(to_timestamp(start, to_utc=False))
-        end, _end = to_timestring(to_timestamp(end, to_utc=False))
-        raw_time_hrs = calculate_hours((_end - _start).total_seconds())
-
-        cpu_time = calculate_cpu_time(alloc_cpus, raw_time_hrs)
-        amount = calculate_amount(
-            partition, alloc_cpus, raw_time_hrs, PRICES_BY_PARTITION)
-        node_list_converted = node_list_format(nodelist)
-
-        table[jobid] = {
-            'jobslurmid': jobid,
-            'submitdate': submit,
-            'startdate': start,
-            'enddate': end,
-            'userid': uid,
-            'accountid': account,
-            'amount': str(amount),
-            'jobstatus': state,
-            'partition': partition,
-            'qos': qos,
-            'nodes': node_list_converted,
-            'num_cpus': int(alloc_cpus),
-            'num_req_nodes': int(req_nodes),
-            'num_alloc_nodes': int(alloc_nodes),
-            'raw_time': raw_time_hrs,
-            'cpu_time': float(cpu_time)}
-
-    except Exception as e:
-        logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, e))
+# collect jobs
+started = time.time()
+METRICS.start_phase('running_jobs')
+running = set()
+resume = None
+try:
+    for job in get_running_jobs():
+        running.add(str(job['jobslurmid']))
+        METRICS.add_items()
+except pagination.PageError as e:
+    # the jobs read so far are still updated, but the run is reported as incomplete
+    METRICS.add_error()
+    print('ERR: could not read all RUNNING jobs from {}db, continuing with {}: {}'.format(MODE, len(running), e))
+    logging.error('could not read all RUNNING jobs from {}db, continuing with {}: {}'.format(MODE, len(running), e))
+    resume = e.params
 
+# collect job stats from slurm
+table = lookup_jobs(sorted(running), running)
 
 if not DEBUG:
     print('updating mybrcdb with {} jobs'.format(len(table)))
@@ -322,33 +401,27 @@ else:
     print('DEBUG: collected {} jobs to update in mybrcdb'.format(len(table)))
     logging.info('DEBUG: collected {} jobs to update in mybrcdb'.format(len(table)))
 
-    for jobid, job in table.items():
-        logging.info('{} COLLECTED : {}'.format(jobid, job))
+# push data
+handled = push_jobs(table)
+running.difference_update(handled)
 
+if DEBUG:
     print('DEBUG run complete, updated 0 jobs.')
     logging.info('DEBUG run complete, updated 0 jobs.')
-    exit(0)
-
-# push data
-counter = 0
-for jobid, job in table.items():
-    request_data = urllib.urlencode(job)
-    url_target = BASE_URL + 'jobs/' + str(jobid) + '/'
-    req = urllib2.Request(url=url_target, data=request_data)
+else:
+    print('run complete, updated {} jobs.'.format(len(handled)))
+    logging.info('run complete, updated {} jobs.'.format(len(handled)))
 
-    req.add_header('Authorization', AUTH_TOKEN)
-    req.get_method = lambda: 'PUT'
+if resume is not None and not RECONCILE:
+    print('run incomplete, RUNNING jobs from {} on were not read'.format(pagination.page_url(BASE_URL + 'jobs/', resume)))
+    logging.error('run incomplete, RUNNING jobs from {} on were not read'.format(pagination.page_url(BASE_URL + 'jobs/', resume)))
+    METRICS.fail()
+    exit(1)
 
+if RECONCILE:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        json.loads(urllib2.urlopen(req).read())
-        logging.info('{} UPDATED : {}'.format(jobid, job))
-        counter += 1
-
-        if counter % int(len(table) / 10) == 0:
-            print('\tprogress: {}/{}'.format(counter, len(table)))
-
-    except urllib2.HTTPError as e:
-        logging.warning('ERROR occured for jobid: {} REASON: {}'.format(jobid, e.reason))
-
-print('run complete, updated {} jobs.'.format(counter))
-logging.info('run complete, updated {} jobs.'.format(counter))
+        reconcile(running, started, resume)
+    except KeyboardInterrupt:
+        print('stopping reconcile, {} jobs still running'.format(len(running)))
+        logging.info('stopping reconcile, {} jobs still running'.format(len(running)))
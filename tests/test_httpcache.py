@@ -0,0 +1,61 @@
+'''
+Tests of bankutils.httpcache, runnable with python 2 and 3:
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bankutils import httpcache  # noqa: E402
+
+
+URL = 'http://127.0.0.1/api/projects/?page=1'
+HEADERS = {'ETag': '"v1"', 'Last-Modified': 'Mon, 19 Oct 2026 00:00:00 GMT'}
+
+
+class ValidatorCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def caches(self):
+        return httpcache.ValidatorCache(), httpcache.ValidatorCache(os.path.join(self.directory, 'cache'))
+
+    def test_not_modified(self):
+        for cache in self.caches():
+            self.assertEqual(cache.request_headers(URL, 'Token a'), {})
+            self.assertEqual(cache.response(URL, 200, HEADERS.get, b'{"count": 1}', 'Token a'), (200, b'{"count": 1}'))
+            self.assertEqual(cache.request_headers(URL, 'Token a'),
+                             {'If-None-Match': '"v1"', 'If-Modified-Since': HEADERS['Last-Modified']})
+            self.assertEqual(cache.response(URL, 304, {}.get, b'', 'Token a'), (200, b'{"count": 1}'))
+
+    def test_kept_per_credentials(self):
+        for cache in self.caches():
+            cache.response(URL, 200, HEADERS.get, b'{"count": 1}', 'Token a')
+            for other in ('Token b', None):
+                self.assertEqual(cache.request_headers(URL, other), {})
+                self.assertEqual(cache.response(URL, 304, {}.get, b'', other), (304, b''))
+            self.assertEqual(cache.response(URL, 304, {}.get, b'', 'Token a'), (200, b'{"count": 1}'))
+
+    def test_credentials_not_written(self):
+        cache = httpcache.ValidatorCache(os.path.join(self.directory, 'cache'))
+        cache.response(URL, 200, HEADERS.get, b'{}', 'Token secret')
+        for name in os.listdir(cache.directory):
+            with open(os.path.join(cache.directory, name), 'rb') as f:
+                self.assertFalse(b'secret' in f.read())
+
+    def test_not_cacheable(self):
+        for cache in self.caches():
+            url = 'http://127.0.0.1/api/jobs/?page=1'
+            cache.response(url, 200, HEADERS.get, b'{}', 'Token a')
+            self.assertEqual(cache.request_headers(url, 'Token a'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
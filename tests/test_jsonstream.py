@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of bankutils.jsonstream, runnable with python 2 and 3:
+
+    python -m unittest discover tests
+'''
+import io
+import os
+import sys
+import json
+import zlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bankutils import jsonstream  # noqa: E402
+
+
+PAGE = {
+    'count': 3,
+    'next': 'http://127.0.0.1/api/jobs/?page=2',
+    'previous': None,
+    'results': [{'jobslurmid': '1000', 'amount': '1.50', 'userid': u'usér'}, 12345, [1, 2.5e3, None]],
+    'total_cpu_time': 12.5,
+    'total_amount': '7.25',
+}
+
+
+def body(page, indent=None):
+    return json.dumps(page, indent=indent).encode('utf-8')
+
+
+def gzipped(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def split(data, size):
+    return [data[index:index + size] for index in range(0, len(data), size)]
+
+
+class PageTest(unittest.TestCase):
+    def assertPage(self, chunks, page, encoding=None):
+        closed = []
+        streamed = jsonstream.Page(chunks, encoding, on_close=closed.append)
+        self.assertEqual(list(streamed.iter_results()), page.get('results') or [])
+        for key, value in page.items():
+            if key != 'results':
+                self.assertEqual(streamed[key], value)
+        self.assertEqual(closed, [None])
+
+    def test_one_byte_chunks(self):
+        for indent in (None, 2):
+            self.assertPage(split(body(PAGE, indent), 1), PAGE)
+
+    def test_gzip_chunks(self):
+        data = gzipped(body(PAGE))
+        for size in (1, 7, len(data)):
+            self.assertPage(split(data, size), PAGE, 'gzip')
+
+    def test_number_cut_after_point_or_exponent(self):
+        for head, tail in ((b'12.', b'5}'), (b'12', b'.5}'), (b'1', b'2.5}'), (b'1.25e', b'1}')):
+            page = jsonstream.Page([b'{"count": 2, "results": [], "total_cpu_time": ' + head, tail])
+            self.assertEqual(page['total_cpu_time'], json.loads((head + tail)[:-1].decode('ascii')))
+
+    def test_number_in_results_cut(self):
+        page = jsonstream.Page([b'{"results": [1.', b'5, -2', b'e1]}'])
+        self.assertEqual(list(page.iter_results()), [1.5, -20.0])
+
+    def test_fields_after_partial_iteration(self):
+        for size in (1, 1000):
+            page = jsonstream.Page(split(body(PAGE), size))
+            results = page.iter_results()
+            self.assertEqual(next(results), PAGE['results'][0])
+            self.assertEqual(page['next'], PAGE['next'])
+            self.assertEqual(page['total_cpu_time'], PAGE['total_cpu_time'])
+
+    def test_results_after_partial_iteration(self):
+        page = jsonstream.Page(split(body(PAGE), 3))
+        results = page.iter_results()
+        self.assertEqual(next(results), PAGE['results'][0])
+        self.assertEqual(page['results'], PAGE['results'][1:])
+        self.assertEqual(page['count'], 3)
+
+    def test_without_results(self):
+        self.assertPage([b'{"count": 0}'], {'count': 0})
+        self.assertPage([b'{"count": 0, "results": null}'], {'count': 0, 'results': None})
+        self.assertEqual(jsonstream.Page([b'{"results": null}'])['results'], None)
+        self.assertPage([b'{}'], {})
+
+    def test_truncated(self):
+        for data in (body(PAGE)[:-10], body(PAGE)[:40], gzipped(body(PAGE))[:-30]):
+            closed = []
+            page = jsonstream.Page(split(data, 5), 'gzip' if data[:2] == b'\x1f\x8b' else None,
+                                   on_close=closed.append)
+            with self.assertRaises(jsonstream.IncompletePage):
+                page.finish()
+            self.assertEqual(len(closed), 1)
+            self.assertTrue(isinstance(closed[0], jsonstream.IncompletePage))
+
+    def test_close(self):
+        closed = []
+        page = jsonstream.Page(split(body(PAGE), 4), on_close=closed.append)
+        next(page.iter_results())
+        page.close()
+        page.close()
+        self.assertEqual(closed, [None])
+
+    def test_chunks_and_gunzip(self):
+        data = body(PAGE)
+        self.assertEqual(b''.join(jsonstream.chunks(io.BytesIO(data), 10)), data)
+        self.assertEqual(jsonstream.gunzip(gzipped(data), 'gzip'), data)
+        self.assertEqual(jsonstream.gunzip(data, None), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
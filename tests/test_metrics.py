@@ -0,0 +1,58 @@
+'''
+Tests of bankutils.metrics, runnable with python 2 and 3:
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bankutils import metrics  # noqa: E402
+
+
+class RunMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def written(self, run):
+        run.write(self.directory, 'run')
+        with open(os.path.join(self.directory, 'run.prom')) as f:
+            prom = f.read()
+        with open(os.path.join(self.directory, 'run_summary.json')) as f:
+            return prom, json.load(f)
+
+    def test_fail(self):
+        run = metrics.RunMetrics('test', {'mode': 'mylrc'})
+        prom, summary = self.written(run)
+        self.assertTrue('slurm_banking_sync_run_failed{mode="mylrc",script="test"} 0\n' in prom)
+        self.assertEqual(summary['failed'], False)
+
+        run.fail()
+        prom, summary = self.written(run)
+        self.assertTrue('slurm_banking_sync_run_failed{mode="mylrc",script="test"} 1\n' in prom)
+        self.assertEqual(summary['failed'], True)
+
+    def test_phases_and_requests(self):
+        run = metrics.RunMetrics('test')
+        run.start_phase('fetch')
+        run.observe_url('GET', 'http://127.0.0.1/api/allocations/12/attributes/?type=x', 0.02, 0, 100, 200)
+        run.observe_url('GET', 'http://127.0.0.1/api/jobs/?page=2', 0.2, 0, 0, 503)
+        run.start_phase('fetch')
+        run.add_items(3)
+        _, summary = self.written(run)
+        self.assertEqual(summary['phases']['fetch']['items'], 3)
+        self.assertEqual(summary['phases']['fetch']['bytes'], 100)
+        self.assertEqual(summary['phases']['fetch']['errors'], 1)
+        self.assertEqual(summary['http']['GET allocations/attributes']['status'], {'200': 1})
+        self.assertEqual(summary['http']['GET jobs']['status'], {'503': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
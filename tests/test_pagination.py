@@ -0,0 +1,184 @@
+'''
+Tests of bankutils.pagination, runnable with python 2 and 3:
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bankutils import jsonstream, pagination  # noqa: E402
+
+try:
+    from urlparse import urlparse, parse_qsl
+except ImportError:
+    from urllib.parse import urlparse, parse_qsl
+
+
+URL = 'http://127.0.0.1/api/jobs/'
+
+
+class HTTPError(IOError):
+    '''like urllib2's'''
+
+    def __init__(self, code):
+        IOError.__init__(self, 'HTTP Error {}'.format(code))
+        self.code = code
+
+
+def query(request_url):
+    return dict(parse_qsl(urlparse(request_url).query))
+
+
+def body(results, more):
+    return json.dumps({'count': 0, 'next': 'more' if more else None, 'results': results}).encode('utf-8')
+
+
+class Pages(object):
+    '''a stub fetch of pages of `size` results out of `total`, numbered or after a keyset cursor.
+    failures maps the page (or cursor) to the errors its next fetches raise, truncate to the bytes its
+    next (streamed) fetches end after'''
+
+    def __init__(self, total, size, streamed=False, failures=None, truncate=None, ignore_cursor=False):
+        self.results = [{'jobslurmid': str(1000 + index), 'startdate': '2026-01-01T00:00:{:02d}'.format(index)}
+                        for index in range(total)]
+        self.size = size
+        self.streamed = streamed
+        self.failures = failures or {}
+        self.truncate = truncate or {}
+        self.ignore_cursor = ignore_cursor
+        self.requested = []
+
+    def __call__(self, request_url):
+        params = query(request_url)
+        self.requested.append(params)
+        key = params.get('after', params.get('page', '1'))
+        if self.failures.get(key):
+            raise self.failures[key].pop(0)
+
+        if 'after' in params and not self.ignore_cursor:
+            keys = [pagination.keyset_cursor(result) for result in self.results]
+            first = keys.index(params['after']) + 1
+        else:
+            first = (int(params.get('page', 1)) - 1) * self.size
+        data = body(self.results[first:first + self.size], first + self.size < len(self.results))
+
+        if not self.streamed:
+            return json.loads(data.decode('utf-8'))
+        if self.truncate.get(key):
+            data = data[:self.truncate[key].pop(0)]
+        return jsonstream.Page([data[index:index + 7] for index in range(0, len(data), 7)])
+
+
+def retry():
+    return pagination.Retry(attempts=3, backoff=0)
+
+
+class PaginateTest(unittest.TestCase):
+    def test_pages_requested_once_each(self):
+        for streamed in (False, True):
+            pages = Pages(25, 10, streamed)
+            self.assertEqual(list(pagination.paginate(pages, URL)), pages.results)
+            self.assertEqual([params.get('page', '1') for params in pages.requested], ['1', '2', '3'])
+
+    def test_start_page_and_params(self):
+        pages = Pages(25, 10)
+        results = list(pagination.paginate(pages, URL, {'account': 'fc_foo', 'page': 2}))
+        self.assertEqual(results, pages.results[10:])
+        self.assertEqual(pages.requested, [{'account': 'fc_foo', 'page': '2'}, {'account': 'fc_foo', 'page': '3'}])
+
+    def test_lazy(self):
+        pages = Pages(25, 10)
+        next(pagination.paginate(pages, URL))
+        self.assertEqual(len(pages.requested), 1)
+
+    def test_transient_errors_retried(self):
+        pages = Pages(25, 10, failures={'2': [HTTPError(503), IOError('reset')]})
+        policy = retry()
+        self.assertEqual(list(pagination.paginate(pages, URL, None, policy)), pages.results)
+        self.assertEqual((policy.retries, policy.retried_pages), (2, 1))
+
+    def test_page_error_resumes(self):
+        pages = Pages(25, 10, failures={'2': [HTTPError(503)] * 3})
+        results = []
+        with self.assertRaises(pagination.PageError) as raised:
+            for result in pagination.paginate(pages, URL, {'account': 'fc_foo'}, retry()):
+                results.append(result)
+        self.assertEqual(results, pages.results[:10])  # the pages before the one that failed
+        self.assertEqual(raised.exception.params, {'account': 'fc_foo', 'page': 2})
+        self.assertEqual(raised.exception.cause.code, 503)
+
+        results.extend(pagination.paginate(pages, raised.exception.url, raised.exception.params, retry()))
+        self.assertEqual(results, pages.results)
+
+    def test_permanent_error_not_retried(self):
+        pages = Pages(25, 10, failures={'1': [HTTPError(404)]})
+        policy = retry()
+        with self.assertRaises(pagination.PageError):
+            list(pagination.paginate(pages, URL, None, policy))
+        self.assertEqual(policy.retries, 0)
+
+    def test_streamed_page_fetched_again(self):
+        pages = Pages(25, 10, streamed=True, truncate={'2': [150]})
+        policy = retry()
+        self.assertEqual(list(pagination.paginate(pages, URL, None, policy)), pages.results)
+        self.assertEqual([params.get('page', '1') for params in pages.requested], ['1', '2', '2', '3'])
+        self.assertEqual(policy.retries, 1)
+
+    def test_streamed_page_error_after_its_results(self):
+        pages = Pages(25, 10, streamed=True, truncate={'2': [150] * 3})
+        results = []
+        with self.assertRaises(pagination.PageError) as raised:
+            for result in pagination.paginate(pages, URL, None, retry()):
+                results.append(result)
+        self.assertTrue(len(results) > 10)  # what the failing page did yield
+        self.assertEqual(results, pages.results[:len(results)])
+        self.assertEqual(raised.exception.params, {'page': 2})  # read again from its start
+        self.assertTrue(isinstance(raised.exception.cause, jsonstream.IncompletePage))
+
+    def test_streamed_page_without_retry(self):
+        pages = Pages(25, 10, streamed=True, truncate={'1': [40]})
+        with self.assertRaises(pagination.PageError):
+            list(pagination.paginate(pages, URL))
+
+
+class KeysetTest(unittest.TestCase):
+    def test_cursor(self):
+        for streamed in (False, True):
+            pages = Pages(25, 10, streamed)
+            self.assertEqual(list(pagination.paginate_keyset(pages, URL, {'page': 4})), pages.results)
+            self.assertEqual([params.get('after') for params in pages.requested],
+                             [None, pagination.keyset_cursor(pages.results[9]),
+                              pagination.keyset_cursor(pages.results[19])])
+            self.assertTrue(all('page' not in params for params in pages.requested))
+            self.assertEqual(pages.requested[0]['ordering'], 'startdate,jobslurmid')
+
+    def test_fields_include_the_key(self):
+        pages = Pages(5, 10)
+        list(pagination.paginate_keyset(pages, URL, {'fields': 'amount,startdate'}))
+        self.assertEqual(pages.requested[0]['fields'], 'amount,startdate,jobslurmid')
+
+    def test_ignored_cursor(self):
+        pages = Pages(25, 10, ignore_cursor=True)
+        with self.assertRaises(ValueError):
+            list(pagination.paginate_keyset(pages, URL))
+        self.assertEqual(len(pages.requested), 2)
+
+    def test_page_error_resumes_at_the_cursor(self):
+        pages = Pages(25, 10)
+        cursor = pagination.keyset_cursor(pages.results[9])
+        pages.failures = {cursor: [HTTPError(502)] * 3}
+        results = []
+        with self.assertRaises(pagination.PageError) as raised:
+            for result in pagination.paginate_keyset(pages, URL, None, retry()):
+                results.append(result)
+        self.assertEqual(raised.exception.params['after'], cursor)
+
+        results.extend(pagination.paginate_keyset(pages, raised.exception.url, raised.exception.params, retry()))
+        self.assertEqual(results, pages.results)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+'''
+Tests of bankutils.ratelimit, runnable with python 2 and 3:
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bankutils import ratelimit  # noqa: E402
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def limiter(self, **kwargs):
+        return ratelimit.RateLimiter(self.path, **kwargs)
+
+    def state(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_shared_bucket(self):
+        first, second = self.limiter(), self.limiter()
+        for _ in range(5):
+            first.acquire()
+        second.acquire()
+        self.assertAlmostEqual(self.state()['tokens'], ratelimit.BURST - 6, places=0)
+
+    def test_held_lock_falls_back(self):
+        limiter = self.limiter()
+        limiter.acquire()
+        with open(self.path) as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            started = time.time()
+            for _ in range(10):
+                limiter.acquire()
+            self.assertLess(time.time() - started, 0.5)
+            self.assertAlmostEqual(self.state()['tokens'], ratelimit.BURST - 1, places=0)  # not written
+            self.assertGreater(limiter.own_until, time.time())
+
+    def test_fifo_is_not_opened(self):
+        os.mkfifo(self.path)
+        limiter = self.limiter()
+        started = time.time()
+        limiter.acquire()
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(limiter.fd, None)
+
+    def test_file_mode(self):
+        os.umask(os.umask(0o077))
+        self.limiter().acquire()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, ratelimit.STATE_MODE)
+
+    def test_untrusted_files_are_not_used(self):
+        os.chmod(self.directory, 0o777)
+        limiter = self.limiter()
+        limiter.acquire()
+        self.assertEqual(limiter.fd, None)
+        self.assertFalse(os.path.exists(self.path))
+        os.chmod(self.directory, 0o700)
+
+        other = os.path.join(self.directory, 'other')
+        for make in (lambda: os.symlink(other, self.path), lambda: os.link(other, self.path)):
+            with open(other, 'w'):
+                pass
+            make()
+            limiter = self.limiter()
+            limiter.acquire()
+            self.assertEqual(limiter.fd, None)
+            self.assertEqual(os.path.getsize(other), 0)
+            os.remove(self.path)
+
+        with open(self.path, 'w'):
+            pass
+        os.chmod(self.path, 0o666)
+        limiter = self.limiter()
+        limiter.acquire()
+        self.assertEqual(limiter.fd, None)
+
+    def test_interactive_reserve(self):
+        self.limiter(interactive=True).acquire()
+        batch = self.limiter(reserve=ratelimit.BURST - 1)
+        batch.acquire()
+        self.assertGreater(batch.throttled, 0)
+
+    def test_observed_with_the_next_token(self):
+        limiter = self.limiter()
+        with limiter.acquire() as ticket:
+            ticket.status = 503
+        self.assertEqual(self.state()['rate'], ratelimit.RATE)
+        limiter.acquire()
+        self.assertEqual(self.state()['rate'], ratelimit.RATE / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
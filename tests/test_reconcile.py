@@ -0,0 +1,196 @@
+'''
+Tests of bankutils.reconcile and bankutils.jobs, runnable with python 2 and 3:
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import calendar
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bankutils import jobs, reconcile  # noqa: E402
+
+
+PRICES = {'savio2': 0.75, 'savio3': 1.0}
+DAY = reconcile.DAY
+
+
+def utc(*fields):
+    return calendar.timegm(tuple(fields) + (0,) * (6 - len(fields)))
+
+
+def sacct_line(jobid, start, hours, account='fc_foo', state='COMPLETED', partition='savio3', cpus=4):
+    '''a `sacct -P --format=SACCT_FORMAT` line, times as epoch seconds'''
+    end = 'Unknown' if state in reconcile.SKIPPED_STATES else str(int(start + hours * 3600))
+    start = 'Unknown' if state == 'PENDING' else str(start)
+    return '|'.join((jobid, str(utc(2026, 1, 1)), start, end, '40000', account, state, partition, 'savio_normal',
+                     'n0[100-101].savio3', str(cpus), '1', '2', '0', '00:00:00'))
+
+
+def day_totals(lines, start=utc(2026, 9, 20), end=utc(2026, 11, 10, 23, 59, 59)):
+    totals = reconcile.DayTotals(start, end)
+    totals.add_sacct('\n'.join(lines) + '\n', PRICES.get)
+    return totals
+
+
+class SplitTest(unittest.TestCase):
+    def test_split_days(self):
+        begin, end = utc(2026, 10, 5, 13, 20), utc(2026, 10, 7, 0, 0, 0)
+        self.assertEqual(reconcile.split_days(begin, end), [
+            (begin, utc(2026, 10, 5, 23, 59, 59)),
+            (utc(2026, 10, 6), utc(2026, 10, 6, 23, 59, 59)),
+            (utc(2026, 10, 7), utc(2026, 10, 7))])
+
+    def test_split_one_day(self):
+        day = utc(2026, 10, 5)
+        self.assertEqual(reconcile.split_days(day, day + DAY - 1), [(day, day + DAY - 1)])
+        self.assertEqual(reconcile.split_days(day + 60, day + 120), [(day + 60, day + 120)])
+
+    def test_split_months(self):
+        begin, end = utc(2026, 11, 15, 8), utc(2027, 3, 1, 0, 0, 1)
+        self.assertEqual(reconcile.split_months(begin, end), [
+            (begin, utc(2026, 11, 30, 23, 59, 59)),
+            (utc(2026, 12, 1), utc(2026, 12, 31, 23, 59, 59)),
+            (utc(2027, 1, 1), utc(2027, 1, 31, 23, 59, 59)),
+            (utc(2027, 2, 1), utc(2027, 2, 28, 23, 59, 59)),
+            (utc(2027, 3, 1), utc(2027, 3, 1, 0, 0, 1))])
+        self.assertEqual(reconcile.split_months(utc(2028, 2, 1), utc(2028, 2, 29, 23, 59, 59)),
+                         [(utc(2028, 2, 1), utc(2028, 2, 29, 23, 59, 59))])
+
+    def test_jobs_bucketed_by_utc_day(self):
+        totals = day_totals([sacct_line('1', utc(2026, 10, 5, 23, 59, 59), 2),
+                             sacct_line('2', utc(2026, 10, 6), 1)])
+        self.assertEqual(sorted(totals.days['fc_foo']), [utc(2026, 10, 5), utc(2026, 10, 6)])
+        self.assertEqual(totals.total('fc_foo', utc(2026, 10, 6), utc(2026, 10, 6, 23, 59, 59)).count, 1)
+        self.assertEqual(totals.total('fc_foo', utc(2026, 10, 5, 12), utc(2026, 10, 5, 23, 59, 59)).count, 1)
+
+
+class CompareTest(unittest.TestCase):
+    def setUp(self):
+        self.local = [sacct_line('1', utc(2026, 10, 5, 10), 2),
+                      sacct_line('2', utc(2026, 10, 6, 10), 3),
+                      sacct_line('3', utc(2026, 10, 6, 11), 1, account='fc_bar', partition='savio2'),
+                      sacct_line('4', utc(2026, 10, 28, 9), 5, account='fc_bar')]
+        self.requested = []
+
+    def compare(self, local, api, failing=()):
+        local, api = day_totals(local), day_totals(api)
+
+        def fetch(account, begin, end):
+            self.requested.append((account, begin, end))
+            return None if account in failing else api.total(account, begin, end)
+
+        return reconcile.compare(local, local.accounts() | api.accounts(), fetch)
+
+    def test_match(self):
+        mismatched, unsettled, stats = self.compare(self.local, self.local)
+        self.assertEqual((mismatched, unsettled), ([], []))
+        self.assertEqual(stats, {'account': 2, 'month': 0, 'day': 0, 'failed': 0})
+
+    def test_mismatched_day(self):
+        api = self.local[:1] + [sacct_line('2', utc(2026, 10, 6, 10), 2)] + self.local[2:]  # another End
+        mismatched, unsettled, stats = self.compare(self.local, api)
+        self.assertEqual((mismatched, unsettled), ([('fc_foo', utc(2026, 10, 6))], []))
+        # fc_foo's months (sep, oct, nov) then its days of october
+        self.assertEqual((stats['account'], stats['month'], stats['day']), (2, 3, 31))
+        self.assertEqual(self.requested[-1], ('fc_foo', utc(2026, 10, 31), utc(2026, 10, 31, 23, 59, 59)))
+
+    def test_missing_account(self):
+        mismatched, _, _ = self.compare(self.local, self.local + [sacct_line('5', utc(2026, 11, 2), 1, 'fc_baz')])
+        self.assertEqual(mismatched, [('fc_baz', utc(2026, 11, 2))])
+
+    def test_running_jobs_unsettled(self):
+        running = sacct_line('5', utc(2026, 10, 6, 20), 0, state='RUNNING')
+        # the API has charged what the running job used so far, slurmdb's totals leave it out
+        mismatched, unsettled, _ = self.compare(self.local + [running],
+                                                self.local + [sacct_line('5', utc(2026, 10, 6, 20), 2)])
+        self.assertEqual((mismatched, unsettled), ([], [('fc_foo', utc(2026, 10, 6))]))
+
+    def test_running_jobs_elsewhere(self):
+        running = sacct_line('5', utc(2026, 10, 7, 20), 0, state='RUNNING')
+        api = self.local[:1] + self.local[2:]  # job 2 missing from the API
+        mismatched, unsettled, _ = self.compare(self.local + [running], api)
+        self.assertEqual((mismatched, unsettled), ([('fc_foo', utc(2026, 10, 6))], []))
+
+    def test_pending_jobs_left_out(self):
+        pending = sacct_line('5', 0, 0, state='PENDING')
+        self.assertEqual(self.compare(self.local + [pending], self.local)[:2], ([], []))
+
+    def test_failed_fetch(self):
+        api = self.local[:2]  # fc_bar's jobs missing
+        mismatched, unsettled, stats = self.compare(self.local, api, failing=('fc_bar',))
+        self.assertEqual((mismatched, unsettled), ([], []))
+        self.assertEqual(stats['failed'], 1)
+
+
+class ExtendSacctTest(unittest.TestCase):
+    def setUp(self):
+        self.numpy = jobs.numpy
+        start = utc(2026, 10, 5, 10)
+        self.out = '\n'.join([
+            sacct_line('100', start, 1.5),
+            sacct_line('101', start, 2, partition='savio2', cpus=3),
+            sacct_line('102', start, 0, state='RUNNING'),
+            sacct_line('103', start, 0, state='PENDING'),
+            sacct_line('104_1', start, 0.5, cpus=1),
+            sacct_line('105', start, 1).replace('|4|1|2|', '|x|1|2|'),
+            sacct_line('106', start, 1).replace(str(start), '2026-13-01T00:00:00'),
+            '107|too|few',
+            ''])
+
+    def tearDown(self):
+        jobs.numpy = self.numpy
+
+    def extend(self, select=None):
+        table = jobs.JobTable()
+        errors = table.extend_sacct(self.out.encode('utf-8'), PRICES.get, select=select)
+        return table, errors
+
+    def check(self):
+        table, errors = self.extend(lambda jobid, state: state not in reconcile.SKIPPED_STATES)
+        self.assertEqual([table.jobid(row) for row in range(len(table))], ['100', '101', '104_1'])
+        self.assertEqual(list(table.amount), [6.0, 4.5, 0.5])
+        self.assertEqual(table.value('partition', 1), 'savio2')
+        self.assertEqual(errors, [('107', 'expected 15 fields, got 3'),
+                                  ('105', "invalid AllocCPUS: 'x'"),
+                                  ('106', "invalid Start: '2026-13-01T00:00:00'")])
+
+        table, errors = self.extend()  # running and pending jobs, without an End
+        self.assertEqual(len(table), 3)
+        self.assertEqual([jobid for jobid, _ in errors], ['107', '102', '103', '105', '106'])
+        self.assertEqual(errors[1], ('102', "invalid End: 'Unknown'"))
+        self.assertEqual(errors[2], ('103', "invalid Start: 'Unknown'"))
+
+    @unittest.skipIf(jobs.numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        self.check()
+
+    def test_without_numpy(self):
+        jobs.numpy = None
+        self.check()
+
+    def test_no_rows(self):
+        table = jobs.JobTable()
+        self.assertEqual(table.extend_sacct('', PRICES.get), [])
+        self.assertEqual(table.extend_sacct(self.out, PRICES.get, select=lambda jobid, state: False),
+                         [('107', 'expected 15 fields, got 3')])
+        self.assertEqual(len(table), 0)
+
+    def test_every_listed_job_seen(self):
+        '''reconcile_jobs tells the jobs only the API has from those sacct listed through select() and the
+        errors, not the table, which leaves out pending and running jobs and the rows it can't parse'''
+        listed = set()
+
+        def select(jobid, state):
+            listed.add(jobid)
+            return state not in reconcile.SKIPPED_STATES
+
+        table, errors = self.extend(select)
+        listed.update(jobid for jobid, _ in errors)
+        self.assertEqual(listed, set(['100', '101', '102', '103', '104_1', '105', '106', '107']))
+        self.assertEqual(set(table.jobid(row) for row in range(len(table))), set(['100', '101', '104_1']))
+
+
+if __name__ == '__main__':
+    unittest.main()
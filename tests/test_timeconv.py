@@ -0,0 +1,81 @@
+'''
+Tests of bankutils.timeconv, runnable with python 2 and 3:
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import time
+import calendar
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bankutils import timeconv  # noqa: E402
+
+
+def set_zone(zone):
+    if zone is None:
+        os.environ.pop('TZ', None)
+    else:
+        os.environ['TZ'] = zone
+    time.tzset()
+    timeconv._utc_offsets.clear()
+    timeconv._naive_offsets.clear()
+
+
+@unittest.skipUnless(hasattr(time, 'tzset'), 'needs time.tzset()')
+class LocalZoneTest(unittest.TestCase):
+    '''in America/Los_Angeles, where the clusters are'''
+
+    def setUp(self):
+        self.zone = os.environ.get('TZ')
+        set_zone('America/Los_Angeles')
+
+    def tearDown(self):
+        set_zone(self.zone)
+
+    def test_sacct_timestamp_forms_agree(self):
+        for utc in ((2026, 1, 15, 20, 30, 5), (2026, 7, 1, 6, 59, 59), (2026, 3, 8, 10, 0, 0)):
+            epoch = calendar.timegm(utc + (0, 0, 0))
+            wall = time.strftime(timeconv.TIMESTAMP_FORMAT_COMPLETE, time.localtime(epoch))  # as sacct prints it
+            self.assertEqual(timeconv.sacct_timestamp(str(epoch)), epoch)
+            self.assertEqual(timeconv.sacct_timestamp(wall), epoch)
+
+    def test_sacct_wall_time_is_local(self):
+        self.assertEqual(timeconv.format_timestamp(timeconv.sacct_timestamp('2026-01-15T12:30:05')),
+                         '2026-01-15T20:30:05')  # PST
+        self.assertEqual(timeconv.format_timestamp(timeconv.sacct_timestamp('2026-07-15T12:30:05')),
+                         '2026-07-15T19:30:05')  # PDT
+
+    def test_sacct_timestamp_unknown(self):
+        for value in ('Unknown', 'None', ''):
+            with self.assertRaises(ValueError):
+                timeconv.sacct_timestamp(value)
+
+    def test_utc2local_round_trip(self):
+        epoch = calendar.timegm((2026, 11, 1, 10, 30, 0, 0, 0, 0))  # 02:30 PST, after the DST change
+        self.assertEqual(timeconv.format_timestamp(timeconv.utc2local(epoch)), '2026-11-01T02:30:00')
+        self.assertEqual(timeconv.local2utc(timeconv.utc2local(epoch)), epoch)
+
+    def test_sacct_env(self):
+        env = timeconv.sacct_env({'PATH': '/bin'})
+        self.assertEqual(env, {'PATH': '/bin', 'SLURM_TIME_FORMAT': '%s'})
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse_and_format(self):
+        epoch = calendar.timegm((2026, 2, 28, 23, 59, 58, 0, 0, 0))
+        for value in ('2026-02-28T23:59:58', '2026-02-28 23:59:58', '2026-02-28T23:59:58.123456',
+                      '2026-02-28T23:59:58Z'):
+            self.assertEqual(timeconv.parse_timestamp(value), epoch)
+        self.assertEqual(timeconv.parse_timestamp('2026-02-28'), epoch - 86398)
+        self.assertEqual(timeconv.format_timestamp(epoch), '2026-02-28T23:59:58')
+
+    def test_invalid(self):
+        for value in ('2026/02/28', '2026-02-28T24:00:00', '2026-02-28T23:59', '2026-02-28X'):
+            with self.assertRaises(ValueError):
+                timeconv.parse_timestamp(value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+'''
+Tests of bankutils.transport, runnable with python 2 and 3:
+
+    python -m unittest discover tests
+'''
+import io
+import os
+import sys
+import json
+import zlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bankutils import httpcache, jsonstream, transport  # noqa: E402
+
+
+URL = 'http://127.0.0.1/api/projects/?page=1'
+JOBS_URL = 'http://127.0.0.1/api/jobs/?page=1'
+
+
+def gzipped(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Response(object):
+    '''an httplib-like response'''
+
+    def __init__(self, status, body=b'', headers=None):
+        self.status = status
+        self.body = io.BytesIO(body)
+        self.headers = dict(headers or {})
+        self.closed = False
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+    def close(self):
+        self.closed = True
+
+
+class NotModified(IOError):
+    '''like urllib2's HTTPError for a 304'''
+    code = 304
+
+    def info(self):
+        return {'ETag': '"v1"'}
+
+
+class Refused(IOError):
+    '''a connection error'''
+
+
+class TransportTest(unittest.TestCase):
+    def setUp(self):
+        self.observed = []
+        self.sent = []
+
+    def transport(self, cache=None):
+        return transport.Transport(cache=cache, observe=lambda *args: self.observed.append(args[:2] + args[3:]))
+
+    def send(self, *responses):
+        responses = list(responses)
+
+        def send(headers, span):
+            self.sent.append(headers)
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        return send
+
+    def test_gzip_and_observe(self):
+        body = json.dumps({'count': 0}).encode('utf-8')
+        data = gzipped(body)
+        response = Response(200, data, {'Content-Encoding': 'gzip', 'Content-Length': str(len(data))})
+        status, received = self.transport().request('GET', URL, {'Authorization': 'Token a'}, None,
+                                                    self.send(response))
+        self.assertEqual((status, received), (200, body))
+        self.assertEqual(self.sent[0]['Accept-Encoding'], jsonstream.ACCEPT_ENCODING)
+        self.assertEqual(self.sent[0]['Authorization'], 'Token a')
+        self.assertEqual(self.observed, [('GET', URL, 0, len(data), 200)])
+        self.assertTrue(response.closed)
+
+    def test_incomplete_body(self):
+        response = Response(200, b'{"count"', {'Content-Length': '100'})
+        with self.assertRaises(jsonstream.IncompletePage):
+            self.transport().request('GET', URL, {}, None, self.send(response))
+        self.assertEqual(self.observed, [('GET', URL, 0, 0, 'IncompletePage')])
+
+    def test_not_modified(self):
+        cache = httpcache.ValidatorCache()
+        kept = Response(200, b'{"count": 1}', {'ETag': '"v1"'})
+        for not_modified in (Response(304), NotModified()):  # from httplib, from urllib2
+            session = self.transport(cache)
+            session.request('GET', URL, {'Authorization': 'Token a'}, None, self.send(kept))
+            self.assertEqual(session.request('GET', URL, {'Authorization': 'Token a'}, None, self.send(not_modified)),
+                             (200, b'{"count": 1}'))
+            self.assertEqual(self.sent[-1]['If-None-Match'], '"v1"')
+            self.assertEqual(self.observed[-1][-1], 304)
+            kept = Response(200, b'{"count": 1}', {'ETag': '"v1"'})
+
+    def test_error_raised(self):
+        with self.assertRaises(Refused):
+            self.transport().request('PUT', URL, {}, b'x=1', self.send(Refused('connection refused')))
+        self.assertEqual(self.observed, [('PUT', URL, 3, 0, 'Refused')])
+
+    def test_stream(self):
+        body = json.dumps({'count': 2, 'results': [1, 2], 'next': None}).encode('utf-8')
+        response = Response(200, gzipped(body), {'Content-Encoding': 'gzip'})
+        status, page = self.transport().stream('GET', JOBS_URL, {}, None, self.send(response))
+        self.assertEqual(status, 200)
+        self.assertEqual(self.observed, [])  # recorded once read
+        self.assertEqual(list(page.iter_results()), [1, 2])
+        self.assertEqual(page['next'], None)
+        self.assertEqual(self.observed, [('GET', JOBS_URL, 0, len(gzipped(body)), 200)])
+        self.assertTrue(response.closed)
+
+    def test_stream_cacheable_read_whole(self):
+        response = Response(200, b'{"results": [1]}', {'ETag': '"v1"'})
+        cache = httpcache.ValidatorCache()
+        _, page = self.transport(cache).stream('GET', URL, {}, None, self.send(response))
+        self.assertEqual(self.observed, [('GET', URL, 0, 16, 200)])
+        self.assertEqual(page['results'], [1])
+
+
+if __name__ == '__main__':
+    unittest.main()